@@ -1,10 +1,11 @@
 import os
+import time
 from pathlib import Path
 
 from dotenv import load_dotenv
 
 from .setup import TIMEZONE, TIME_STR
-from .setup import PYTHON_PATH, APP_PATH, AUDIO_TMP_DIR
+from .setup import PYTHON_PATH, APP_PATH, STORAGE_DIR, AUDIO_TMP_DIR, INDEX_VERSION_FILE, EMBEDDING_CACHE_DIR
 from .log.timeit import timeit, async_timeit
 from .log.log import get_log, LOG_TYPE
 from .core.utils import load_yaml
@@ -12,6 +13,9 @@ from .core.utils import load_yaml
 LOGGER = get_log(name=LOG_TYPE.LOCAL)
 
 
+# time to load the env/YAML config (reported with the startup timings)
+CONFIG_START = time.perf_counter()
+
 # Load environment variables from .env file
 env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
@@ -21,6 +25,8 @@ class Config:
     DB_CONECTION = os.getenv('DB_CONECTION')
     DB_TABLE_CLIENT = os.getenv('DB_TABLE_CLIENT')
     DB_TABLE_CONVERSATION = os.getenv('DB_TABLE_CONVERSATION')
+    DB_TABLE_PROMPT = os.getenv('DB_TABLE_PROMPT', 'prompt')
+    SESSION_REDIS_URL = os.getenv('SESSION_REDIS_URL')
 
     # config for speech
     SPEECH_REGION = os.getenv('SPEECH_REGION')
@@ -41,8 +47,47 @@ class Config:
     INTERNET_SEARCH = int(SEACHER.get("internet_search", 3))
     SEARCH_WITH_EMOTION = bool(SEACHER.get("search_with_emotion", False))
     HISTORY_LENGTH = int(SEACHER.get("history_length", 2))
+    HISTORY_TOKEN_BUDGET = int(SEACHER.get("history_token_budget", 0))
+    HISTORY_SUMMARY = bool(SEACHER.get("history_summary", False))
+    HISTORY_SUMMARY_MAX_TOKENS = int(SEACHER.get("history_summary_max_tokens", 200))
+    TOKENIZER_ENCODING = str(SEACHER.get("tokenizer_encoding", "o200k_base"))
     STATUS_DURATION = int(SEACHER.get("status_duration", 3600))
     OUTDATE_DURATION = int(SEACHER.get("outdate_duration", 3600))
+    FLUSH_BATCH_SIZE = int(SEACHER.get("flush_batch_size", 1000))
+    DB_RETRIES = int(SEACHER.get("db_retries", 3))
+    DB_RETRY_BACKOFF = float(SEACHER.get("db_retry_backoff", 0.5))
+    DB_CONCURRENCY = int(SEACHER.get("db_concurrency", 8))
+    SESSION_STORE = str(SEACHER.get("session_store", "memory"))
+    SESSION_SQLITE_PATH = str(SEACHER.get("session_sqlite_path", "sessions.db"))
+    REHYDRATE_NEGATIVE_TTL = int(SEACHER.get("rehydrate_negative_ttl", 300))
+    SESSION_MAX_COUNT = int(SEACHER.get("session_max_count", 0))
+    SESSION_MAX_BYTES = int(SEACHER.get("session_max_size", 0)) * 1024 * 1024
+    SESSION_TOKEN_QUOTA = int(SEACHER.get("session_token_quota", 0))
+    INACTIVE_MAX_COUNT = int(SEACHER.get("inactive_max_count", 0))
+    AUDIO_CACHE_MAX_SIZE = int(SEACHER.get("audio_cache_max_size", 1024))
+    AUDIO_CACHE_MAX_AGE = int(SEACHER.get("audio_cache_max_age", 86400))
+    ANSWER_CACHE_SIZE = int(SEACHER.get("answer_cache_size", 0))
+    ANSWER_CACHE_TTL = int(SEACHER.get("answer_cache_ttl", 3600))
+    ANSWER_CACHE_THRESHOLD = float(SEACHER.get("answer_cache_threshold", 0.95))
+    EMBEDDING_CACHE_SIZE = int(SEACHER.get("embedding_cache_size", 0))
+    EMBEDDING_CACHE_PERSIST = bool(SEACHER.get("embedding_cache_persist", False))
+    SEARCH_CONCURRENCY = int(SEACHER.get("search_concurrency", 16))
+    TOOL_TIMEOUT = float(SEACHER.get("tool_timeout", 20))
+    RETRIEVER = str(SEACHER.get("retriever", "azure"))
+    LOCAL_BUNDLE = str(SEACHER.get("local_bundle", "bundles"))
+    LOCAL_IMAGE_THRESHOLD = float(SEACHER.get("local_image_threshold", 0.5))
+    RRF_K = int(SEACHER.get("rrf_k", 60))
+    HTTP_POOL_SIZE = int(SEACHER.get("http_pool_size", 100))
+    HTTP_POOL_SIZE_PER_HOST = int(SEACHER.get("http_pool_size_per_host", 32))
+    HTTP_TIMEOUT = float(SEACHER.get("http_timeout", 10))
+    HTTP_CONNECT_TIMEOUT = float(SEACHER.get("http_connect_timeout", 3))
+    HTTP_RETRIES = int(SEACHER.get("http_retries", 2))
+    HTTP_RETRY_BACKOFF = float(SEACHER.get("http_retry_backoff", 0.5))
+    TOKEN_RELOAD_INTERVAL = float(SEACHER.get("token_reload_interval", 5))
+    CONFIG_RELOAD_INTERVAL = float(SEACHER.get("config_reload_interval", 5))
+    STATIC_CACHE_MAX_AGE = int(SEACHER.get("static_cache_max_age", 0))
+    RATE_LIMIT = float(SEACHER.get("rate_limit", 0))
+    RATE_LIMIT_BURST = int(SEACHER.get("rate_limit_burst", 20))
 
 
     # config for Azure search
@@ -63,11 +108,12 @@ class Config:
     STT_LOCALES = os.getenv('STT_LOCALES')
     LANGUAGE_DEFAULT = "vi-VN"
     LANGUAGES_PATH = os.path.join(APP_PATH, 'conf', 'languages.yaml')
-    LANGUAGES = load_yaml(LANGUAGES_PATH)
+    # languages with their title/greeting/waiting, loaded by load_languages()
+    LANGUAGES = {}
 
     # config for logo
     LOGO_PATH = os.path.join(APP_PATH, "conf", "logo.yaml")
-    LOGO = load_yaml(LOGO_PATH).get(COGNITIVE_SEARCH_INDEX_NAME, load_yaml(LOGO_PATH)['default'])
+    LOGO = {}
 
     # config for prompt
     SYSTEM_PROMPT = os.getenv('SYSTEM_PROMPT')
@@ -77,16 +123,10 @@ class Config:
     # config for title
     TITLE_DEFAULT = "Tôi là trợ lý ảo."
     TITLE_PATH = os.path.join(APP_PATH, "conf", "titles.yaml")
-    TITLES = load_yaml(TITLE_PATH).get(COGNITIVE_SEARCH_INDEX_NAME, "default")
-    for k in LANGUAGES.keys():
-        LANGUAGES[k]['title'] = TITLES[k] if k in TITLES else TITLE_DEFAULT
 
     # config for greeting
     GREETING_DEFAULT = "Xin chào!"
     GREETING_PATH = os.path.join(APP_PATH, "conf", "greeting.yaml")
-    GREETING = load_yaml(GREETING_PATH).get("default", "")
-    for k in LANGUAGES.keys():
-        LANGUAGES[k]['greeting'] = GREETING[k] if k in GREETING else GREETING_DEFAULT
 
     # config for chat excption
     CHAT_EXCEPTION_DEFAULT = "Xin lỗi, tôi không thể trả lời câu hỏi này. Vui lòng hỏi câu hỏi khác!"
@@ -101,12 +141,39 @@ class Config:
             }
         }
     WAITING_PATH = os.path.join(APP_PATH, "conf", "waiting.yaml")
-    WAITINGS = load_yaml(WAITING_PATH)
-    WAITINGS = WAITINGS.get("default", "")
-    for k in LANGUAGES.keys():
-        LANGUAGES[k]['waiting'] = WAITINGS[k] if k in WAITINGS else WAITING_DEFAULT
+    # YAML files of the languages and the logo (reloaded when they change)
+    LANGUAGE_FILES = [LANGUAGES_PATH, TITLE_PATH, GREETING_PATH, WAITING_PATH, LOGO_PATH]
+
+def load_languages():
+    """
+    Load the languages (with their title, greeting and waiting texts) and the logo of the search index into Config.
+    Called at import and when the YAML files changed.
+    """
+    languages = load_yaml(Config.LANGUAGES_PATH)
+    titles = load_yaml(Config.TITLE_PATH).get(Config.COGNITIVE_SEARCH_INDEX_NAME, "default")
+    greeting = load_yaml(Config.GREETING_PATH).get("default", "")
+    waitings = load_yaml(Config.WAITING_PATH).get("default", "")
+    for k in languages.keys():
+        languages[k]['title'] = titles[k] if k in titles else Config.TITLE_DEFAULT
+        languages[k]['greeting'] = greeting[k] if k in greeting else Config.GREETING_DEFAULT
+        languages[k]['waiting'] = waitings[k] if k in waitings else Config.WAITING_DEFAULT
+    logos = load_yaml(Config.LOGO_PATH)
+    # replace the dicts (requests being served keep the previous ones)
+    Config.LANGUAGES = languages
+    Config.LOGO = logos.get(Config.COGNITIVE_SEARCH_INDEX_NAME, logos['default'])
+
+load_languages()
+
+CONFIG_SECONDS = time.perf_counter() - CONFIG_START
+
+# credentials of the env, never written to the logs
+SECRET_CONFIG = ("DB_CONECTION", "SESSION_REDIS_URL", "SPEECH_KEY", "AZURE_OPENAI_API_KEY", "COGNITIVE_SEARCH_API_KEY",
+                 "BING_SUBSCRIPTION_KEY", "ICE_SERVER_PASSWORD")
 
 def show_config():
     attrs = (name for name in vars(Config) if not name.startswith('_'))
     for attr in attrs:
-        LOGGER.info("-{}={}".format(attr, getattr(Config, attr)))
+        value = getattr(Config, attr)
+        if attr in SECRET_CONFIG and value:
+            value = "***"
+        LOGGER.info("-{}={}".format(attr, value))
@@ -1,29 +1,39 @@
 import json
+import time
 import inspect
 import asyncio
 import ast
 from datetime import datetime
  
-import requests
 from openai import AsyncAzureOpenAI
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryAnswerType, QueryCaptionType, QueryType, VectorizedQuery
 from ..config import Config, LOGGER, async_timeit
+from ..log.metrics import LLM_TOKENS, SEARCH_CALLS
+from ..log.trace import span, start_span, NOOP_SPAN
+from .http import get_json
+from .cache import EMBEDDING_CACHE
+from .tokens import count_tokens, count_message_tokens, count_prompt_tokens
+from .retriever import Retriever, create_retriever
+from .services import SERVICES
  
 PERSONA = Config.PERSONA
  
-AzureOpenAIClient = AsyncAzureOpenAI(
-    api_key=Config.AZURE_OPENAI_API_KEY,
-    api_version=Config.AZURE_OPENAI_API_VERSION,
-    azure_endpoint=Config.AZURE_OPENAI_ENDPOINT
-)
- 
-AzureSearchClient = SearchClient(
-    endpoint=Config.COGNITIVE_SEARCH_ENDPOINT,
-    index_name=Config.COGNITIVE_SEARCH_INDEX_NAME,
-    credential=AzureKeyCredential(Config.COGNITIVE_SEARCH_API_KEY)
-)
+def create_openai_client() -> AsyncAzureOpenAI:
+    return AsyncAzureOpenAI(
+        api_key=Config.AZURE_OPENAI_API_KEY,
+        api_version=Config.AZURE_OPENAI_API_VERSION,
+        azure_endpoint=Config.AZURE_OPENAI_ENDPOINT
+    )
+
+# clients built at startup or at the first call
+SERVICES.register("openai", create_openai_client, close=lambda client: client.close())
+# retriever of local search (azure/local)
+SERVICES.register("retriever", create_retriever, close=lambda retriever: retriever.close(), required=Config.LOCAL_SEARCH > 0)
+
+def get_openai_client() -> AsyncAzureOpenAI:
+    return SERVICES.get("openai")
+
+def get_retriever() -> Retriever:
+    return SERVICES.get("retriever")
  
 class ToolResponseFormat:
     content: str
@@ -68,11 +78,11 @@ def get_language(language_code):
 @async_timeit()
 async def internet_search(query, max_results=Config.INTERNET_SEARCH):
     LOGGER.info("query: {} - max_results: {}".format(query, max_results))
-    params = {'q': query, 'mkt': 'en-US', "textDecorations": True, "textFormat": "HTML"}
+    params = {'q': query, 'mkt': 'en-US', "textDecorations": "true", "textFormat": "HTML"}
     headers = {'Ocp-Apim-Subscription-Key': Config.BING_SUBSCRIPTION_KEY}
-    response = requests.get(Config.BING_SEARCH_URL, headers=headers, params=params)
-    response.raise_for_status()
-    search_results = response.json()
+    with span("internet_search", max_results=max_results) as s:
+        search_results = await get_json(Config.BING_SEARCH_URL, headers=headers, params=params)
+        s.set("results", len(search_results["webPages"]["value"][:max_results]))
     
     images = []
 
@@ -86,8 +96,18 @@ async def internet_search(query, max_results=Config.INTERNET_SEARCH):
 @async_timeit()
 async def get_embedding(text, model=Config.AZURE_OPENAI_EMB_DEPLOYMENT):
     text = text.replace("\n", " ")
-    embedding_response = await AzureOpenAIClient.embeddings.create(input=[text], model=model)
-    embedding = embedding_response.data[0].embedding
+    with span("embedding", model=model) as s:
+        embedding = EMBEDDING_CACHE.get(text, model)
+        s.set("cache_hit", embedding is not None)
+        if embedding is not None:
+            return embedding
+        ts = time.perf_counter()
+        embedding_response = await get_openai_client().embeddings.create(input=[text], model=model)
+        embedding = embedding_response.data[0].embedding
+        if embedding_response.usage is not None:
+            LLM_TOKENS.inc(model, "embedding", value=embedding_response.usage.prompt_tokens)
+            s.set("tokens", embedding_response.usage.prompt_tokens)
+        EMBEDDING_CACHE.put(text, model, embedding, time.perf_counter() - ts)
     return embedding
  
 @async_timeit()
@@ -95,28 +115,19 @@ async def local_search(search_query, max_results=Config.LOCAL_SEARCH):
     search_query= search_query.replace("tại", "")
     search_query= search_query.replace("Madame Lân", "")
     search_query= search_query.replace("Đà Nẵng", "")
-    print(search_query)
     LOGGER.info("search_query: {}".format(search_query))
-    vector = VectorizedQuery(vector=await get_embedding(search_query), k_nearest_neighbors=max_results, fields="summaryVector")
-    results = AzureSearchClient.search(
-        search_text=search_query,
-        vector_queries=[vector],
-        query_type=QueryType.SEMANTIC, semantic_configuration_name='my-semantic-config',
-        query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
-        select=["summary", "content_details","image_links"],
-        top=max_results
-    )
+    vector = await get_embedding(search_query)
     text_content = "Here is the result of local search: \n"
     index = 1
     images = []
+    with span("local_search", retriever=Config.RETRIEVER, max_results=max_results) as s:
+        results = await get_retriever().search(search_query, vector, max_results)
+        s.set("results", len(results))
     for result in results:
         text_content += f"{index}. {result['summary']}\n{result['content_details']}\n"
         index += 1
-        print("="*40 + f"\n{result['summary']}\n" + "="*40)
-        #images.append(result['image_links'])
-        eranker_score = result.get('@search.reranker_score')
-        print(eranker_score)
-        if(float(eranker_score)>=2.3):
+        LOGGER.debug("result: score={} - summary={}".format(result['score'], result['summary']))
+        if result['show_images']:
             images.append(result['image_links'])
  
     return ToolResponseFormat(content=text_content, images=images)
@@ -125,7 +136,7 @@ async def local_search(search_query, max_results=Config.LOCAL_SEARCH):
 async def search(query):
     results = {}
     tasks = {}
-    print(query)
+    LOGGER.debug("query: {}".format(query))
     if Config.LOCAL_SEARCH > 0:
         tasks['local_search'] = asyncio.create_task(local_search(query))
 
@@ -137,11 +148,13 @@ async def search(query):
     for search_type, task in tasks.items():
         try:
             result = await task
+            SEARCH_CALLS.inc(search_type, "ok")
             results[search_type] = result.content.strip()
             if search_type == 'local_search':
                 image_links=result.get_args('images')
             # print("@"*40 + f"\n{search_type} =====> {image_links}\n" + "@"*40)
         except Exception as exc:
+            SEARCH_CALLS.inc(search_type, "error")
             results[search_type] = f'{search_type} generated an exception: {exc}'
  
     combined_results = ""
@@ -159,6 +172,48 @@ async def search(query):
         image_filtration = image_links[0]
     return ToolResponseFormat(content=combined_results, images=image_filtration)
  
+def count_usage(model, conversation, content, usage=None):
+    """
+    Count the tokens of a chat completion: usage of the response, else counted with the tokenizer
+    (streamed responses of the API version have no usage).
+    Args:
+        model (str): deployment name
+        conversation (list): messages of the request
+        content (str): content of the reply
+        usage (CompletionUsage): usage of the response
+    Returns:
+        (prompt_tokens, completion_tokens)
+    """
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt_tokens = sum(count_prompt_tokens(message["content"]) if message.get("role") == "system" else
+                            count_message_tokens(message.get("content") or "") for message in conversation)
+        completion_tokens = count_tokens(content)
+    LLM_TOKENS.inc(model, "prompt", value=prompt_tokens)
+    LLM_TOKENS.inc(model, "completion", value=completion_tokens)
+    return prompt_tokens, completion_tokens
+
+def merge_tool_call_deltas(tool_calls, deltas):
+    """
+    Merge streamed tool-call deltas into complete tool calls.
+    Args:
+        tool_calls (dict): tool calls by index (id/type/function.name/function.arguments)
+        deltas (list): ChoiceDeltaToolCall of one chunk
+    Returns:
+        tool_calls (dict)
+    """
+    for delta in deltas:
+        tool_call = tool_calls.setdefault(delta.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+        if delta.id:
+            tool_call["id"] = delta.id
+        if delta.function is not None:
+            if delta.function.name:
+                tool_call["function"]["name"] += delta.function.name
+            if delta.function.arguments:
+                tool_call["function"]["arguments"] += delta.function.arguments
+    return tool_calls
+ 
 def check_args(function, args):
     sig = inspect.signature(function)
     params = sig.parameters
@@ -203,6 +258,65 @@ class Smart_Agent():
  
     def get_current_prompt(self, language_code):
         return self.persona.format(current_date=get_current_date(), prompt_by_search_mode=get_prompt_by_search_mode(), language=get_language(language_code))
+
+    async def call_tool(self, tool_call):
+        """
+        Call one tool with timeout, errors are returned as the tool response.
+        Args:
+            tool_call (dict): tool call in dict format (id/function.name/function.arguments)
+        Returns:
+            (message, image_links): tool message, images of the response (None if failed)
+        """
+        function_name = tool_call["function"]["name"]
+        image_links = None
+        with span("tool", function=function_name) as s:
+            try:
+                if function_name not in self.functions_list:
+                    raise ValueError("function {} is not available".format(function_name))
+                function_to_call = self.functions_list[function_name]
+                function_args = json.loads(tool_call["function"]["arguments"])
+                if check_args(function_to_call, function_args) is False:
+                    raise ValueError("invalid arguments {}".format(function_args))
+                function_response = await asyncio.wait_for(function_to_call(**function_args), timeout=Config.TOOL_TIMEOUT)
+                content = function_response.content
+                image_links = function_response.get_args('images')
+            except asyncio.TimeoutError as e:
+                LOGGER.error("Tool {} timed out after {}s".format(function_name, Config.TOOL_TIMEOUT))
+                content = "{} timed out, no result.".format(function_name)
+                s.error(e)
+            except Exception as e:
+                LOGGER.error("Exception: {}".format(e))
+                content = "{} generated an exception: {}".format(function_name, e)
+                s.error(e)
+        message = {
+            "tool_call_id": tool_call["id"],
+            "role": "tool",
+            "name": function_name,
+            "content": content,
+        }
+        return message, image_links
+
+    async def call_tools(self, conversation, tool_calls):
+        """
+        Call the requested tools concurrently and append their responses to the conversation, in the order of the calls.
+        Args:
+            conversation (list): messages, the last one is the assistant message with tool_calls
+            tool_calls (list): tool calls in dict format (id/function.name/function.arguments)
+        Returns:
+            image_links (list): images of the last successful tool response, None if no tool succeeded
+        """
+        image_links = None
+        responses = await asyncio.gather(*[self.call_tool(tool_call) for tool_call in tool_calls])
+        for message, images in responses:
+            conversation.append(message)
+            if images is not None:
+                image_links = images
+        if Config.LOCAL_SEARCH > 0 and Config.INTERNET_SEARCH <= 0:
+            conversation.append({
+                "role": "system",
+                "content": "Only respond truthfully based on the retrieved information. Do not add any information that was not provided in the retrieved results."
+            })
+        return image_links
  
     @async_timeit()
     async def run(self, language_code, conversation):
@@ -212,18 +326,22 @@ class Smart_Agent():
             max_tokens = 600
             image_links = []
             while True:
-                response = await AzureOpenAIClient.chat.completions.create(
-                model=self.engine,
-                messages=conversation,
-                tools=self.functions_spec,
-                tool_choice='auto',
-                max_tokens=max_tokens,
-                # The 'temperature' parameter controls the randomness of the output.
-                # A temperature of 0.0 means the model will generate predictable, consistent, and precise responses.
-                temperature=0.0
-            )
-                response_message = response.choices[0].message
-                finish_reason = response.choices[0].finish_reason
+                with span("llm", model=self.engine, messages=len(conversation)) as s:
+                    response = await get_openai_client().chat.completions.create(
+                    model=self.engine,
+                    messages=conversation,
+                    tools=self.functions_spec,
+                    tool_choice='auto',
+                    max_tokens=max_tokens,
+                    # The 'temperature' parameter controls the randomness of the output.
+                    # A temperature of 0.0 means the model will generate predictable, consistent, and precise responses.
+                    temperature=0.0
+                )
+                    response_message = response.choices[0].message
+                    finish_reason = response.choices[0].finish_reason
+                    prompt_tokens, completion_tokens = count_usage(self.engine, conversation, response_message.content, response.usage)
+                    s.set("prompt_tokens", prompt_tokens).set("completion_tokens", completion_tokens)
+                    s.set("finish_reason", str(finish_reason)).set("tool_calls", len(response_message.tool_calls or []))
                 if finish_reason == 'content_filter':
                     retry_count += 1
                     if retry_count <= max_retries:
@@ -242,32 +360,9 @@ class Smart_Agent():
                         "content": response_message.content,
                         "tool_calls": response_message.tool_calls
                     })
-                    for tool_call in tool_calls:
-                        function_name = tool_call.function.name
-                        if function_name not in self.functions_list:
-                            conversation.pop()
-                            continue
-                        function_to_call = self.functions_list[function_name]
-                        function_args = json.loads(tool_call.function.arguments)
-                        if check_args(function_to_call, function_args) is False:
-                            conversation.pop()
-                            continue
-                        function_response = await function_to_call(**function_args)
-                        image_links = function_response.get_args('images')
-                        conversation.append(
-                            {
-                                "tool_call_id": tool_call.id,
-                                "role": "tool",
-                                "name": function_name,
-                                "content": function_response.content,
-                            }
-                        )
-                    if Config.LOCAL_SEARCH > 0 and Config.INTERNET_SEARCH <= 0:
-                        conversation.append({
-                            "role": "system",
-                            "content": "Only respond truthfully based on the retrieved information. Do not add any information that was not provided in the retrieved results."
-                        })   
- 
+                    images = await self.call_tools(conversation, [tool_call.model_dump() for tool_call in tool_calls])
+                    if images is not None:
+                        image_links = images
                     continue
  
                 else:
@@ -281,4 +376,92 @@ class Smart_Agent():
             LOGGER.error("assistant_response: {}".format(assistant_response))
  
         finally:
-            return assistant_response, image_links
\ No newline at end of file
+            return assistant_response, image_links
+
+    async def run_stream(self, language_code, conversation):
+        """
+        Stream the assistant reply while it is generated.
+        Tool-call deltas are merged by index and the tools are called before the next completion.
+        Args:
+            language_code (str): language code
+            conversation (list): messages (system/user/assistant)
+        Yields:
+            ("delta", str): new content of the reply
+            ("reset", None): the content streamed so far must be discarded (retry/tool calls)
+            ("done", (str, list)): full assistant reply and image links
+        """
+        max_retries = 3
+        retry_count = 0
+        max_tokens = 600
+        image_links = []
+        s = NOOP_SPAN
+        try:
+            while True:
+                # not the current span: the consumer of the deltas runs between the chunks
+                s = start_span("llm", model=self.engine, messages=len(conversation), stream=True)
+                stream = await get_openai_client().chat.completions.create(
+                    model=self.engine,
+                    messages=conversation,
+                    tools=self.functions_spec,
+                    tool_choice='auto',
+                    max_tokens=max_tokens,
+                    temperature=0.0,
+                    stream=True
+                )
+                content = ""
+                tool_calls = {}
+                finish_reason = None
+                usage = None
+                async for chunk in stream:
+                    usage = getattr(chunk, "usage", None) or usage
+                    # azure sends prompt filter results in a chunk without choices
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    if choice.delta is not None:
+                        if choice.delta.content:
+                            content += choice.delta.content
+                            yield "delta", choice.delta.content
+                        if choice.delta.tool_calls:
+                            merge_tool_call_deltas(tool_calls, choice.delta.tool_calls)
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+                prompt_tokens, completion_tokens = count_usage(self.engine, conversation, content, usage)
+                s.set("prompt_tokens", prompt_tokens).set("completion_tokens", completion_tokens)
+                s.set("finish_reason", str(finish_reason)).set("tool_calls", len(tool_calls))
+                s.finish()
+
+                if finish_reason == 'content_filter':
+                    retry_count += 1
+                    if retry_count <= max_retries:
+                        LOGGER.warning(f"Content filter triggered. Retrying {retry_count}/{max_retries}...")
+                        yield "reset", None
+                        continue
+                    else:
+                        raise ValueError("Content was filtered by OpenAI due to violation of content policies.")
+
+                if tool_calls:
+                    max_tokens = 300
+                    if content:
+                        yield "reset", None
+                    tool_calls = [tool_calls[index] for index in sorted(tool_calls)]
+                    conversation.append({
+                        "role": "assistant",
+                        "content": content,
+                        "tool_calls": tool_calls
+                    })
+                    images = await self.call_tools(conversation, tool_calls)
+                    if images is not None:
+                        image_links = images
+                    continue
+                assistant_response = content
+                break
+        except Exception as e:
+            LOGGER.error("Exception: {}".format(e))
+            s.error(e)
+            s.finish()
+            assistant_response = Config.CHAT_EXCEPTION[language_code] if language_code in Config.CHAT_EXCEPTION else Config.CHAT_EXCEPTION_DEFAULT
+            LOGGER.error("assistant_response: {}".format(assistant_response))
+            yield "reset", None
+            yield "delta", assistant_response
+        yield "done", (assistant_response, image_links)
@@ -1,20 +1,128 @@
 import os
+import time
 
-from app.config import APP_PATH, LOGGER, load_yaml
+from app.config import APP_PATH, LOGGER, Config, load_yaml
+from app.log.metrics import RATE_LIMITED
 from app.utils.app_exceptions import AppException
-from app.utils.service_result import ServiceResult
+from app.utils.service_result import ServiceResult, handle_result
 
 # config for access token
 TOKEN_PATH = os.path.join(APP_PATH, "conf", "access_tokens.yaml")
-TOKENS = load_yaml(TOKEN_PATH).get("default", "")
+
+
+class TokenRegistry:
+    """Access tokens of the token file: token -> name map (O(1) lookup).
+    The file is reloaded when its mtime changes, checked at most every check_interval seconds.
+    """
+    def __init__(self, path: str = TOKEN_PATH, check_interval: float = Config.TOKEN_RELOAD_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.names = {}
+        self.mtime = None
+        self.checked = 0.0
+        self.reload()
+
+    def reload(self):
+        """
+        Load the tokens if the file changed, keep the previous tokens if the file cannot be read.
+        """
+        self.checked = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            tokens = load_yaml(self.path).get("default", {}) or {}
+            self.names = {str(token): name for name, token in tokens.items()}
+            self.mtime = mtime
+            LOGGER.info("Loaded {} access tokens from {}".format(len(self.names), self.path))
+        except Exception as e:
+            LOGGER.error("Exception: {}".format(e))
+
+    def get_name(self, access_token: str):
+        """
+        Get the name of an access token.
+        Returns:
+            name (str): None if the token is not valid
+        """
+        if time.monotonic() - self.checked >= self.check_interval:
+            self.reload()
+        return self.names.get(access_token)
+
+
+class RateLimiter:
+    """Token bucket per access token: rate requests per second on average, bursts up to burst requests.
+    """
+    def __init__(self, rate: float = Config.RATE_LIMIT, burst: int = Config.RATE_LIMIT_BURST):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # access_token -> [available requests, last update]
+        self.buckets = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, access_token: str) -> float:
+        """
+        Take one request from the bucket of the access token.
+        Returns:
+            retry_after (float): 0 if allowed, else seconds until the next request is allowed
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic()
+        bucket = self.buckets.get(access_token)
+        if bucket is None:
+            bucket = self.buckets[access_token] = [float(self.burst), now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return 0.0
+        return (1.0 - bucket[0]) / self.rate
+
+
+TOKEN_REGISTRY = TokenRegistry()
+RATE_LIMITER = RateLimiter()
 
 
 def is_valid_token(access_token: str):
-    return True if access_token in TOKENS.values() else False
+    return TOKEN_REGISTRY.get_name(access_token) is not None
 
 def check_authentication(access_token: str) -> ServiceResult:
-    if not is_valid_token(access_token):
+    name = TOKEN_REGISTRY.get_name(access_token)
+    if name is None:
         return ServiceResult(AppException.AccessTokenNotFound({"access_token": access_token}))
-    LOGGER.info("Authentication: name={}".format([k for k, v in TOKENS.items() if v==access_token]))
+    LOGGER.info("Authentication: name={}".format(name))
     data = {"access_token": access_token}
-    return ServiceResult(data) 
+    return ServiceResult(data)
+
+def check_rate_limit(access_token: str) -> ServiceResult:
+    retry_after = RATE_LIMITER.acquire(access_token)
+    if retry_after > 0:
+        name = TOKEN_REGISTRY.get_name(access_token)
+        RATE_LIMITED.inc(name)
+        LOGGER.warning("Rate limit: name={} - retry_after={:.2f}s".format(name, retry_after))
+        return ServiceResult(AppException.TooManyRequests({"access_token": access_token, "retry_after": round(retry_after, 2)}))
+    data = {"access_token": access_token}
+    return ServiceResult(data)
+
+async def authenticate(access_token: str) -> str:
+    """
+    Dependency of the routes with an access token: check the token and its rate limit.
+    Raises:
+        AccessTokenNotFound (403), TooManyRequests (429)
+    """
+    handle_result(check_authentication(access_token))
+    handle_result(check_rate_limit(access_token))
+    return access_token
+
+async def authenticate_token(access_token: str) -> str:
+    """
+    Dependency of the routes not rate limited (metrics scrapes, cached static config): check the token only.
+    Raises:
+        AccessTokenNotFound (403)
+    """
+    handle_result(check_authentication(access_token))
+    return access_token
@@ -0,0 +1,295 @@
+import os
+import time
+import hashlib
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from ..config import Config, LOGGER, INDEX_VERSION_FILE, EMBEDDING_CACHE_DIR
+from ..log.timeit import LOGGER as TIMEIT_LOGGER
+
+
+def get_index_version(path=INDEX_VERSION_FILE):
+    """
+    Get version of the search index, the version file is touched by prepdocs.py after every indexing.
+    Returns:
+        version (float): mtime of the version file, 0 if not existed
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+class SemanticAnswerCache:
+    """LRU/TTL cache of assistant replies, looked up by cosine similarity of the user query embeddings.
+    """
+    def __init__(self, max_size=Config.ANSWER_CACHE_SIZE, ttl=Config.ANSWER_CACHE_TTL,
+                 threshold=Config.ANSWER_CACHE_THRESHOLD):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.index_version = get_index_version()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def check_index_version(self):
+        """
+        Clear all replies if the search index was rebuilt.
+        Returns:
+            index_version (float): current version of the search index
+        """
+        index_version = get_index_version()
+        if index_version != self.index_version:
+            LOGGER.info("Search index changed, clear {} cached answers.".format(len(self.entries)))
+            self.index_version = index_version
+            self.clear()
+        return index_version
+
+    def remove_expired(self):
+        now = time.monotonic()
+        for key, entry in list(self.entries.items()):
+            if now - entry["created_at"] > self.ttl:
+                self.entries.pop(key)
+
+    def get(self, language: str, embedding: list):
+        """
+        Get the reply of the most similar query in the same language.
+        Args:
+            language (str): language code
+            embedding (list): embedding of the user query
+        Returns:
+            entry (dict): query/reply/image_links/score, None if no query is above the threshold
+        """
+        self.check_index_version()
+        self.remove_expired()
+        vector = np.array(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+
+        best_key, best_score = None, self.threshold
+        for key, entry in self.entries.items():
+            if entry["language"] != language:
+                continue
+            score = float(np.dot(entry["vector"], vector))
+            if score >= best_score:
+                best_key, best_score = key, score
+
+        if best_key is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(best_key)
+        entry = self.entries[best_key]
+        LOGGER.info("Answer cache hit: query={} - score={:.4f}".format(entry["query"], best_score))
+        return {"query": entry["query"], "reply": entry["reply"], "image_links": list(entry["image_links"]), "score": best_score}
+
+    def put(self, language: str, query: str, embedding: list, reply: str, image_links: list, index_version: float):
+        """
+        Add reply of the query, evict the least recently used reply if the cache is full.
+        Args:
+            index_version (float): version of the search index when the reply was looked up (index_version after get),
+                the reply is dropped if the index was rebuilt since
+        """
+        if not self.enabled:
+            return
+        if self.check_index_version() != index_version:
+            LOGGER.info("Search index changed since the lookup, reply of query={} not cached.".format(query))
+            return
+        vector = np.array(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        key = (language, query)
+        self.entries[key] = {
+            "language": language,
+            "query": query,
+            "vector": vector,
+            "reply": reply,
+            "image_links": list(image_links),
+            "created_at": time.monotonic()
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+ANSWER_CACHE = SemanticAnswerCache()
+
+
+class EmbeddingStore:
+    """Append-only on-disk store of embeddings: float32 rows in a memory-mapped file plus a key index.
+    Files of a deployment (model): <path>/<model>/vectors.f32 and <path>/<model>/index.tsv ("key\\trow" lines).
+    """
+    def __init__(self, path: str, model: str):
+        self.path = os.path.join(path, model)
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.index_path = os.path.join(self.path, "index.tsv")
+        self.dim = 0
+        self.rows = {}
+        self.vectors = None
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                key, _, value = line.rstrip("\n").partition("\t")
+                if key == "dim":
+                    self.dim = int(value)
+                elif value:
+                    self.rows[key] = int(value)
+        LOGGER.info("Loaded {} embeddings from {}".format(len(self.rows), self.path))
+
+    def get_vectors(self, row: int):
+        # remap when the file has grown since the last mapping
+        if self.vectors is None or row >= self.vectors.shape[0]:
+            size = os.path.getsize(self.vectors_path) // (4 * self.dim)
+            if row >= size:
+                return None
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(size, self.dim))
+        return self.vectors
+
+    def get(self, key: str):
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        vectors = self.get_vectors(row)
+        return None if vectors is None else np.array(vectors[row])
+
+    def put(self, key: str, vector: np.ndarray):
+        if self.dim == 0:
+            self.dim = vector.shape[0]
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write("dim\t{}\n".format(self.dim))
+        if vector.shape[0] != self.dim:
+            return
+        # append-only writes, the row is derived from the file offset after the write
+        fd = os.open(self.vectors_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, vector.astype(np.float32).tobytes())
+            row = os.lseek(fd, 0, os.SEEK_CUR) // (4 * self.dim) - 1
+        finally:
+            os.close(fd)
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write("{}\t{}\n".format(key, row))
+        self.rows[key] = row
+
+
+class EmbeddingCache:
+    """LRU cache of embeddings by normalized text + deployment, optionally persisted in an EmbeddingStore.
+    Hit ratio and the time saved (average latency of the misses) are reported through the timeit logger.
+    """
+    def __init__(self, max_size=Config.EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_DIR if Config.EMBEDDING_CACHE_PERSIST else None,
+                 report_every=100):
+        self.max_size = max_size
+        self.path = path
+        self.report_every = report_every
+        self.entries = OrderedDict()
+        self.stores = {}
+        self.hits = 0
+        self.misses = 0
+        self.miss_time = 0.0
+        self.saved_time = 0.0
+
+    @staticmethod
+    def get_key(text: str, model: str) -> str:
+        text = unicodedata.normalize("NFC", " ".join(text.split())).lower()
+        return hashlib.sha1("{}\n{}".format(model, text).encode("utf-8")).hexdigest()
+
+    def get_store(self, model: str):
+        if self.path is None:
+            return None
+        if model not in self.stores:
+            try:
+                self.stores[model] = EmbeddingStore(self.path, model)
+            except Exception as e:
+                LOGGER.error("Exception: {}".format(e))
+                self.stores[model] = None
+        return self.stores[model]
+
+    def get(self, text: str, model: str):
+        """
+        Get embedding of the text.
+        Returns:
+            embedding (list): None if not cached
+        """
+        if self.max_size <= 0:
+            return None
+        key = self.get_key(text, model)
+        vector = self.entries.get(key)
+        if vector is None:
+            store = self.get_store(model)
+            vector = store.get(key) if store is not None else None
+            if vector is not None:
+                self.add(key, vector)
+        else:
+            self.entries.move_to_end(key)
+
+        if vector is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.saved_time += self.miss_time / self.misses if self.misses else 0.0
+        self.report()
+        return None if vector is None else vector.tolist()
+
+    def put(self, text: str, model: str, embedding: list, elapsed: float = 0.0):
+        """
+        Add embedding of the text.
+        Args:
+            elapsed (float): time of the embedding request (seconds)
+        """
+        if self.max_size <= 0:
+            return
+        self.miss_time += elapsed
+        key = self.get_key(text, model)
+        vector = np.array(embedding, dtype=np.float32)
+        self.add(key, vector)
+        store = self.get_store(model)
+        if store is not None:
+            try:
+                store.put(key, vector)
+            except Exception as e:
+                LOGGER.error("Exception: {}".format(e))
+
+    def add(self, key: str, vector: np.ndarray):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def report(self):
+        total = self.hits + self.misses
+        if total % self.report_every == 0:
+            TIMEIT_LOGGER.info("[embedding cache] {}".format(self.stats()))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "saved_ms": round(self.saved_time * 1000, 1)
+        }
+
+
+EMBEDDING_CACHE = EmbeddingCache()
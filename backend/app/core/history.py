@@ -0,0 +1,175 @@
+import asyncio
+from collections import OrderedDict
+
+from ..config import Config, LOGGER
+from ..db.models.role import Role
+from ..db.api import DB
+from .tokens import count_message_tokens
+from .agent import get_openai_client
+
+
+SUMMARY_PROMPT = """You summarize the earlier part of a conversation between a user and the AI guide of the restaurant Madame Lân.
+Keep the facts the user asked about and the answers (dishes, prices, opening hours, places, dates), the user's preferences and open questions.
+Merge the previous summary with the new turns. Write the summary in the language of the conversation, in at most {max_words} words."""
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+# max turns merged into the summary by one chat call
+SUMMARY_BATCH_SIZE = 20
+
+
+class HistoryWindow:
+    """History of the prompt within a token budget: latest turns from newest to oldest while their tokens fit the budget.
+    Token counts are cached in the turns (counted once when the turn is added).
+    Optionally the dropped turns are replaced by a rolling summary, cached per client in this worker and updated in the
+    background: the request that drops new turns uses the previous summary, the next requests use the updated one.
+    The summary covers every turn before its next turn number: the turns up to the first kept turn which are out of the
+    window (kept by a previous request, dropped while a summary was running) are loaded from the session.
+    """
+    def __init__(self, budget=Config.HISTORY_TOKEN_BUDGET, summary=Config.HISTORY_SUMMARY,
+                 summary_max_tokens=Config.HISTORY_SUMMARY_MAX_TOKENS, max_size=10000, load_turns=DB.get_turns_since):
+        """
+        Args:
+            load_turns: coroutine function (access_token, client_id, since) returning the turns of a client from turn since
+        """
+        self.budget = budget
+        self.summary = summary
+        self.summary_max_tokens = summary_max_tokens
+        self.max_size = max_size
+        self.load_turns = load_turns
+        # (access_token, client_id) -> (next turn of the summary: first turn not in it, summary, tokens of the summary message)
+        self.summaries = OrderedDict()
+        self.tasks = {}
+
+    @staticmethod
+    def get_tokens(turn) -> int:
+        if turn.tokens < 0:
+            turn.tokens = count_message_tokens(turn.user) + count_message_tokens(turn.assistant)
+        return turn.tokens
+
+    def select(self, turns: list, budget: int):
+        """
+        Select the latest turns within the budget.
+        Args:
+            turns (list): list of Turn, oldest first
+            budget (int): max prompt tokens of the turns, 0 for no limit
+        Returns:
+            (kept, dropped, tokens): kept/dropped turns (oldest first), prompt tokens of the kept turns
+        """
+        tokens = 0
+        start = len(turns)
+        for i in range(len(turns) - 1, -1, -1):
+            turn_tokens = self.get_tokens(turns[i])
+            if budget > 0 and tokens + turn_tokens > budget:
+                break
+            tokens += turn_tokens
+            start = i
+        return turns[start:], turns[:start], tokens
+
+    def build(self, access_token: str, client_id: str, turns: list):
+        """
+        Build the history messages of the prompt.
+        Args:
+            access_token (str): access token
+            client_id (str): client id
+            turns (list): latest conversations (list of Turn, oldest first)
+        Returns:
+            (messages, stats): history messages (role/content), stats of the window (turns/kept/tokens/summary_tokens)
+        """
+        key = (access_token, client_id)
+        cached = self.summaries.get(key) if self.summary else None
+        budget = self.budget
+        if cached is not None:
+            self.summaries.move_to_end(key)
+            # the summary takes its share of the budget, turns already in the summary are not repeated
+            budget = max(budget - cached[2], 1) if budget > 0 else 0
+            turns = [d for d in turns if d.turn >= cached[0]]
+        kept, dropped, tokens = self.select(turns, budget)
+
+        if self.summary and turns:
+            # every turn before the first kept turn goes into the summary, not only the turns dropped from this window
+            start = cached[0] if cached is not None else 0
+            end = kept[0].turn if kept else turns[-1].turn + 1
+            if start < end:
+                self.update_summary(key, cached, start, end, dropped)
+        messages = []
+        summary_tokens = 0
+        if cached is not None and cached[1]:
+            messages.append({"role": str(Role.SYSTEM), "content": SUMMARY_HEADER + cached[1]})
+            summary_tokens = cached[2]
+        for d in kept:
+            messages.append({"role": str(Role.USER), "content": d.user})
+            messages.append({"role": str(Role.ASSISTANT), "content": d.assistant})
+        stats = {"turns": len(turns), "kept": len(kept), "tokens": tokens, "summary_tokens": summary_tokens}
+        return messages, stats
+
+    def update_summary(self, key: tuple, cached: tuple, start: int, end: int, dropped: list):
+        """
+        Summarize the previous summary + the turns start..end-1 in the background, one task per client
+        (the turns left by a running task are summarized at the next request).
+        """
+        if key in self.tasks:
+            return
+        previous = cached[1] if cached is not None else ""
+        self.tasks[key] = asyncio.ensure_future(self.summarize(key, previous, start, end, dropped))
+        self.tasks[key].add_done_callback(lambda _: self.tasks.pop(key, None))
+
+    async def summarize(self, key: tuple, previous: str, start: int, end: int, turns: list):
+        """
+        Merge the turns start..end-1 into the previous summary, by batches of SUMMARY_BATCH_SIZE turns.
+        Args:
+            key (tuple): (access_token, client_id)
+            previous (str): previous summary (turns before start)
+            start (int): next turn of the previous summary
+            end (int): first kept turn
+            turns (list): turns of the window dropped by the request, the turns before them are loaded
+        """
+        if not turns or turns[0].turn > start:
+            try:
+                loaded = await self.load_turns(key[0], key[1], start)
+            except Exception as e:
+                LOGGER.error("Exception: {}".format(e))
+                return
+            turns = [d for d in loaded if d.turn < (turns[0].turn if turns else end)] + turns
+        if len(turns) < end - start:
+            LOGGER.warning("History of access_token={} - client_id={}: {} of the turns {}..{} not found, not in the summary".format(
+                key[0], key[1], end - start - len(turns), start, end - 1))
+        # all turns missing: the summary moves past them
+        text, mark = previous, start if turns else end
+        for i in range(0, len(turns), SUMMARY_BATCH_SIZE):
+            try:
+                text = await self.complete(text, turns[i:i + SUMMARY_BATCH_SIZE])
+            except Exception as e:
+                LOGGER.error("Exception: {}".format(e))
+                break
+            mark = turns[i + SUMMARY_BATCH_SIZE].turn if i + SUMMARY_BATCH_SIZE < len(turns) else end
+        if mark == start:
+            return
+        tokens = count_message_tokens(SUMMARY_HEADER + text) if text else 0
+        self.summaries[key] = (mark, text, tokens)
+        self.summaries.move_to_end(key)
+        while len(self.summaries) > self.max_size:
+            self.summaries.popitem(last=False)
+        LOGGER.info("Summarized history of access_token={} - client_id={}: turns {}..{} -> {} tokens".format(
+            key[0], key[1], start, mark - 1, tokens))
+
+    async def complete(self, previous: str, turns: list) -> str:
+        """
+        Returns:
+            summary (str): previous summary merged with the turns
+        """
+        lines = ["Previous summary:\n{}\n".format(previous)] if previous else []
+        lines.append("New turns:")
+        for d in turns:
+            lines.append("User: {}\nAssistant: {}".format(d.user, d.assistant))
+        response = await get_openai_client().chat.completions.create(
+            model=Config.AZURE_OPENAI_DEPLOYMENT_NAME,
+            messages=[
+                {"role": str(Role.SYSTEM), "content": SUMMARY_PROMPT.format(max_words=self.summary_max_tokens * 2 // 3)},
+                {"role": str(Role.USER), "content": "\n".join(lines)}
+            ],
+            max_tokens=self.summary_max_tokens,
+            temperature=0.0
+        )
+        return (response.choices[0].message.content or "").strip()
+
+
+HISTORY_WINDOW = HistoryWindow()
@@ -0,0 +1,64 @@
+import random
+import asyncio
+
+import aiohttp
+
+from ..config import Config, LOGGER
+
+
+HTTP_SESSION = None
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Get the shared HTTP session (connection pool), created in the running event loop at the first call.
+    Returns:
+        aiohttp.ClientSession
+    """
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=Config.HTTP_POOL_SIZE,
+                                         limit_per_host=Config.HTTP_POOL_SIZE_PER_HOST,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=Config.HTTP_TIMEOUT, sock_connect=Config.HTTP_CONNECT_TIMEOUT)
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        LOGGER.info("Created HTTP session: pool_size={} - pool_size_per_host={}".format(Config.HTTP_POOL_SIZE, Config.HTTP_POOL_SIZE_PER_HOST))
+    return HTTP_SESSION
+
+async def close_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+        LOGGER.info("Closed HTTP session.")
+    HTTP_SESSION = None
+
+async def get_json(url: str, headers: dict = None, params: dict = None, retries: int = Config.HTTP_RETRIES):
+    """
+    GET a JSON response with the shared session, retry on connection errors, timeouts and 429/5xx.
+    The delay before a retry is a random value up to HTTP_RETRY_BACKOFF * 2^attempt (full jitter).
+    Args:
+        url (str): url
+        headers (dict): request headers
+        params (dict): query params
+        retries (int): max retries
+    Returns:
+        data (dict): JSON response
+    """
+    attempt = 0
+    while True:
+        try:
+            async with get_http_session().get(url, headers=headers, params=params) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUS:
+                raise
+            if attempt >= retries:
+                raise
+            delay = random.uniform(0, Config.HTTP_RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+            # do not log the exception repr, it contains the request headers (subscription key)
+            reason = "status={}".format(e.status) if isinstance(e, aiohttp.ClientResponseError) else type(e).__name__
+            LOGGER.warning("GET {} failed: {}. Retrying {}/{} in {:.2f}s...".format(url, reason, attempt, retries, delay))
+            await asyncio.sleep(delay)
@@ -0,0 +1,248 @@
+import os
+import re
+import json
+import math
+import asyncio
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import QueryAnswerType, QueryCaptionType, QueryType, VectorizedQuery
+
+from ..config import Config, LOGGER, STORAGE_DIR
+from .http import get_http_session
+
+
+class RETRIEVER_TYPE:
+    AZURE = 'azure'
+    LOCAL = 'local'
+
+
+class Retriever(ABC):
+    """Interface of the local search backends.
+    search() returns the top documents as dict: summary/content_details/image_links/score/show_images.
+    """
+    @abstractmethod
+    async def search(self, search_text: str, vector: list, top: int) -> list:
+        """
+        Returns:
+            documents (list): top documents, best first
+        """
+
+    async def close(self):
+        pass
+
+
+class AzureRetriever(Retriever):
+    """Azure AI Search: hybrid (text + summaryVector) query with semantic ranking.
+    The async client is created in the running event loop, on the shared HTTP session.
+    """
+    # min reranker score to show the images of a document
+    RERANKER_SCORE_IMAGES = 2.3
+
+    def __init__(self, concurrency=Config.SEARCH_CONCURRENCY):
+        self.concurrency = concurrency
+        self.client = None
+        self.semaphore = None
+
+    def get_client(self) -> SearchClient:
+        if self.client is None:
+            self.client = SearchClient(
+                endpoint=Config.COGNITIVE_SEARCH_ENDPOINT,
+                index_name=Config.COGNITIVE_SEARCH_INDEX_NAME,
+                credential=AzureKeyCredential(Config.COGNITIVE_SEARCH_API_KEY),
+                transport=AioHttpTransport(session=get_http_session(), session_owner=False)
+            )
+        return self.client
+
+    def get_semaphore(self) -> asyncio.Semaphore:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.semaphore
+
+    async def search(self, search_text: str, vector: list, top: int) -> list:
+        documents = []
+        async with self.get_semaphore():
+            results = await self.get_client().search(
+                search_text=search_text,
+                vector_queries=[VectorizedQuery(vector=vector, k_nearest_neighbors=top, fields="summaryVector")],
+                query_type=QueryType.SEMANTIC, semantic_configuration_name='my-semantic-config',
+                query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
+                select=["summary", "content_details", "image_links"],
+                top=top
+            )
+            async for result in results:
+                score = float(result.get('@search.reranker_score') or 0.0)
+                documents.append({
+                    "summary": result['summary'],
+                    "content_details": result['content_details'],
+                    "image_links": result['image_links'],
+                    "score": score,
+                    "show_images": score >= self.RERANKER_SCORE_IMAGES
+                })
+        return documents
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+
+def tokenize(text: str) -> list:
+    return re.findall(r'\w+', unicodedata.normalize("NFC", text).lower())
+
+
+class LocalRetriever(Retriever):
+    """In-process retrieval over a local bundle of the search index.
+    Brute-force cosine top-k on a contiguous float32 matrix of summaryVector + BM25 on summary/content_details/keyword_entities,
+    fused with reciprocal-rank fusion.
+    Bundle files: documents.jsonl (one document per line), vectors.npy (row i is the vector of line i) and manifest.json,
+    written by script/indexing/export_index.py to <path>/<version>, <path>/LATEST is the current version.
+    The vectors are memory-mapped (read only), so workers of the same node share them through the page cache.
+    """
+    TEXT_FIELDS = ["summary", "content_details", "keyword_entities"]
+
+    def __init__(self, path: str, rrf_k: int = Config.RRF_K, image_threshold: float = Config.LOCAL_IMAGE_THRESHOLD,
+                 bm25_k1: float = 1.2, bm25_b: float = 0.75):
+        self.path = path
+        self.rrf_k = rrf_k
+        self.image_threshold = image_threshold
+        self.bm25_k1 = bm25_k1
+        self.bm25_b = bm25_b
+        self.documents = []
+        self.vectors = None
+        self.norms = None
+        self.postings = {}
+        self.load()
+
+    @staticmethod
+    def resolve_bundle(path: str) -> str:
+        """
+        Get folder of the latest bundle version if path has a LATEST file.
+        """
+        latest_path = os.path.join(path, "LATEST")
+        if os.path.isfile(latest_path):
+            with open(latest_path, 'r', encoding='utf-8') as f:
+                return os.path.join(path, f.read().strip())
+        return path
+
+    def load(self):
+        self.path = self.resolve_bundle(self.path)
+        manifest_path = os.path.join(self.path, "manifest.json")
+        manifest = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            # cheap check of the files, the hashes are verified by export_index.py --verify
+            for name, info in manifest.get("files", {}).items():
+                if os.path.getsize(os.path.join(self.path, name)) != info["size"]:
+                    raise ValueError("Bundle {} file {} does not match the manifest".format(self.path, name))
+        with open(os.path.join(self.path, "documents.jsonl"), 'r', encoding='utf-8') as f:
+            self.documents = [json.loads(line) for line in f if line.strip()]
+        self.vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode='r')
+        if self.vectors.shape[0] != len(self.documents):
+            raise ValueError("Bundle {} has {} documents but {} vectors".format(self.path, len(self.documents), self.vectors.shape[0]))
+        norms = np.linalg.norm(self.vectors, axis=1)
+        norms[norms == 0] = 1.0
+        self.norms = norms.astype(np.float32)
+        self.build_text_index()
+        LOGGER.info("Loaded local bundle {}: version={} - documents={} - dim={}".format(
+            self.path, manifest.get("version", ""), len(self.documents), self.vectors.shape[1] if self.vectors.ndim == 2 else 0))
+
+    def build_text_index(self):
+        """
+        Build the inverted index: term -> (doc_ids, idf, BM25 term weights of the documents).
+        """
+        doc_terms = []
+        doc_lengths = []
+        for document in self.documents:
+            terms = defaultdict(int)
+            for field in self.TEXT_FIELDS:
+                value = document.get(field) or ""
+                value = " ".join(value) if isinstance(value, list) else value
+                for term in tokenize(value):
+                    terms[term] += 1
+            doc_terms.append(terms)
+            doc_lengths.append(sum(terms.values()))
+        n = len(self.documents)
+        avg_length = (sum(doc_lengths) / n) if n else 0.0
+
+        postings = defaultdict(lambda: ([], []))
+        for doc_id, terms in enumerate(doc_terms):
+            norm = self.bm25_k1 * (1 - self.bm25_b + self.bm25_b * doc_lengths[doc_id] / (avg_length or 1.0))
+            for term, tf in terms.items():
+                doc_ids, weights = postings[term]
+                doc_ids.append(doc_id)
+                weights.append(tf * (self.bm25_k1 + 1) / (tf + norm))
+        self.postings = {
+            term: (np.asarray(doc_ids, dtype=np.int32),
+                   math.log(1 + (n - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5)),
+                   np.asarray(weights, dtype=np.float32))
+            for term, (doc_ids, weights) in postings.items()
+        }
+
+    def vector_search(self, vector: list, top: int):
+        """
+        Returns:
+            (doc_ids, scores): top documents by cosine similarity
+        """
+        query = np.array(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = (self.vectors @ query) / self.norms
+        top = min(top, len(scores))
+        if top <= 0:
+            return [], []
+        doc_ids = np.argpartition(-scores, top - 1)[:top]
+        doc_ids = doc_ids[np.argsort(-scores[doc_ids])]
+        return doc_ids.tolist(), scores[doc_ids].tolist()
+
+    def text_search(self, search_text: str, top: int):
+        """
+        Returns:
+            doc_ids (list): top documents by BM25
+        """
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for term in set(tokenize(search_text)):
+            if term in self.postings:
+                doc_ids, idf, weights = self.postings[term]
+                scores[doc_ids] += idf * weights
+        matched = np.count_nonzero(scores)
+        top = min(top, matched)
+        if top <= 0:
+            return []
+        doc_ids = np.argpartition(-scores, top - 1)[:top]
+        return doc_ids[np.argsort(-scores[doc_ids])].tolist()
+
+    async def search(self, search_text: str, vector: list, top: int) -> list:
+        # wider candidate lists for the fusion
+        candidates = max(top * 5, 50)
+        vector_ids, vector_scores = self.vector_search(vector, candidates)
+        text_ids = self.text_search(search_text, candidates)
+
+        fused = defaultdict(float)
+        for ranking in (vector_ids, text_ids):
+            for rank, doc_id in enumerate(ranking):
+                fused[doc_id] += 1.0 / (self.rrf_k + rank + 1)
+        similarity = dict(zip(vector_ids, vector_scores))
+
+        documents = []
+        for doc_id in sorted(fused, key=fused.get, reverse=True)[:top]:
+            document = self.documents[doc_id]
+            documents.append({
+                "summary": document.get("summary", ""),
+                "content_details": document.get("content_details", ""),
+                "image_links": document.get("image_links") or [],
+                "score": fused[doc_id],
+                "show_images": similarity.get(doc_id, 0.0) >= self.image_threshold
+            })
+        return documents
+
+
+def create_retriever(retriever_type=Config.RETRIEVER) -> Retriever:
+    if retriever_type == RETRIEVER_TYPE.LOCAL:
+        return LocalRetriever(os.path.join(STORAGE_DIR, Config.LOCAL_BUNDLE))
+    return AzureRetriever()
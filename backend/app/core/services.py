@@ -0,0 +1,174 @@
+import time
+import asyncio
+import threading
+
+from ..config import LOGGER, CONFIG_SECONDS
+
+
+class SERVICE_STATE:
+    PENDING = 'pending'
+    STARTING = 'starting'
+    READY = 'ready'
+    FAILED = 'failed'
+
+
+class Service:
+    """Client of an external service (or a component of the app), built by its factory at the first use
+    or at startup.
+    """
+    def __init__(self, name: str, factory, close=None, required: bool = True):
+        self.name = name
+        self.factory = factory
+        self.close = close
+        self.required = required
+        self.is_async = asyncio.iscoroutinefunction(factory)
+        self.value = None
+        self.state = SERVICE_STATE.PENDING
+        self.seconds = 0.0
+        self.error = ""
+        self.failed_at = 0.0
+        self.lock = threading.Lock()
+        self.task = None
+
+    def report(self) -> dict:
+        data = {"state": self.state, "ms": round(self.seconds * 1000, 1), "required": self.required}
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+class ServiceRegistry:
+    """Clients of the external services (Azure OpenAI, speech, search, tables...), registered by their modules at import
+    without connecting. The app can be imported without credentials: the clients are built concurrently at startup
+    (lifespan) or lazily at the first use, the build time of each client is reported for the readiness probe.
+    """
+    def __init__(self, retry_interval: float = 10.0):
+        self.services = {}
+        self.retry_interval = retry_interval
+        self.startup_seconds = 0.0
+
+    def register(self, name: str, factory, close=None, required: bool = True):
+        """
+        Register a service.
+        Args:
+            name (str): name of the service
+            factory: function (or coroutine function) building the client
+            close: function (or coroutine function) closing the client (argument), called at shutdown
+            required (bool): the app is not ready without the service
+        """
+        self.services[name] = Service(name, factory, close, required)
+
+    def build(self, service: Service):
+        """
+        Build the client of a service with a sync factory (once, thread safe).
+        """
+        with service.lock:
+            if service.state == SERVICE_STATE.READY:
+                return service.value
+            service.state = SERVICE_STATE.STARTING
+            start = time.perf_counter()
+            try:
+                service.value = service.factory()
+            except Exception as e:
+                self.fail(service, e)
+                raise
+            finally:
+                service.seconds = time.perf_counter() - start
+            service.state = SERVICE_STATE.READY
+            service.error = ""
+            return service.value
+
+    def fail(self, service: Service, e: Exception):
+        service.state = SERVICE_STATE.FAILED
+        service.error = "{}: {}".format(type(e).__name__, e)
+        service.failed_at = time.monotonic()
+        LOGGER.error("Exception: {}".format(service.error))
+
+    def get(self, name: str):
+        """
+        Get the client of a service, built at the first call (sync factories).
+        """
+        service = self.services[name]
+        if service.state == SERVICE_STATE.READY:
+            return service.value
+        if service.is_async:
+            raise RuntimeError("Service {} is not ready: {}".format(name, service.state))
+        return self.build(service)
+
+    async def start_service(self, service: Service):
+        if service.state == SERVICE_STATE.READY:
+            return
+        if not service.is_async:
+            # in a thread, the factories load libraries/files
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.build, service)
+            except Exception:
+                pass
+            return
+        if service.task is None or service.task.done():
+            service.task = asyncio.ensure_future(self.start_async(service))
+        await asyncio.shield(service.task)
+
+    async def start_async(self, service: Service):
+        service.state = SERVICE_STATE.STARTING
+        start = time.perf_counter()
+        try:
+            service.value = await service.factory()
+            service.state = SERVICE_STATE.READY
+            service.error = ""
+        except Exception as e:
+            self.fail(service, e)
+        finally:
+            service.seconds = time.perf_counter() - start
+
+    async def start(self):
+        """
+        Build the clients of all services concurrently, log the build times.
+        """
+        start = time.perf_counter()
+        await asyncio.gather(*[self.start_service(service) for service in self.services.values()])
+        self.startup_seconds = time.perf_counter() - start
+        LOGGER.info("Startup in {:.3f}s: config={:.1f}ms - {}".format(self.startup_seconds, CONFIG_SECONDS * 1000, " - ".join(
+            "{}={}ms ({})".format(service.name, service.report()["ms"], service.state) for service in self.services.values())))
+
+    def is_ready(self) -> bool:
+        return all(service.state == SERVICE_STATE.READY for service in self.services.values() if service.required)
+
+    def retry_failed(self):
+        """
+        Start again the failed services (in the background), at most every retry_interval.
+        """
+        now = time.monotonic()
+        for service in self.services.values():
+            if service.state == SERVICE_STATE.FAILED and now - service.failed_at >= self.retry_interval:
+                service.failed_at = now
+                asyncio.ensure_future(self.start_service(service))
+
+    def report(self) -> dict:
+        return {
+            "ready": self.is_ready(),
+            "startup_ms": round(self.startup_seconds * 1000, 1),
+            "config_ms": round(CONFIG_SECONDS * 1000, 1),
+            "services": {name: service.report() for name, service in self.services.items()}
+        }
+
+    async def close(self):
+        """
+        Close the clients in the reverse order of registration.
+        """
+        for service in reversed(list(self.services.values())):
+            if service.task is not None and not service.task.done():
+                service.task.cancel()
+            if service.state != SERVICE_STATE.READY or service.close is None:
+                continue
+            try:
+                result = service.close(service.value)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                LOGGER.error("Exception: {}".format(e))
+            service.state = SERVICE_STATE.PENDING
+            service.value = None
+
+
+SERVICES = ServiceRegistry()
@@ -1,32 +1,143 @@
 import os
 import uuid
 import re
+import time
+import hashlib
 import asyncio
+import unicodedata
 
 import emoji
-from azure.cognitiveservices.speech import SpeechConfig, SpeechSynthesizer, AudioConfig
+from azure.cognitiveservices.speech import SpeechConfig, SpeechSynthesizer, AudioConfig, ResultReason
 
 from ..config import AUDIO_TMP_DIR, Config, LOGGER, async_timeit
+from ..log.metrics import TTS_CHARACTERS
+from ..log.trace import span
+from .services import SERVICES
 
 
-SPEECH_CONFIG = SpeechConfig(subscription=Config.SPEECH_KEY, region=Config.SPEECH_REGION)
-SPEECH_CONFIG.speech_synthesis_voice_name = Config.TTS_VOICE
+def create_speech_config(voice_name: str = Config.TTS_VOICE) -> SpeechConfig:
+    speech_config = SpeechConfig(subscription=Config.SPEECH_KEY, region=Config.SPEECH_REGION)
+    speech_config.speech_synthesis_voice_name = voice_name
+    return speech_config
 
+SERVICES.register("speech", create_speech_config)
 
-@async_timeit()
-async def generate_speech_audio(text: str, voice: str) -> str:
+# sentence boundary: latin punctuation followed by spaces, CJK punctuation or new lines
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.!?;:])\s+|(?<=[。！？；])|\n+')
+# shorter sentences (list numbers, headings, etc.) are merged with the next one
+SENTENCE_MIN_LENGTH = 20
+
+
+# audio cache: files are named by hash of voice name + normalized text, mtime is the last use
+AUDIO_CACHE_STATS = {"hits": 0, "misses": 0}
+AUDIO_IN_PROGRESS = {}
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", " ".join(text.split()))
+
+def get_audio_key(voice_name: str, text: str) -> str:
+    return hashlib.sha256("{}\n{}".format(voice_name, text).encode("utf-8")).hexdigest()
+
+def synthesize_to_file(text: str, voice_name: str, audio_path: str):
+    """
+    Synthesize text to a temporary file, then move it to audio_path if the synthesis is completed.
+    Runs in executor threads: the voice is set on a config of this call, the registered config is shared.
+    """
+    tmp_path = "{}.{}.part".format(audio_path, uuid.uuid4())
     try:
-        audio_filename = f"{uuid.uuid4()}.wav"
-        audio_path = os.path.join(AUDIO_TMP_DIR, audio_filename)
-        audio_output = AudioConfig(filename=audio_path)
-        voice_name = Config.LANGUAGES[voice]['voice_name']
-        SPEECH_CONFIG.speech_synthesis_voice_name = voice_name
-        synthesizer = SpeechSynthesizer(speech_config=SPEECH_CONFIG, audio_config=audio_output)
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, lambda: synthesizer.speak_text_async(text).get())
-    except Exception as e:
-        LOGGER.error("Exception: {}".format(e))
-    return f"{audio_path}"
+        # checks the credentials once (readiness), never mutated
+        SERVICES.get("speech")
+        audio_output = AudioConfig(filename=tmp_path)
+        speech_config = create_speech_config(voice_name)
+        synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=audio_output)
+        result = synthesizer.speak_text_async(text).get()
+        # release the output file before moving it
+        del synthesizer
+        if result.reason != ResultReason.SynthesizingAudioCompleted:
+            raise RuntimeError("Speech synthesis failed: {}".format(result.reason))
+        os.replace(tmp_path, audio_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+@async_timeit()
+async def generate_speech_audio(text: str, voice: str):
+    """
+    Synthesize text with the voice of a language, cached by voice name and normalized text.
+    Returns:
+        audio_path (str): None if the synthesis failed
+    """
+    audio_path = None
+    with span("tts", voice=voice, characters=len(text)) as s:
+        try:
+            voice_name = Config.LANGUAGES[voice]['voice_name']
+            text = normalize_text(text)
+            audio_key = get_audio_key(voice_name, text)
+            audio_path = os.path.join(AUDIO_TMP_DIR, f"{audio_key}.wav")
+            if os.path.isfile(audio_path):
+                AUDIO_CACHE_STATS["hits"] += 1
+                s.set("cache_hit", True)
+                os.utime(audio_path)
+                return audio_path
+
+            # the same audio is synthesizing by another request
+            if audio_key in AUDIO_IN_PROGRESS:
+                AUDIO_CACHE_STATS["hits"] += 1
+                s.set("cache_hit", True).set("in_progress", True)
+                await asyncio.shield(AUDIO_IN_PROGRESS[audio_key])
+                return audio_path if os.path.isfile(audio_path) else None
+
+            AUDIO_CACHE_STATS["misses"] += 1
+            s.set("cache_hit", False)
+            TTS_CHARACTERS.inc(voice_name, value=len(text))
+            loop = asyncio.get_running_loop()
+            task = loop.run_in_executor(None, synthesize_to_file, text, voice_name, audio_path)
+            AUDIO_IN_PROGRESS[audio_key] = task
+            try:
+                await asyncio.shield(task)
+            finally:
+                AUDIO_IN_PROGRESS.pop(audio_key, None)
+        except Exception as e:
+            LOGGER.error("Exception: {}".format(e))
+            s.error(e)
+            # the file was not written, never return its path
+            return None
+    return audio_path
+
+def cleanup_audio_cache(max_size=Config.AUDIO_CACHE_MAX_SIZE, max_age=Config.AUDIO_CACHE_MAX_AGE):
+    """
+    Remove audio files unused for max_age, then the least recently used ones until the cache fits max_size.
+    Args:
+        max_size (int): max size of the audio cache (MB)
+        max_age (int): max time since last use (seconds)
+    Returns:
+        removed (int): number of removed files
+    """
+    now = time.time()
+    files = []
+    removed = 0
+    for entry in os.scandir(AUDIO_TMP_DIR):
+        if not entry.is_file() or not (entry.name.endswith('.wav') or entry.name.endswith('.part')):
+            continue
+        stat = entry.stat()
+        if now - stat.st_mtime > max_age:
+            os.remove(entry.path)
+            removed += 1
+        elif entry.name.endswith('.wav'):
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in files)
+    max_bytes = max_size * 1024 * 1024
+    for _, size, path in sorted(files):
+        if total_size <= max_bytes:
+            break
+        os.remove(path)
+        total_size -= size
+        removed += 1
+    LOGGER.info("Audio cache: size={:.1f}MB - removed={} - hits={} - misses={}".format(
+        total_size / 1024 / 1024, removed, AUDIO_CACHE_STATS["hits"], AUDIO_CACHE_STATS["misses"]))
+    return removed
 
 def remove_emoji(text):
     return emoji.replace_emoji(text, replace='')
@@ -39,3 +150,86 @@ def replace_markdown_links_with_urls(text):
         url = match[1]
         text = text.replace(f'[{full_link}]({url})', url)
     return text
+
+def split_sentences(text):
+    """
+    Split text by sentence boundaries.
+    Args:
+        text (str): text
+    Returns:
+        sentences (list): the last item is the unfinished rest of the text (may be empty)
+    """
+    return SENTENCE_END_PATTERN.split(text)
+
+
+class SpeechPipeline:
+    """Synthesize a streamed reply sentence by sentence, while it is still generated.
+    """
+    def __init__(self, voice: str, min_length: int = SENTENCE_MIN_LENGTH):
+        self.voice = voice
+        self.min_length = min_length
+        self.buffer = ""
+        self.pending = ""
+        self.tasks = []
+        self.next_index = 0
+
+    def feed(self, text: str):
+        """
+        Add new reply text, start synthesis of every completed sentence.
+        Args:
+            text (str): new content of the reply
+        """
+        self.buffer += text
+        sentences = split_sentences(self.buffer)
+        self.buffer = sentences.pop()
+        for sentence in sentences:
+            self.pending = "{} {}".format(self.pending, sentence) if self.pending else sentence
+            if len(self.pending) >= self.min_length:
+                self.synthesize(self.pending)
+                self.pending = ""
+
+    def synthesize(self, sentence: str):
+        plain_text = remove_emoji(replace_markdown_links_with_urls(sentence)).strip()
+        if plain_text:
+            self.tasks.append(asyncio.create_task(generate_speech_audio(plain_text, self.voice)))
+
+    def reset(self):
+        """
+        Discard the streamed text and cancel running synthesis.
+        """
+        for task in self.tasks[self.next_index:]:
+            task.cancel()
+        self.buffer = ""
+        self.pending = ""
+        self.tasks = []
+        self.next_index = 0
+
+    def ready(self):
+        """
+        Get audio paths already synthesized, in sentence order (the failed sentences are skipped).
+        Returns:
+            audio_paths (list)
+        """
+        audio_paths = []
+        while self.next_index < len(self.tasks) and self.tasks[self.next_index].done():
+            audio_path = self.tasks[self.next_index].result()
+            self.next_index += 1
+            if audio_path:
+                audio_paths.append(audio_path)
+        return audio_paths
+
+    async def finish(self):
+        """
+        Synthesize the rest of the reply and wait for all audio.
+        Yields:
+            audio_path (str): audio paths not returned yet, in sentence order
+        """
+        rest = "{} {}".format(self.pending, self.buffer) if self.pending else self.buffer
+        self.buffer = ""
+        self.pending = ""
+        self.synthesize(rest)
+        while self.next_index < len(self.tasks):
+            audio_path = await self.tasks[self.next_index]
+            self.next_index += 1
+            if audio_path:
+                yield audio_path
@@ -0,0 +1,68 @@
+import functools
+
+from ..config import Config, LOGGER
+from .services import SERVICES
+
+
+# tokens added by the chat format to every message (role and separators)
+MESSAGE_TOKENS = 3
+
+ENCODING = None
+ENCODING_FAILED = False
+
+
+def get_encoding():
+    """
+    Get the tiktoken encoding of the chat model, loaded at the first call.
+    Returns:
+        tiktoken.Encoding: None if tiktoken or its encoding file is not available
+    """
+    global ENCODING, ENCODING_FAILED
+    if ENCODING is None and not ENCODING_FAILED:
+        try:
+            import tiktoken
+            ENCODING = tiktoken.get_encoding(Config.TOKENIZER_ENCODING)
+        except Exception as e:
+            # warned once, the history budget is then estimated for the life of the process
+            ENCODING_FAILED = True
+            LOGGER.warning("Tokenizer {} not available, tokens are estimated by characters (len/3): {}: {}. "
+                           "Install tiktoken and set env TIKTOKEN_CACHE_DIR to a folder with the encoding file on offline servers.".format(
+                               Config.TOKENIZER_ENCODING, type(e).__name__, e))
+    return ENCODING
+
+def load_encoding():
+    """
+    Load the encoding at startup (the encoding file may be downloaded), reported by the readiness probe.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        raise RuntimeError("Tokenizer {} not available, tokens are estimated by characters".format(Config.TOKENIZER_ENCODING))
+    return encoding
+
+SERVICES.register("tokenizer", load_encoding, required=False)
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens of the text with the tokenizer of the chat model.
+    Args:
+        text (str): text
+    Returns:
+        tokens (int): number of tokens, estimated by characters if the tokenizer is not available
+    """
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        # rough upper estimate for Vietnamese/English texts
+        return len(text) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(text: str) -> int:
+    return count_tokens(text) + MESSAGE_TOKENS
+
+@functools.lru_cache(maxsize=64)
+def count_prompt_tokens(text: str) -> int:
+    """
+    Count tokens of a system prompt message, cached (the prompt only changes with the date/language).
+    """
+    return count_message_tokens(text)
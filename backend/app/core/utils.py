@@ -4,6 +4,9 @@ import platform
 import yaml
 from easydict import EasyDict as edict
 
+# libyaml parser if available (several times faster)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 def load_yaml(config_path: str):
     """parse YAML config to EasyDict format
 
@@ -15,7 +18,7 @@ def load_yaml(config_path: str):
     """
     try:
         with open(config_path, 'r', encoding="utf-8") as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YAML_LOADER)
         return edict(config)
 
     except Exception as err:
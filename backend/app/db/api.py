@@ -1,29 +1,131 @@
+import time
 import uuid
+import random
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
 
 from fastapi import HTTPException
-from azure.data.tables import TableServiceClient
+from azure.data.tables.aio import TableServiceClient
 
 from app.config import LOGGER, Config
 from app.db.models.status import Status
 from app.db.models.role import Role
-from app.utils.utils import get_datetime_now, time2str
+from app.db.models.turn import Turn
+from app.db.store import create_session_store, encode, decode
+from app.db.prompts import PROMPTS
+from app.core.tokens import count_message_tokens
+from app.utils.utils import get_datetime_now, time2str, str2time
 from app.utils.utils import uuid2str
 
 
-global CURRENT_DATA, INACTIVE_DATA
-CURRENT_DATA = {}
-INACTIVE_DATA = {}
+global INACTIVE_DATA
+# active sessions, shared by the workers with the sqlite/redis session stores
+STORE = create_session_store()
+# sessions expired/evicted by this worker, waiting to be saved to DB: (access_token, client_id) -> client, oldest first
+INACTIVE_DATA = OrderedDict()
+# clients dropped from INACTIVE_DATA over inactive_max_count (not saved)
+INACTIVE_DROPPED = 0
+# rehydration of sessions from DB: running loads by (access_token, client_id), clients not found in DB (expiry time)
+LOADING = {}
+NOT_FOUND = OrderedDict()
+NOT_FOUND_MAX_SIZE = 10000
 EMP_STR = ""
 MAX_LEN = Config.HISTORY_LENGTH + 1
+# max operations of an Azure Table batch transaction
+TRANSACTION_SIZE = 100
+# clients snapshotted between two yields to the event loop
+SNAPSHOT_CHUNK_SIZE = 50
+# max length of the last conversations kept in the client entity (string properties of Azure Table are up to 32K characters)
+RECENT_MAX_CHARS = 30000
 
-TableService = TableServiceClient.from_connection_string(conn_str=Config.DB_CONECTION)
-TableService.create_table_if_not_exists(Config.DB_TABLE_CLIENT)
-DB_CLIENT = TableService.get_table_client(table_name=Config.DB_TABLE_CLIENT)
+# async table clients, created in the running event loop by open_tables()
+TableService = None
+DB_CLIENT = None
+DB_CONV = None
+DB_PROMPT = None
+# PartitionKey of the prompt entities
+PROMPT_PARTITION = "prompt"
 
-TableService.create_table_if_not_exists(Config.DB_TABLE_CONVERSATION)
-DB_CONV = TableService.get_table_client(table_name=Config.DB_TABLE_CONVERSATION)
+# guards INACTIVE_DATA between update_status and the persistence worker
+DATA_LOCK = threading.RLock()
+# flush of the persistence worker before its interval (set by the worker), sessions evicted since the last flush
+FLUSH_TRIGGER = None
+SPILLED = 0
 
 
+def synchronized(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with DATA_LOCK:
+            return func(*args, **kwargs)
+    return wrapper
+
+async def open_tables():
+    """
+    Create the async table clients (and the tables if not existed).
+    The clients are set only when all the tables are opened: after a failure, the next call (retry of the service) opens them again.
+    """
+    global TableService, DB_CLIENT, DB_CONV, DB_PROMPT
+    if DB_CLIENT is not None:
+        return
+    service = TableServiceClient.from_connection_string(conn_str=Config.DB_CONECTION)
+    try:
+        clients = []
+        for table_name in (Config.DB_TABLE_CLIENT, Config.DB_TABLE_CONVERSATION, Config.DB_TABLE_PROMPT):
+            await service.create_table_if_not_exists(table_name)
+            clients.append(service.get_table_client(table_name=table_name))
+    except Exception:
+        await service.close()
+        raise
+    TableService = service
+    DB_CLIENT, DB_CONV, DB_PROMPT = clients
+    LOGGER.info("Opened tables {} - {} - {}".format(Config.DB_TABLE_CLIENT, Config.DB_TABLE_CONVERSATION, Config.DB_TABLE_PROMPT))
+
+def set_flush_trigger(func):
+    global FLUSH_TRIGGER
+    FLUSH_TRIGGER = func
+
+async def close_tables():
+    global TableService, DB_CLIENT, DB_CONV, DB_PROMPT
+    for client in (DB_CLIENT, DB_CONV, DB_PROMPT, TableService):
+        if client is not None:
+            await client.close()
+    TableService, DB_CLIENT, DB_CONV, DB_PROMPT = None, None, None, None
+
+
+class FlushQueue:
+    """Deduplicated FIFO of clients (access_token, client_id) changed since their last save (write-behind).
+    """
+    def __init__(self):
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, access_token: str, client_id: str):
+        with self.lock:
+            self.items[(access_token, client_id)] = None
+
+    def get_batch(self, size: int):
+        """
+        Pop the oldest changed clients.
+        Args:
+            size (int): max clients
+        Returns:
+            batch (list): list of (access_token, client_id)
+        """
+        with self.lock:
+            batch = []
+            while self.items and len(batch) < size:
+                batch.append(self.items.popitem(last=False)[0])
+            return batch
+
+    def __len__(self):
+        return len(self.items)
+
+
+FLUSH_QUEUE = FlushQueue()
+
 
 class DB:
     """This is class to init prompt for client, add conversation by role, get latest conversations, etc.
@@ -31,39 +133,39 @@ class DB:
     @staticmethod
     def create_new_client_id(access_token):
         """
-        Create new client id that not in GLOBAL_DB.
+        Create new client id, init_client checks that it is not in the session store (atomic create).
         Args:
         Returns:
             client_id (str): client id
         """
-        client_id = uuid2str(uuid.uuid4())
-        while DB.check_client_id_existed(access_token, client_id):
-            client_id = uuid2str(uuid.uuid4())
-        return client_id
+        return uuid2str(uuid.uuid4())
 
     @staticmethod
-    def init_client(access_token: str, client_id: str):
+    async def init_client(access_token: str, client_id: str):
         """
-        Init client with status/language/init_prompt/conversations.
+        Init client with status/language/prompt_id in the session store (conversations are kept by the store).
         Args:
             access_token (str): access token
             client_id (str): client id
         Returns:
-            dict
+            True/False: False if the client is existed
         """
-        global CURRENT_DATA
         client = {}
         client["status"] = str(Status.ACTIVE)
         client["language"] = EMP_STR
-        client["init_prompt"] = EMP_STR
-        client["conversations"] = []
+        client["prompt_id"] = EMP_STR
+        # number of conversations added / saved to DB (high-water mark)
+        client["turns"] = 0
+        client["saved_turns"] = 0
         client["created_at"] = get_datetime_now()
         client["updated_at"] = get_datetime_now()
-        CURRENT_DATA[access_token] = CURRENT_DATA[access_token] if access_token in CURRENT_DATA else {}
-        CURRENT_DATA[access_token][client_id] = client
+        created = await STORE.create(access_token, client_id, client)
+        if created:
+            FLUSH_QUEUE.put(access_token, client_id)
+        return created
 
     @staticmethod
-    def create(access_token: str):
+    async def create(access_token: str):
         """
         Create new client obj in GLOBAL_DB.
         Args:
@@ -72,11 +174,12 @@ class DB:
             True/False
         """
         client_id = DB.create_new_client_id(access_token)
-        DB.init_client(access_token, client_id)
+        while not await DB.init_client(access_token, client_id):
+            client_id = DB.create_new_client_id(access_token)
         return client_id
 
     @staticmethod
-    def update(access_token: str, client_id: str):
+    async def update(access_token: str, client_id: str):
         """
         Create new client obj in GLOBAL_DB.
         Args:
@@ -85,15 +188,14 @@ class DB:
         Returns:
             True/False
         """
-        global CURRENT_DATA
-        if not DB.check_client_id_existed(access_token, client_id):
+        if not await STORE.update(access_token, client_id, {"status": str(Status.INACTIVE)}):
             LOGGER.error("access_token={} - client_id={} not found!")
             raise HTTPException(status_code=400, detail="access_token={} - client_id={} not found!".format(access_token, client_id))
-        CURRENT_DATA[access_token][client_id]["status"] = str(Status.INACTIVE)
+        FLUSH_QUEUE.put(access_token, client_id)
         return client_id
 
     @staticmethod
-    def check_client_id_existed(access_token: str, client_id: str):
+    async def check_client_id_existed(access_token: str, client_id: str):
         """
         Check if the client is existed or not.
         Args:
@@ -102,11 +204,10 @@ class DB:
         Returns:
             True/False
         """
-        global CURRENT_DATA
-        return True if access_token in CURRENT_DATA and client_id in CURRENT_DATA[access_token] else False
+        return await STORE.get(access_token, client_id) is not None
 
     @staticmethod
-    def check_client_id_active(access_token: str, client_id: str):
+    async def check_client_id_active(access_token: str, client_id: str):
         """
         Check if the client is existed or not.
         Args:
@@ -115,42 +216,192 @@ class DB:
         Returns:
             True/False
         """
-        global CURRENT_DATA
-        client = CURRENT_DATA[access_token][client_id]
+        client = await STORE.get(access_token, client_id)
         return True if client['status'] == str(Status.ACTIVE) else False
 
     @staticmethod
-    def get_latest_conversations(access_token: str, client_id: str):
+    async def rehydrate_client(access_token: str, client_id: str):
         """
-        Get latest conversations client_id and limit by limit*2+1 (sytem + user/assistant).
+        Load client and its last conversations (MAX_LEN) into the session store if not in the store (restart/other worker):
+        from INACTIVE_DATA if the client just expired, else from DB.
+        Concurrent loads of the same client are coalesced, clients not found in DB are cached for REHYDRATE_NEGATIVE_TTL.
         Args:
             access_token (str): access token
             client_id (str): client id
-            limit (int): limit conversations
         Returns:
-            data (list): list of latest conversations (role/content)
+            True/False: True if the client is in the store
+        """
+        if await DB.check_client_id_existed(access_token, client_id):
+            return True
+        if await DB.restore_inactive_client(access_token, client_id):
+            return True
+        key = (access_token, client_id)
+        expired_at = NOT_FOUND.get(key)
+        if expired_at is not None:
+            if expired_at > time.monotonic():
+                return False
+            NOT_FOUND.pop(key, None)
+        if key not in LOADING:
+            LOADING[key] = asyncio.ensure_future(DB.load_client(access_token, client_id))
+            LOADING[key].add_done_callback(lambda _: LOADING.pop(key, None))
+        try:
+            # shield: a cancelled request does not cancel the load of the other requests
+            return await asyncio.shield(LOADING[key])
+        except Exception as e:
+            LOGGER.error("Exception: {}".format(e))
+            return False
+
+    @staticmethod
+    async def restore_inactive_client(access_token: str, client_id: str):
+        """
+        Move client expired by this worker (not saved to DB yet) back to the session store.
+        Returns:
+            True/False
+        """
+        with DATA_LOCK:
+            data = INACTIVE_DATA.pop((access_token, client_id), None)
+        if data is None:
+            return False
+        conversations = data.pop("conversations")
+        data["status"] = str(Status.ACTIVE)
+        data["updated_at"] = get_datetime_now()
+        if await STORE.create(access_token, client_id, data, conversations):
+            FLUSH_QUEUE.put(access_token, client_id)
+        LOGGER.info("Restored inactive access_token={} - client_id={}".format(access_token, client_id))
+        return True
+
+    @staticmethod
+    async def load_client(access_token: str, client_id: str, cache_ttl=Config.REHYDRATE_NEGATIVE_TTL):
+        """
+        Load client from DB with one query of the client partition (RowKey range of the client id): the client entity
+        keeps its number of turns and its last conversations (MAX_LEN).
+        Client entities saved without them (or with too long conversations) are completed by a query of their
+        conversation partition.
+        Returns:
+            True/False: False if not found
+        """
+        if DB_CLIENT is None:
+            return False
+        start = time.perf_counter()
+        entity = None
+        # RowKey is "<client_id>_<created_at>", "`" is the next character of "_"
+        query = DB_CLIENT.query_entities("PartitionKey eq @pk and RowKey ge @low and RowKey lt @high",
+                                         parameters={"pk": access_token, "low": client_id + "_", "high": client_id + "`"},
+                                         results_per_page=MAX_LEN)
+        async for e in query:
+            if entity is None or e["RowKey"] > entity["RowKey"]:
+                entity = e
+        if entity is None:
+            NOT_FOUND[(access_token, client_id)] = time.monotonic() + cache_ttl
+            while len(NOT_FOUND) > NOT_FOUND_MAX_SIZE:
+                NOT_FOUND.popitem(last=False)
+            return False
+
+        if entity.get("recent"):
+            turns = entity["turns"]
+            conversations = [Turn.from_list(d) for d in decode(entity["recent"])]
+        else:
+            turns, conversations = await DB.load_conversations(access_token, client_id, entity["created_at"])
+        client = {}
+        client["status"] = str(Status.ACTIVE)
+        client["language"] = entity.get("language", EMP_STR)
+        client["prompt_id"] = entity.get("prompt_id", EMP_STR)
+        client["turns"] = turns
+        client["saved_turns"] = turns
+        client["created_at"] = str2time(entity["created_at"])
+        client["updated_at"] = get_datetime_now()
+        await STORE.create(access_token, client_id, client, conversations)
+        LOGGER.info("Rehydrated access_token={} - client_id={}: {} conversations in {:.3f}s".format(
+            access_token, client_id, turns, time.perf_counter() - start))
+        return True
+
+    @staticmethod
+    async def load_conversations(access_token: str, client_id: str, client_created_at: str, last: int = MAX_LEN):
+        """
+        Load the last conversations of a client from its conversation partition.
+        Args:
+            last (int): number of conversations, 0 for all
+        Returns:
+            turns (int): number of conversations of the client
+            conversations (list): last conversations (Turn), oldest first
         """
-        global CURRENT_DATA
-        if not DB.check_client_id_existed(access_token, client_id):
+        partition_key = "{}_{}_{}".format(access_token, client_created_at, client_id)
+        entities = [e async for e in DB_CONV.query_entities("PartitionKey eq @pk", parameters={"pk": partition_key})]
+        entities.sort(key=lambda e: e["RowKey"])
+        turns = len(entities)
+        conversations = []
+        entities = entities[-last:] if last > 0 else entities
+        for i, e in enumerate(entities):
+            # conversations saved before the prompt registry have the full system prompt
+            prompt_id = e["prompt_id"] if "prompt_id" in e else PROMPTS.register(e.get("system", EMP_STR))
+            conversations.append(Turn(e.get("language", EMP_STR), prompt_id, e.get("user", EMP_STR), e.get("assistant", EMP_STR),
+                                      e["created_at"], turn=turns - len(entities) + i, tokens=e.get("tokens", -1)))
+        return turns, conversations
+
+    @staticmethod
+    async def get_turns_since(access_token: str, client_id: str, since: int):
+        """
+        Get the conversations of client_id from turn since, oldest first: the session store keeps the conversations
+        not saved yet and the last MAX_LEN, the older ones are read from the conversation partition.
+        Args:
+            access_token (str): access token
+            client_id (str): client id
+            since (int): first turn
+        Returns:
+            data (list): list of Turn
+        """
+        client = await STORE.snapshot(access_token, client_id, since)
+        if client is None:
+            return []
+        conversations = client["conversations"]
+        first = conversations[0].turn if conversations else client["turns"]
+        if first > since and DB_CONV is not None:
+            _, saved = await DB.load_conversations(access_token, client_id, time2str(client["created_at"]), last=0)
+            conversations = [d for d in saved if since <= d.turn < first] + conversations
+        return conversations
+
+    @staticmethod
+    async def get_latest_turns(access_token: str, client_id: str):
+        """
+        Get latest conversations (MAX_LEN) of client_id, oldest first.
+        Args:
+            access_token (str): access token
+            client_id (str): client id
+        Returns:
+            data (list): list of Turn
+        """
+        # the session may have been evicted/expired since it was rehydrated: restore it, a new session splits the history
+        if not await DB.rehydrate_client(access_token, client_id):
             LOGGER.error("access_token={} - client_id={} not found!")
-            DB.init_client(access_token, client_id)
+            await DB.init_client(access_token, client_id)
             LOGGER.info("Create new access_token={} - client_id={}!")
             # raise HTTPException(status_code=400, detail="access_token={} - client_id={} not found!".format(access_token, client_id))
-        if not DB.check_client_id_active(access_token, client_id):
+        if not await DB.check_client_id_active(access_token, client_id):
             LOGGER.error("access_token={} - client_id={} not active!")
             raise HTTPException(status_code=400, detail="access_token={} - client_id={} not active!".format(access_token, client_id))
+        return await STORE.get_turns(access_token, client_id, MAX_LEN)
 
-        client = CURRENT_DATA[access_token][client_id]
+    @staticmethod
+    async def get_latest_conversations(access_token: str, client_id: str):
+        """
+        Get latest conversations client_id and limit by limit*2+1 (sytem + user/assistant).
+        Args:
+            access_token (str): access token
+            client_id (str): client id
+        Returns:
+            data (list): list of latest conversations (role/content)
+        """
         data = []
-        for d in client["conversations"][-MAX_LEN:]:
-            data.append({"role": str(Role.USER), "content": d['user']})
-            data.append({"role": str(Role.ASSISTANT), "content": d['assistant']})
+        for d in await DB.get_latest_turns(access_token, client_id):
+            data.append({"role": str(Role.USER), "content": d.user})
+            data.append({"role": str(Role.ASSISTANT), "content": d.assistant})
         return data
 
     @staticmethod
-    def add_conversation(access_token: str, client_id: str, language: str, system: str, user: str, assistant: str):
+    async def add_conversation(access_token: str, client_id: str, language: str, system: str, user: str, assistant: str):
         """
         Add new conversation to DB by client_id, language, system, user, assistant.
+        The system prompt is kept once in the prompt registry, the conversation keeps its id.
         Args:
             access_token (str): access token
             client_id (str): client id
@@ -161,48 +412,94 @@ class DB:
         Returns:
             data (list): list of latest conversations (role/content)
         """
-        global CURRENT_DATA
-        if not DB.check_client_id_existed(access_token, client_id):
+        # the session may have been evicted/expired since the request started (long LLM call): restore it before the new one
+        if not await DB.rehydrate_client(access_token, client_id):
             LOGGER.error("access_token={} - client_id={} not found!")
-            DB.init_client(access_token, client_id)
+            await DB.init_client(access_token, client_id)
             LOGGER.info("Create new access_token={} - client_id={}!")
             # raise HTTPException(status_code=400, detail="access_token={} - client_id={} not found!".format(access_token, client_id))
-        client = CURRENT_DATA[access_token][client_id].copy()
-        conversation = {
-                        "language": language,
-                        "system": system,
-                        "user": user,
-                        "assistant": assistant,
-                        "created_at": get_datetime_now()
-                        }
-        client["conversations"].append(conversation)
-        client["updated_at"] = get_datetime_now()
-        CURRENT_DATA[access_token][client_id] = client
+        # prompt tokens of the turn are counted once, the history window reads them from the turn
+        tokens = count_message_tokens(user) + count_message_tokens(assistant)
+        conversation = Turn(language, PROMPTS.register(system), user, assistant, get_datetime_now(), tokens=tokens)
+        # the store sets the turn number of the conversation and updated_at of the client
+        await STORE.append_turn(access_token, client_id, conversation, get_datetime_now())
+        FLUSH_QUEUE.put(access_token, client_id)
 
     @staticmethod
-    def update_status(duration=Config.STATUS_DURATION):
+    @synchronized
+    def spill_client(access_token: str, client_id: str, client: dict):
+        """
+        Keep client evicted from the session store (capacity/quota) in INACTIVE_DATA until it is saved to DB,
+        request a flush when FLUSH_BATCH_SIZE evicted clients are waiting.
+        Args:
+            access_token (str): access token
+            client_id (str): client id
+            client (dict): client with all its "conversations"
+        """
+        global SPILLED
+        DB.keep_inactive(access_token, client_id, client)
+        SPILLED += 1
+        if SPILLED >= Config.FLUSH_BATCH_SIZE and FLUSH_TRIGGER is not None:
+            SPILLED = 0
+            FLUSH_TRIGGER()
+
+    @staticmethod
+    @synchronized
+    def keep_inactive(access_token: str, client_id: str, client: dict, max_count=Config.INACTIVE_MAX_COUNT):
+        """
+        Keep client in INACTIVE_DATA until it is saved to DB. Over max_count (the database is failing),
+        the oldest clients are dropped: the memory stays bounded, their changes since the last save are lost.
+        Args:
+            access_token (str): access token
+            client_id (str): client id
+            client (dict): client with all its "conversations"
+            max_count (int): max clients waiting, 0 for no limit
+        """
+        global INACTIVE_DROPPED
+        key = (access_token, client_id)
+        INACTIVE_DATA[key] = client
+        INACTIVE_DATA.move_to_end(key)
+        dropped = 0
+        while max_count > 0 and len(INACTIVE_DATA) > max_count:
+            INACTIVE_DATA.popitem(last=False)
+            dropped += 1
+        if dropped > 0:
+            INACTIVE_DROPPED += dropped
+            LOGGER.error("Dropped {} unsaved inactive clients over inactive_max_count={} (total dropped={})".format(
+                dropped, max_count, INACTIVE_DROPPED))
+
+    @staticmethod
+    async def get_session_stats():
+        """
+        Gauges of the sessions: sessions/bytes of the session store (and its limits), clients waiting in INACTIVE_DATA.
+        Returns:
+            stats (dict)
+        """
+        stats = await STORE.stats()
+        with DATA_LOCK:
+            stats["inactive"] = len(INACTIVE_DATA)
+            stats["inactive_dropped"] = INACTIVE_DROPPED
+        return stats
+
+    @staticmethod
+    async def update_status(duration=Config.STATUS_DURATION):
         """
         Update client status if inactive after duration.
         Args:
             duration (int): duration to change status time (seconds)
         Returns:
         """
-        global CURRENT_DATA, INACTIVE_DATA
         try:
             LOGGER.info("Update client status if inactive after {} s.".format(duration))
-            for access_token, clients in list(CURRENT_DATA.items()):
-                for client_id, _ in list(clients.items()):
-                    # check last updated_at of client
-                    updated_at_delta = (get_datetime_now() - clients[client_id]['updated_at']).total_seconds()
-                    if updated_at_delta > duration:
-                        LOGGER.info("Update status of access_token={} - client_id={}".format(access_token, client_id))
-                        INACTIVE_DATA[access_token] = INACTIVE_DATA[access_token] if access_token in INACTIVE_DATA else {}
-                        INACTIVE_DATA[access_token][client_id] = clients[client_id]
-                        INACTIVE_DATA[access_token][client_id]['status'] = str(Status.INACTIVE)
-                        LOGGER.info("Remove access_token={} - client_id={} (inactive) of out the global data.".format(access_token, client_id))
-                        CURRENT_DATA[access_token].pop(client_id)
+            # expired clients from the expiry index of the store, pop is atomic: only one worker moves a client to its INACTIVE_DATA
+            for access_token, client_id, client in await STORE.pop_expired(duration):
+                LOGGER.info("Update status of access_token={} - client_id={}".format(access_token, client_id))
+                client['status'] = str(Status.INACTIVE)
+                DB.keep_inactive(access_token, client_id, client)
+                LOGGER.info("Remove access_token={} - client_id={} (inactive) of out the session store.".format(access_token, client_id))
+            LOGGER.info("Sessions: {}".format(await DB.get_session_stats()))
         except Exception as e:
-            LOGGER.error("Exception:", str(e))
+            LOGGER.error("Exception: {}".format(e))
 
     @staticmethod
     def copy_client(access_token, client_id, data):
@@ -222,8 +519,12 @@ class DB:
         client["status"] = data["status"]
         client["created_at"] = time2str(data["created_at"])
         client["updated_at"] = time2str(data["updated_at"])
-        client["language"] = conversations[0]["language"] if (len(conversations) > 0 and data["language"] == EMP_STR) else data["language"]
-        client["init_prompt"] = conversations[0]["system"] if (len(conversations) > 0 and data["init_prompt"] == EMP_STR) else data["init_prompt"]
+        client["language"] = conversations[0].language if (len(conversations) > 0 and data["language"] == EMP_STR) else data["language"]
+        client["prompt_id"] = conversations[0].prompt_id if (len(conversations) > 0 and data["prompt_id"] == EMP_STR) else data["prompt_id"]
+        # number of turns and last conversations: the client is rehydrated by one query of the client partition
+        client["turns"] = data["turns"]
+        recent = encode([d.to_list() for d in conversations[-MAX_LEN:]])
+        client["recent"] = recent if len(recent) <= RECENT_MAX_CHARS else EMP_STR
         client["PartitionKey"] = access_token
         client["RowKey"] = "{}_{}".format(client_id, client["created_at"])
         return client
@@ -237,86 +538,233 @@ class DB:
             access_token (str): access token
             client_id (str): client id
             client_created_at (str): create time of client
-            data (dict): conversation data
+            data (Turn): conversation data
         Returns:
             conv (list): list of latest conversations data.
         """
         conv = {}
         conv['client_id'] = client_id
-        conv["created_at"] = time2str(data['created_at'])
-        conv["language"] = data["language"]
-        conv["system"] = data["system"]
-        conv["user"] = data["user"]
-        conv["assistant"] = data["assistant"]
+        conv["created_at"] = time2str(data.created_at)
+        conv["language"] = data.language
+        conv["prompt_id"] = data.prompt_id
+        conv["user"] = data.user
+        conv["assistant"] = data.assistant
+        conv["tokens"] = data.tokens
         conv["PartitionKey"] = "{}_{}_{}".format(access_token, client_created_at, client_id)
         conv["RowKey"] = conv["created_at"]
         return conv
 
     @staticmethod
-    def save_inactive_clients():
+    def get_entities(access_token, client_id, data):
+        """
+        Create client entity and entities of the conversations added since the last save (turn >= saved_turns).
+        Args:
+            access_token (str): access token
+            client_id (str): client id
+            data (dict): client data
+        Returns:
+            client (dict): client entity
+            conversations (list): conversation entities
+            saved_turns (int): high-water mark of the client once the entities are saved
+        """
+        client = DB.copy_client(access_token, client_id, data.copy())
+        conversations = []
+        saved_turns = data["saved_turns"]
+        for d in data["conversations"].copy():
+            if d.turn < data["saved_turns"]:
+                continue
+            conversations.append(DB.copy_conversation(access_token, client_id, client["created_at"], d))
+            saved_turns = max(saved_turns, d.turn + 1)
+        return client, conversations, saved_turns
+
+    @staticmethod
+    async def submit_transaction(table, semaphore, partition_key, operations, retries=Config.DB_RETRIES):
+        """
+        Submit a batch transaction, retry with jittered backoff if failed.
+        Returns:
+            True/False
+        """
+        attempt = 0
+        while True:
+            try:
+                async with semaphore:
+                    await table.submit_transaction(operations)
+                return True
+            except Exception as e:
+                if attempt >= retries:
+                    LOGGER.error("Transaction of {} entities (PartitionKey={}) failed: {}".format(len(operations), partition_key, e))
+                    return False
+                delay = random.uniform(0, Config.DB_RETRY_BACKOFF * 2 ** attempt)
+                attempt += 1
+                LOGGER.warning("Transaction of {} entities (PartitionKey={}) failed: {}. Retrying {}/{} in {:.2f}s...".format(
+                    len(operations), partition_key, type(e).__name__, attempt, retries, delay))
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def submit_entities(table, entities, concurrency=Config.DB_CONCURRENCY):
+        """
+        Upsert entities with batch transactions: grouped by PartitionKey, up to TRANSACTION_SIZE entities per transaction,
+        up to concurrency transactions at the same time.
+        Args:
+            table (TableClient): async table client
+            entities (list): entities
+            concurrency (int): max concurrent transactions
+        Returns:
+            failed (set): (PartitionKey, RowKey) of the entities not saved
+        """
+        partitions = OrderedDict()
+        for entity in entities:
+            # a transaction cannot have 2 operations on the same entity, keep the last one
+            partitions.setdefault(entity["PartitionKey"], OrderedDict())[entity["RowKey"]] = entity
+
+        batches = []
+        for partition_key, rows in partitions.items():
+            rows = list(rows.values())
+            for i in range(0, len(rows), TRANSACTION_SIZE):
+                batches.append((partition_key, [("upsert", entity) for entity in rows[i:i + TRANSACTION_SIZE]]))
+
+        semaphore = asyncio.Semaphore(concurrency)
+        results = await asyncio.gather(*[DB.submit_transaction(table, semaphore, partition_key, operations) for partition_key, operations in batches])
+        failed = set()
+        for (partition_key, operations), success in zip(batches, results):
+            if not success:
+                failed.update((partition_key, entity["RowKey"]) for _, entity in operations)
+        return failed
+
+    @staticmethod
+    async def snapshot_chunk(items, inactive=False):
+        """
+        Snapshot clients of INACTIVE_DATA (under the data lock) or of the session store (concurrent snapshots).
+        Returns:
+            snapshots (list): list of (access_token, client_id, client with "conversations")
+        """
+        if inactive:
+            with DATA_LOCK:
+                data = [INACTIVE_DATA.get(key) for key in items]
+        else:
+            data = await asyncio.gather(*[STORE.snapshot(access_token, client_id) for access_token, client_id in items])
+        return [(access_token, client_id, d) for (access_token, client_id), d in zip(items, data) if d is not None]
+
+    @staticmethod
+    async def snapshot_clients(items, inactive=False, chunk_size=SNAPSHOT_CHUNK_SIZE):
+        """
+        Create entities of the clients from snapshots taken chunk_size clients at a time,
+        the event loop serves requests between two chunks (every snapshot of a client is consistent).
+        Args:
+            items (list): list of (access_token, client_id)
+            inactive (bool): clients of INACTIVE_DATA
+            chunk_size (int): clients per chunk
+        Returns:
+            clients (list): client entities
+            conversations (list): conversation entities
+            pending (list): list of ((access_token, client_id), keys of the entities, saved_turns)
+        """
+        clients, conversations, pending = [], [], []
+        for i in range(0, len(items), chunk_size):
+            if i > 0:
+                await asyncio.sleep(0)
+            for access_token, client_id, data in await DB.snapshot_chunk(items[i:i + chunk_size], inactive):
+                client, convs, saved_turns = DB.get_entities(access_token, client_id, data)
+                clients.append(client)
+                conversations.extend(convs)
+                keys = [(e["PartitionKey"], e["RowKey"]) for e in [client] + convs]
+                pending.append(((access_token, client_id), keys, saved_turns))
+        return clients, conversations, pending
+
+    @staticmethod
+    async def save_clients(items, inactive=False):
+        """
+        Save clients and their new conversations to DB.
+        Args:
+            items (list): list of (access_token, client_id)
+            inactive (bool): clients of INACTIVE_DATA
+        Returns:
+            saved (dict): (access_token, client_id) -> saved_turns of the saved clients
+        """
+        start = time.perf_counter()
+        clients, conversations, pending = await DB.snapshot_clients(items, inactive)
+        if len(pending) == 0:
+            return {}
+        failed_clients, failed_conversations = await asyncio.gather(DB.submit_entities(DB_CLIENT, clients),
+                                                                    DB.submit_entities(DB_CONV, conversations))
+        failed = failed_clients | failed_conversations
+        saved = {key: saved_turns for key, keys, saved_turns in pending if not any(k in failed for k in keys)}
+
+        count = len(clients) + len(conversations) - len(failed)
+        elapsed = time.perf_counter() - start
+        LOGGER.info("Saved {} clients - {} entities in {:.3f}s ({:.1f} entities/s), {} clients failed.".format(
+            len(saved), count, elapsed, count / elapsed if elapsed > 0 else 0.0, len(pending) - len(saved)))
+        return saved
+
+    @staticmethod
+    async def save_prompts():
+        """
+        Save prompts registered since the last save to DB (once per prompt).
+        Args:
+        Returns:
+        """
+        try:
+            prompts = PROMPTS.get_pending()
+            if len(prompts) == 0:
+                return
+            entities = [{"PartitionKey": PROMPT_PARTITION, "RowKey": prompt_id, "prompt": text} for prompt_id, text in prompts]
+            failed = await DB.submit_entities(DB_PROMPT, entities)
+            PROMPTS.mark_saved([prompt_id for prompt_id, _ in prompts if (PROMPT_PARTITION, prompt_id) not in failed])
+            LOGGER.info("Saved {} prompts to database.".format(len(prompts) - len(failed)))
+        except Exception as e:
+            LOGGER.error("Exception: {}".format(e))
+
+    @staticmethod
+    async def save_inactive_clients():
         """
         Save inactive clients to DB.
-        Clear all inactive clients.
+        Clear all saved inactive clients, failed clients are kept for the next run.
         Args:
         Returns:
         """
-        global INACTIVE_DATA
+        global SPILLED
         try:
-            LOGGER.info("Save inactive clients to database...")
-            for access_token, clients in list(INACTIVE_DATA.items()):
-                for client_id, _ in list(clients.items()):
-                    LOGGER.info("Save inactive client access_token={} - client_id={}".format(access_token, client_id))
-                    client = DB.copy_client(access_token, client_id, clients[client_id].copy())
-                    conversations = clients[client_id]["conversations"].copy()
-                    try:
-                        cli = DB_CLIENT.get_entity(partition_key=client["PartitionKey"], row_key=client["RowKey"])
-                        DB_CLIENT.update_entity(client)
-                    except Exception as e:
-                        cli = DB_CLIENT.create_entity(entity=client)
-
-                    for i in range(len(conversations)):
-                        conversation = DB.copy_conversation(access_token, client_id, client["created_at"], conversations[i].copy())
-                        try:
-                            conv = DB_CONV.get_entity(partition_key=conversation["PartitionKey"], row_key=conversation["RowKey"])
-                        except Exception as e:
-                            conv = DB_CONV.create_entity(entity=conversation)
-                    LOGGER.info("Saved {} conversations of access_token={} - client_id={} to database.".format(len(conversations), access_token, client_id))
-            # clear all inactive clients.
-            INACTIVE_DATA = {}
+            with DATA_LOCK:
+                SPILLED = 0
+                items = list(INACTIVE_DATA)
+            if len(items) == 0:
+                return
+            LOGGER.info("Save {} inactive clients to database...".format(len(items)))
+            saved = await DB.save_clients(items, inactive=True)
+            with DATA_LOCK:
+                for key in saved:
+                    # the client may be restored to the session store during the save
+                    INACTIVE_DATA.pop(key, None)
         except Exception as e:
-            LOGGER.error("Exception:", str(e))
+            LOGGER.error("Exception: {}".format(e))
 
     @staticmethod
-    def save_active_clients():
+    async def save_active_clients(batch_size=Config.FLUSH_BATCH_SIZE):
         """
-        Save & update active clients to DB.
-        Clear previous conversations, keep last conversations (MAX_LEN).
+        Save & update active clients changed since the last save (FLUSH_QUEUE) to DB, batch_size clients at a time.
+        Clear previous saved conversations, keep last conversations (MAX_LEN).
         Args:
+            batch_size (int): max clients saved per batch
         Returns:
         """
-        global CURRENT_DATA
         try:
-            LOGGER.info("Save & update active clients to database...")
-            for access_token, clients in list(CURRENT_DATA.items()):
-                for client_id, _ in list(clients.items()):
-                    LOGGER.info("Save active client access_token={} - client_id={}".format(access_token, client_id))
-                    client = DB.copy_client(access_token, client_id, clients[client_id].copy())
-                    conversations = clients[client_id]["conversations"].copy()
-                    try:
-                        cli = DB_CLIENT.get_entity(partition_key=client["PartitionKey"], row_key=client["RowKey"])
-                        DB_CLIENT.update_entity(client)
-                    except Exception as e:
-                        cli = DB_CLIENT.create_entity(entity=client)
-
-                    for i in range(len(conversations)):
-                        conversation = DB.copy_conversation(access_token, client_id, client["created_at"], conversations[i].copy())
-                        try:
-                            conv = DB_CONV.get_entity(partition_key=conversation["PartitionKey"], row_key=conversation["RowKey"])
-                        except Exception as e:
-                            conv = DB_CONV.create_entity(entity=conversation)
-                    LOGGER.info("Saved {} conversations of access_token={} - client_id={} to database.".format(len(conversations), access_token, client_id))
-                    # clear previous conversations, keep last conversations (MAX_LEN)
-                    CURRENT_DATA[access_token][client_id]['conversations'] = conversations[-MAX_LEN:] if len(conversations) > MAX_LEN else conversations
-                    LOGGER.info("Keep {} conversations of caccess_token={} - client_id={} to database.".format(len(CURRENT_DATA[access_token][client_id]['conversations']), access_token, client_id))
+            # clients queued again (failed/changed) during the run are left for the next run
+            for _ in range((len(FLUSH_QUEUE) + batch_size - 1) // batch_size):
+                batch = FLUSH_QUEUE.get_batch(batch_size)
+                LOGGER.info("Save & update {} changed active clients to database...".format(len(batch)))
+                # clients not in the store anymore (expired) are saved by save_inactive_clients
+                saved = await DB.save_clients(batch)
+                for access_token, client_id in batch:
+                    if (access_token, client_id) in saved:
+                        # clear previous saved conversations, keep last conversations (MAX_LEN)
+                        await STORE.mark_saved(access_token, client_id, saved[(access_token, client_id)], MAX_LEN)
+                    elif await DB.check_client_id_existed(access_token, client_id):
+                        FLUSH_QUEUE.put(access_token, client_id)
+            if len(FLUSH_QUEUE) > 0:
+                LOGGER.warning("{} changed clients left for the next run.".format(len(FLUSH_QUEUE)))
         except Exception as e:
-            LOGGER.error("Exception:", str(e))
+            LOGGER.error("Exception: {}".format(e))
+
+
+# sessions evicted by the memory store are saved like the inactive clients
+STORE.on_evict = DB.spill_client
@@ -0,0 +1,28 @@
+import sys
+
+
+class Turn:
+    """Conversation turn: the system prompt is referenced by its id in the prompt registry,
+    language codes and prompt ids are interned (one string object per distinct value).
+    tokens is the cached prompt-token count of the user/assistant messages (-1 if not counted yet).
+    """
+    __slots__ = ("turn", "language", "prompt_id", "user", "assistant", "created_at", "tokens")
+
+    def __init__(self, language, prompt_id, user, assistant, created_at, turn=-1, tokens=-1):
+        self.turn = turn
+        self.language = sys.intern(language)
+        self.prompt_id = sys.intern(prompt_id)
+        self.user = user
+        self.assistant = assistant
+        self.created_at = created_at
+        self.tokens = tokens
+
+    def to_list(self):
+        return [self.turn, self.language, self.prompt_id, self.user, self.assistant, self.created_at, self.tokens]
+
+    @classmethod
+    def from_list(cls, data):
+        # turns stored before the token count have 6 fields
+        turn, language, prompt_id, user, assistant, created_at = data[:6]
+        tokens = data[6] if len(data) > 6 else -1
+        return cls(language, prompt_id, user, assistant, created_at, turn=turn, tokens=tokens)
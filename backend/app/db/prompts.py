@@ -0,0 +1,58 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from app.config import LOGGER
+
+
+class PromptRegistry:
+    """System prompts by id (hash of the content): turns keep the id, every prompt is saved to DB once.
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.prompts = OrderedDict()
+        # prompts not saved to DB yet
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_id(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+    def register(self, text: str) -> str:
+        """
+        Add prompt if not registered.
+        Returns:
+            prompt_id (str): id of the prompt
+        """
+        prompt_id = self.get_id(text)
+        with self.lock:
+            if prompt_id in self.prompts:
+                self.prompts.move_to_end(prompt_id)
+                return prompt_id
+            self.prompts[prompt_id] = text
+            self.pending[prompt_id] = text
+            while len(self.prompts) > self.max_size:
+                self.prompts.popitem(last=False)
+        LOGGER.info("Registered prompt {} ({} chars)".format(prompt_id, len(text)))
+        return prompt_id
+
+    def get(self, prompt_id: str):
+        with self.lock:
+            return self.prompts.get(prompt_id)
+
+    def get_pending(self):
+        """
+        Returns:
+            list of (prompt_id, text) not saved to DB yet
+        """
+        with self.lock:
+            return list(self.pending.items())
+
+    def mark_saved(self, prompt_ids):
+        with self.lock:
+            for prompt_id in prompt_ids:
+                self.pending.pop(prompt_id, None)
+
+
+PROMPTS = PromptRegistry()
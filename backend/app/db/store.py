@@ -0,0 +1,657 @@
+import os
+import sys
+import time
+import json
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import Config, LOGGER, STORAGE_DIR
+from app.db.models.turn import Turn
+
+
+class STORE_TYPE:
+    MEMORY = 'memory'
+    SQLITE = 'sqlite'
+    REDIS = 'redis'
+
+
+def encode(data) -> str:
+    """
+    Encode client dict/fields/turn list to JSON, datetimes are kept as {"$dt": iso format}.
+    """
+    return json.dumps(data, ensure_ascii=False, default=lambda o: {"$dt": o.isoformat()} if isinstance(o, datetime) else str(o))
+
+def decode(text):
+    return json.loads(text, object_hook=lambda o: datetime.fromisoformat(o["$dt"]) if len(o) == 1 and "$dt" in o else o)
+
+
+# approximate sizes (bytes) of the containers of a session/turn, the strings are added by their sys.getsizeof
+SESSION_OVERHEAD = 1024
+TURN_OVERHEAD = 200
+
+
+def get_session_size(client_id: str, client: dict) -> int:
+    return SESSION_OVERHEAD + sys.getsizeof(client_id) + sum(sys.getsizeof(v) for v in client.values() if isinstance(v, str))
+
+def get_turn_size(conversation: Turn) -> int:
+    return TURN_OVERHEAD + sys.getsizeof(conversation.user) + sys.getsizeof(conversation.assistant)
+
+
+class SessionStore(ABC):
+    """Interface of the session state backends.
+    A session is a client dict (status/language/prompt_id/created_at/updated_at/turns/saved_turns) plus its conversations (Turn),
+    every conversation has its turn number (Turn.turn), turns = number of conversations added.
+    All methods are atomic coroutines (the backends never block the event loop), returned client dicts are copies,
+    returned Turn records must not be changed.
+    """
+    # called with (access_token, client_id, client with all its "conversations") for every session evicted by a bounded store
+    on_evict = None
+
+    @abstractmethod
+    async def create(self, access_token: str, client_id: str, client: dict, conversations: list = ()) -> bool:
+        """
+        Create session if not existed.
+        Args:
+            conversations (list): conversations (Turn) of a restored session, oldest first
+        Returns:
+            True if created, False if existed
+        """
+
+    @abstractmethod
+    async def get(self, access_token: str, client_id: str):
+        """
+        Returns:
+            client (dict): None if not existed
+        """
+
+    @abstractmethod
+    async def update(self, access_token: str, client_id: str, fields: dict) -> bool:
+        """
+        Set fields of the client.
+        Returns:
+            True if updated, False if the session is not existed
+        """
+
+    @abstractmethod
+    async def append_turn(self, access_token: str, client_id: str, conversation: Turn, updated_at: datetime) -> int:
+        """
+        Add conversation as the next turn and set updated_at of the client.
+        Returns:
+            turn (int): turn number of the conversation, -1 if the session is not existed
+        """
+
+    @abstractmethod
+    async def get_turns(self, access_token: str, client_id: str, last: int) -> list:
+        """
+        Returns:
+            conversations (list): last conversations, oldest first
+        """
+
+    @abstractmethod
+    async def snapshot(self, access_token: str, client_id: str, since: int = 0):
+        """
+        Returns:
+            client (dict): client with "conversations" (turn >= since), None if not existed
+        """
+
+    @abstractmethod
+    async def mark_saved(self, access_token: str, client_id: str, saved_turns: int, keep: int):
+        """
+        Set high-water mark of the saved turns, remove saved turns except the last keep turns.
+        """
+
+    @abstractmethod
+    async def pop(self, access_token: str, client_id: str):
+        """
+        Remove session.
+        Returns:
+            client (dict): client with all its "conversations", None if not existed
+        """
+
+    @abstractmethod
+    async def pop_expired(self, idle: float) -> list:
+        """
+        Remove sessions not updated (created/turn added) for idle seconds, from the expiry index:
+        the work is proportional to the expired sessions, not all sessions.
+        Args:
+            idle (float): seconds
+        Returns:
+            list of (access_token, client_id, client with all its "conversations")
+        """
+
+    @abstractmethod
+    async def items(self) -> list:
+        """
+        Returns:
+            list of (access_token, client_id, client)
+        """
+
+    @abstractmethod
+    async def stats(self) -> dict:
+        """
+        Gauges of the store.
+        Returns:
+            stats (dict): number of sessions, approximate bytes of the sessions
+        """
+
+    async def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in the process memory (single worker), bounded by a global capacity (max_sessions/max_bytes)
+    and a quota of sessions per access token.
+    LRU index: OrderedDict of the keys by the last update (created/turn added), oldest first, it is also the expiry index.
+    Over a limit, the least recently updated sessions (of the access token for the quota) are evicted
+    and passed to on_evict (spilled to DB) outside the lock.
+    """
+    def __init__(self, max_sessions=Config.SESSION_MAX_COUNT, max_bytes=Config.SESSION_MAX_BYTES,
+                 token_quota=Config.SESSION_TOKEN_QUOTA, on_evict=None):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.token_quota = token_quota
+        self.on_evict = on_evict
+        self.sessions = {}
+        self.lru = OrderedDict()
+        # access_token -> OrderedDict of its client ids (LRU)
+        self.tokens = {}
+        self.bytes = 0
+        self.evicted = 0
+        self.lock = threading.RLock()
+
+    def touch(self, key, session):
+        session["touched"] = time.monotonic()
+        self.lru[key] = session["touched"]
+        self.lru.move_to_end(key)
+        self.tokens[key[0]].move_to_end(key[1])
+
+    def remove(self, key):
+        session = self.sessions.pop(key)
+        self.lru.pop(key)
+        clients = self.tokens[key[0]]
+        clients.pop(key[1])
+        if len(clients) == 0:
+            self.tokens.pop(key[0])
+        self.bytes -= session["bytes"]
+        return key + (dict(session["client"], conversations=session["conversations"]),)
+
+    def evict(self, access_token):
+        """
+        Evict the least recently updated sessions over the quota of the access token and the global capacity
+        (the last session is kept whatever its size).
+        Returns:
+            list of (access_token, client_id, client with all its "conversations")
+        """
+        evicted = []
+        clients = self.tokens.get(access_token)
+        while self.token_quota > 0 and clients is not None and len(clients) > self.token_quota:
+            evicted.append(self.remove((access_token, next(iter(clients)))))
+        while len(self.sessions) > 1 and ((self.max_sessions > 0 and len(self.sessions) > self.max_sessions)
+                                          or (self.max_bytes > 0 and self.bytes > self.max_bytes)):
+            evicted.append(self.remove(next(iter(self.lru))))
+        self.evicted += len(evicted)
+        return evicted
+
+    def spill(self, evicted):
+        if len(evicted) == 0:
+            return
+        # totals in stats() (logged by update_status)
+        LOGGER.debug("Evicted {} sessions: sessions={} - bytes={}".format(len(evicted), len(self.sessions), self.bytes))
+        if self.on_evict is not None:
+            for access_token, client_id, client in evicted:
+                self.on_evict(access_token, client_id, client)
+
+    async def create(self, access_token, client_id, client, conversations=()):
+        with self.lock:
+            key = (access_token, client_id)
+            if key in self.sessions:
+                return False
+            session = {"client": dict(client), "conversations": list(conversations)}
+            session["bytes"] = get_session_size(client_id, client) + sum(get_turn_size(d) for d in session["conversations"])
+            self.sessions[key] = session
+            self.tokens.setdefault(access_token, OrderedDict())[client_id] = None
+            self.bytes += session["bytes"]
+            self.touch(key, session)
+            evicted = self.evict(access_token)
+        self.spill(evicted)
+        return True
+
+    async def get(self, access_token, client_id):
+        with self.lock:
+            session = self.sessions.get((access_token, client_id))
+            return dict(session["client"]) if session is not None else None
+
+    async def update(self, access_token, client_id, fields):
+        with self.lock:
+            session = self.sessions.get((access_token, client_id))
+            if session is None:
+                return False
+            session["client"].update(fields)
+            return True
+
+    async def append_turn(self, access_token, client_id, conversation, updated_at):
+        with self.lock:
+            session = self.sessions.get((access_token, client_id))
+            if session is None:
+                return -1
+            client = session["client"]
+            turn = client["turns"]
+            conversation.turn = turn
+            session["conversations"].append(conversation)
+            client["turns"] = turn + 1
+            client["updated_at"] = updated_at
+            size = get_turn_size(conversation)
+            session["bytes"] += size
+            self.bytes += size
+            self.touch((access_token, client_id), session)
+            evicted = self.evict(access_token)
+        self.spill(evicted)
+        return turn
+
+    async def get_turns(self, access_token, client_id, last):
+        with self.lock:
+            session = self.sessions.get((access_token, client_id))
+            if session is None or last <= 0:
+                return []
+            return session["conversations"][-last:]
+
+    async def snapshot(self, access_token, client_id, since=0):
+        with self.lock:
+            session = self.sessions.get((access_token, client_id))
+            if session is None:
+                return None
+            return dict(session["client"], conversations=[d for d in session["conversations"] if d.turn >= since])
+
+    async def mark_saved(self, access_token, client_id, saved_turns, keep):
+        with self.lock:
+            session = self.sessions.get((access_token, client_id))
+            if session is None:
+                return
+            client = session["client"]
+            client["saved_turns"] = max(client["saved_turns"], saved_turns)
+            first = min(client["saved_turns"], client["turns"] - keep)
+            size = sum(get_turn_size(d) for d in session["conversations"] if d.turn < first)
+            session["conversations"] = [d for d in session["conversations"] if d.turn >= first]
+            session["bytes"] -= size
+            self.bytes -= size
+
+    async def pop(self, access_token, client_id):
+        with self.lock:
+            if (access_token, client_id) not in self.sessions:
+                return None
+            return self.remove((access_token, client_id))[2]
+
+    async def pop_expired(self, idle):
+        deadline = time.monotonic() - idle
+        expired = []
+        with self.lock:
+            while self.lru:
+                key, touched = next(iter(self.lru.items()))
+                if touched > deadline:
+                    break
+                expired.append(self.remove(key))
+        return expired
+
+    async def items(self):
+        with self.lock:
+            return [(access_token, client_id, dict(session["client"])) for (access_token, client_id), session in self.sessions.items()]
+
+    async def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "bytes": self.bytes, "access_tokens": len(self.tokens), "evicted": self.evicted,
+                    "max_sessions": self.max_sessions, "max_bytes": self.max_bytes, "token_quota": self.token_quota}
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a local SQLite database (WAL mode), shared by the workers of a node.
+    Writes run in BEGIN IMMEDIATE transactions, so they are atomic across processes.
+    sqlite3 is blocking (the busy timeout waits for the other workers): the statements run in a thread of the store,
+    one at a time, the event loop only awaits them.
+    Expiry index: index on updated_at (epoch time, the database outlives the monotonic clock of a boot).
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS sessions (access_token TEXT, client_id TEXT, client TEXT, updated_at REAL, PRIMARY KEY (access_token, client_id))",
+        "CREATE TABLE IF NOT EXISTS conversations (access_token TEXT, client_id TEXT, turn INTEGER, conversation TEXT, PRIMARY KEY (access_token, client_id, turn))",
+        "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)"
+    ]
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # autocommit mode, transactions are explicit
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-store")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+        LOGGER.info("Opened session store {}".format(path))
+
+    async def execute(self, func, *args):
+        """
+        Run func(*args) in the thread of the store.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def transaction(self, func, write=True):
+        def run():
+            self.conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                result = func(self.conn)
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+        return await self.execute(run)
+
+    @staticmethod
+    def read_client(conn, access_token, client_id):
+        row = conn.execute("SELECT client FROM sessions WHERE access_token=? AND client_id=?", (access_token, client_id)).fetchone()
+        return decode(row[0]) if row is not None else None
+
+    @staticmethod
+    def write_client(conn, access_token, client_id, client):
+        conn.execute("UPDATE sessions SET client=?, updated_at=? WHERE access_token=? AND client_id=?",
+                     (encode(client), client["updated_at"].timestamp(), access_token, client_id))
+
+    async def create(self, access_token, client_id, client, conversations=()):
+        def run(conn):
+            cursor = conn.execute("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?)",
+                                  (access_token, client_id, encode(client), client["updated_at"].timestamp()))
+            if cursor.rowcount != 1:
+                return False
+            conn.executemany("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                             [(access_token, client_id, d.turn, encode(d.to_list())) for d in conversations])
+            return True
+        return await self.transaction(run)
+
+    async def get(self, access_token, client_id):
+        return await self.execute(self.read_client, self.conn, access_token, client_id)
+
+    async def update(self, access_token, client_id, fields):
+        def run(conn):
+            client = self.read_client(conn, access_token, client_id)
+            if client is None:
+                return False
+            client.update(fields)
+            self.write_client(conn, access_token, client_id, client)
+            return True
+        return await self.transaction(run)
+
+    async def append_turn(self, access_token, client_id, conversation, updated_at):
+        def run(conn):
+            client = self.read_client(conn, access_token, client_id)
+            if client is None:
+                return -1
+            turn = client["turns"]
+            conversation.turn = turn
+            conn.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                         (access_token, client_id, turn, encode(conversation.to_list())))
+            client["turns"] = turn + 1
+            client["updated_at"] = updated_at
+            self.write_client(conn, access_token, client_id, client)
+            return turn
+        return await self.transaction(run)
+
+    async def get_turns(self, access_token, client_id, last):
+        def run():
+            return self.conn.execute("SELECT conversation FROM conversations WHERE access_token=? AND client_id=? ORDER BY turn DESC LIMIT ?",
+                                     (access_token, client_id, max(last, 0))).fetchall()
+        rows = await self.execute(run)
+        return [Turn.from_list(decode(row[0])) for row in reversed(rows)]
+
+    async def snapshot(self, access_token, client_id, since=0):
+        def run(conn):
+            client = self.read_client(conn, access_token, client_id)
+            if client is None:
+                return None
+            rows = conn.execute("SELECT conversation FROM conversations WHERE access_token=? AND client_id=? AND turn>=? ORDER BY turn",
+                                (access_token, client_id, since)).fetchall()
+            client["conversations"] = [Turn.from_list(decode(row[0])) for row in rows]
+            return client
+        return await self.transaction(run, write=False)
+
+    async def mark_saved(self, access_token, client_id, saved_turns, keep):
+        def run(conn):
+            client = self.read_client(conn, access_token, client_id)
+            if client is None:
+                return
+            client["saved_turns"] = max(client["saved_turns"], saved_turns)
+            self.write_client(conn, access_token, client_id, client)
+            conn.execute("DELETE FROM conversations WHERE access_token=? AND client_id=? AND turn<?",
+                         (access_token, client_id, min(client["saved_turns"], client["turns"] - keep)))
+        await self.transaction(run)
+
+    @classmethod
+    def pop_session(cls, conn, access_token, client_id):
+        client = cls.read_client(conn, access_token, client_id)
+        if client is None:
+            return None
+        rows = conn.execute("SELECT conversation FROM conversations WHERE access_token=? AND client_id=? ORDER BY turn",
+                            (access_token, client_id)).fetchall()
+        client["conversations"] = [Turn.from_list(decode(row[0])) for row in rows]
+        conn.execute("DELETE FROM conversations WHERE access_token=? AND client_id=?", (access_token, client_id))
+        conn.execute("DELETE FROM sessions WHERE access_token=? AND client_id=?", (access_token, client_id))
+        return client
+
+    async def pop(self, access_token, client_id):
+        return await self.transaction(lambda conn: self.pop_session(conn, access_token, client_id))
+
+    async def pop_expired(self, idle):
+        def run(conn):
+            keys = conn.execute("SELECT access_token, client_id FROM sessions WHERE updated_at<=?", (time.time() - idle,)).fetchall()
+            return [(access_token, client_id, self.pop_session(conn, access_token, client_id)) for access_token, client_id in keys]
+        return await self.transaction(run)
+
+    async def items(self):
+        rows = await self.execute(lambda: self.conn.execute("SELECT access_token, client_id, client FROM sessions").fetchall())
+        return [(access_token, client_id, decode(client)) for access_token, client_id, client in rows]
+
+    async def stats(self):
+        def run():
+            sessions = self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            size = sum(os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.isfile(path))
+            return {"sessions": sessions, "bytes": size}
+        return await self.execute(run)
+
+    async def close(self):
+        await self.execute(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions in Redis (or any server of the Redis protocol), shared by all workers, with the asyncio client.
+    Keys: <prefix>:client:<token>:<client_id> (hash of JSON fields), <prefix>:conv:<token>:<client_id> (list of JSON conversations)
+    and <prefix>:sessions (expiry index: sorted set of "<token>\\t<client_id>" by epoch time of updated_at).
+    The conversation at index i of the list is turn (turns - length + i), updates of several keys run as Lua scripts.
+    """
+    CREATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+local n = tonumber(ARGV[3])
+redis.call('HSET', KEYS[1], unpack(ARGV, 4, 3 + n))
+if #ARGV > 3 + n then redis.call('RPUSH', KEYS[3], unpack(ARGV, 4 + n)) end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+    UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+    APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local turn = redis.call('HINCRBY', KEYS[1], 'turns', 1) - 1
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[2])
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[4])
+return turn
+"""
+    MARK_SAVED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local saved = math.max(tonumber(redis.call('HGET', KEYS[1], 'saved_turns')), tonumber(ARGV[1]))
+redis.call('HSET', KEYS[1], 'saved_turns', saved)
+local turns = tonumber(redis.call('HGET', KEYS[1], 'turns'))
+local drop = math.min(saved, turns - tonumber(ARGV[2])) - (turns - redis.call('LLEN', KEYS[2]))
+if drop > 0 then redis.call('LTRIM', KEYS[2], drop, -1) end
+return 1
+"""
+    POP_EXPIRED_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[3], ARGV[1])
+if not score or tonumber(score) > tonumber(ARGV[2]) then return nil end
+local client = redis.call('HGETALL', KEYS[1])
+local conversations = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return {client, conversations}
+"""
+
+    def __init__(self, url: str, prefix: str = "madame_lan"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImportError("Session store 'redis' requires the redis package: pip install redis")
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.sessions_key = "{}:sessions".format(prefix)
+        self.create_script = self.redis.register_script(self.CREATE_SCRIPT)
+        self.update_script = self.redis.register_script(self.UPDATE_SCRIPT)
+        self.append_script = self.redis.register_script(self.APPEND_SCRIPT)
+        self.mark_saved_script = self.redis.register_script(self.MARK_SAVED_SCRIPT)
+        self.pop_expired_script = self.redis.register_script(self.POP_EXPIRED_SCRIPT)
+
+    def keys(self, access_token, client_id):
+        return "{}:client:{}:{}".format(self.prefix, access_token, client_id), "{}:conv:{}:{}".format(self.prefix, access_token, client_id)
+
+    @staticmethod
+    def encode_fields(fields):
+        args = []
+        for key, value in fields.items():
+            args += [key, encode(value)]
+        return args
+
+    @staticmethod
+    def decode_client(data):
+        return {key.decode(): decode(value) for key, value in data.items()} if data else None
+
+    @staticmethod
+    def decode_conversations(client, items):
+        # turn number of the first conversation in the list
+        first = client["turns"] - len(items)
+        conversations = [Turn.from_list(decode(item)) for item in items]
+        for i, conversation in enumerate(conversations):
+            conversation.turn = first + i
+        return conversations
+
+    async def create(self, access_token, client_id, client, conversations=()):
+        client_key, conv_key = self.keys(access_token, client_id)
+        fields = self.encode_fields(client)
+        return await self.create_script(keys=[client_key, self.sessions_key, conv_key],
+                                        args=["{}\t{}".format(access_token, client_id), client["updated_at"].timestamp(), len(fields)] + fields +
+                                             [encode(d.to_list()) for d in conversations]) == 1
+
+    async def get(self, access_token, client_id):
+        client_key, _ = self.keys(access_token, client_id)
+        return self.decode_client(await self.redis.hgetall(client_key))
+
+    async def update(self, access_token, client_id, fields):
+        client_key, _ = self.keys(access_token, client_id)
+        return await self.update_script(keys=[client_key], args=self.encode_fields(fields)) == 1
+
+    async def append_turn(self, access_token, client_id, conversation, updated_at):
+        client_key, conv_key = self.keys(access_token, client_id)
+        return int(await self.append_script(keys=[client_key, conv_key, self.sessions_key],
+                                            args=[encode(conversation.to_list()), encode(updated_at), updated_at.timestamp(), "{}\t{}".format(access_token, client_id)]))
+
+    async def get_turns(self, access_token, client_id, last):
+        if last <= 0:
+            return []
+        client_key, conv_key = self.keys(access_token, client_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hget(client_key, "turns")
+            pipe.lrange(conv_key, -last, -1)
+            turns, items = await pipe.execute()
+        return self.decode_conversations({"turns": int(turns)}, items) if turns is not None else []
+
+    async def snapshot(self, access_token, client_id, since=0):
+        client_key, conv_key = self.keys(access_token, client_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(client_key)
+            pipe.lrange(conv_key, 0, -1)
+            data, items = await pipe.execute()
+        client = self.decode_client(data)
+        if client is None:
+            return None
+        client["conversations"] = [d for d in self.decode_conversations(client, items) if d.turn >= since]
+        return client
+
+    async def mark_saved(self, access_token, client_id, saved_turns, keep):
+        client_key, conv_key = self.keys(access_token, client_id)
+        await self.mark_saved_script(keys=[client_key, conv_key], args=[saved_turns, keep])
+
+    async def pop(self, access_token, client_id):
+        client_key, conv_key = self.keys(access_token, client_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(client_key)
+            pipe.lrange(conv_key, 0, -1)
+            pipe.delete(client_key, conv_key)
+            pipe.zrem(self.sessions_key, "{}\t{}".format(access_token, client_id))
+            data, items, _, _ = await pipe.execute()
+        client = self.decode_client(data)
+        if client is None:
+            return None
+        client["conversations"] = self.decode_conversations(client, items)
+        return client
+
+    async def pop_expired(self, idle):
+        deadline = time.time() - idle
+        expired = []
+        for member in await self.redis.zrangebyscore(self.sessions_key, "-inf", deadline):
+            access_token, client_id = member.decode().split("\t", 1)
+            # popped only if not updated (or popped by another worker) since the range query
+            result = await self.pop_expired_script(keys=list(self.keys(access_token, client_id)) + [self.sessions_key], args=[member, deadline])
+            if result is None:
+                continue
+            data, items = result
+            client = self.decode_client(dict(zip(data[::2], data[1::2])))
+            client["conversations"] = self.decode_conversations(client, items)
+            expired.append((access_token, client_id, client))
+        return expired
+
+    async def items(self):
+        members = [m.decode().split("\t", 1) for m in await self.redis.zrange(self.sessions_key, 0, -1)]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for access_token, client_id in members:
+                pipe.hgetall(self.keys(access_token, client_id)[0])
+            values = await pipe.execute()
+        results = []
+        for (access_token, client_id), data in zip(members, values):
+            client = self.decode_client(data)
+            if client is not None:
+                results.append((access_token, client_id, client))
+        return results
+
+    async def stats(self):
+        try:
+            # memory of the whole Redis server
+            used_memory = (await self.redis.info("memory")).get("used_memory", 0)
+        except Exception:
+            # servers of the Redis protocol without INFO
+            used_memory = 0
+        return {"sessions": await self.redis.zcard(self.sessions_key), "bytes": used_memory}
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+def create_session_store(store_type=Config.SESSION_STORE) -> SessionStore:
+    if store_type == STORE_TYPE.SQLITE:
+        return SQLiteSessionStore(os.path.join(STORAGE_DIR, Config.SESSION_SQLITE_PATH))
+    if store_type == STORE_TYPE.REDIS:
+        return RedisSessionStore(Config.SESSION_REDIS_URL)
+    return MemorySessionStore()
@@ -0,0 +1,81 @@
+import time
+import asyncio
+
+from app.config import LOGGER, Config
+from app.db.api import DB, STORE, open_tables, close_tables, set_flush_trigger
+
+
+class PersistenceWorker:
+    """Background task of the event loop: moves idle clients to INACTIVE_DATA (every status_interval)
+    and saves changed clients to DB (every flush_interval or earlier on request), flushes everything on shutdown.
+    """
+    def __init__(self, status_interval=Config.STATUS_DURATION, flush_interval=Config.OUTDATE_DURATION):
+        self.status_interval = status_interval
+        self.flush_interval = flush_interval
+        self.task = None
+        self.loop = None
+        self.flush_event = None
+
+    async def start(self):
+        await open_tables()
+        self.loop = asyncio.get_running_loop()
+        self.flush_event = asyncio.Event()
+        set_flush_trigger(self.request_flush)
+        self.task = asyncio.create_task(self.run())
+        LOGGER.info("Started persistence worker: status_interval={} - flush_interval={}".format(self.status_interval, self.flush_interval))
+
+    async def flush(self):
+        start = time.perf_counter()
+        # prompts first, the conversations reference them
+        await DB.save_prompts()
+        await DB.save_inactive_clients()
+        await DB.save_active_clients()
+        LOGGER.info("Flushed to database in {:.3f}s.".format(time.perf_counter() - start))
+
+    def request_flush(self):
+        """
+        Flush before the next interval (sessions evicted from the session store are waiting in memory), thread safe.
+        """
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.flush_event.set)
+
+    async def run(self):
+        next_status = time.monotonic() + self.status_interval
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), max(0.0, min(next_status, next_flush) - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if time.monotonic() >= next_status:
+                    await DB.update_status(self.status_interval)
+                    next_status = time.monotonic() + self.status_interval
+                if self.flush_event.is_set() or time.monotonic() >= next_flush:
+                    self.flush_event.clear()
+                    await self.flush()
+                    next_flush = time.monotonic() + self.flush_interval
+            except Exception as e:
+                LOGGER.error("Exception: {}".format(e))
+
+    async def stop(self):
+        """
+        Stop the worker, save all inactive and changed active clients, close the table clients and the session store.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        set_flush_trigger(None)
+        try:
+            await self.flush()
+        finally:
+            await close_tables()
+            await STORE.close()
+        LOGGER.info("Stopped persistence worker.")
+
+
+PERSISTENCE_WORKER = PersistenceWorker()
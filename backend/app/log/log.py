@@ -1,4 +1,6 @@
 import os
+import queue
+import atexit
 import logging
 import logging.handlers as handlers
 
@@ -6,10 +8,17 @@ from ..setup import LOG_DIR, LOG_FILE
 from ..core.utils import get_map_from_file
 
 
+# max records waiting for a listener thread, new records are dropped (and counted) if the disk stalls
+QUEUE_SIZE = 10000
+# name -> QueueListener writing the records of the logger
+LISTENERS = {}
+
+
 class LOG_TYPE:
     LOCAL = 'local'
     MIDDLEWARE = 'middleware'
     TIMEIT = 'timeit'
+    TRACE = 'trace'
 
 
 class LOG_LEVEL:
@@ -21,46 +30,117 @@ class LOG_LEVEL:
     CRITICAL = 'CRITICAL' 
 
 
-def get_log(name=LOG_TYPE.LOCAL):
+class LogQueueHandler(handlers.QueueHandler):
+    """Put the records in the queue of a QueueListener thread, which formats and writes them (file I/O and rotation).
+    The records stay in the process, so they are not formatted here: only the message args are merged.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the args may change after the call
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def get_level(level: str):
+    level = level.strip()
+    if level == LOG_LEVEL.NOTSET:
+        return logging.NOTSET
+    elif level == LOG_LEVEL.DEBUG:
+        return logging.DEBUG
+    elif level == LOG_LEVEL.INFO:
+        return logging.INFO
+    elif level == LOG_LEVEL.WARNING:
+        return logging.WARNING
+    elif level == LOG_LEVEL.ERROR:
+        return logging.ERROR
+    elif level == LOG_LEVEL.CRITICAL:
+        return logging.CRITICAL
+    return logging.INFO
+
+def get_handlers(name=LOG_TYPE.LOCAL, log_dir=LOG_DIR):
+    """
+    Create the handlers of a log config (app/conf/log/<name>.conf).
+    Args:
+        name (str): log type
+        log_dir (str): folder of the log files
+    Returns:
+        (level, handlers): level of the logger, file (+ console) handlers
+    """
     config = LOG_FILE.format(name)
-    log = logging.getLogger(name)
     settingmaps = get_map_from_file(config)
 
     logTemplate = settingmaps["template"]
     logFormatter = logging.Formatter(logTemplate)
 
     outFile = settingmaps["outfile"].strip()
-    outPath = os.path.join(LOG_DIR, outFile)
+    outPath = os.path.join(log_dir, outFile)
 
-    fileHandler = logging.FileHandler(outPath, encoding="utf-8")
     fileHandler = handlers.TimedRotatingFileHandler(outPath, when="midnight", interval=1, encoding="utf-8")
     fileHandler.suffix = "%Y%m%d.log"
     fileHandler.terminator = ""
     fileHandler.setFormatter(logFormatter)
-
-    level = settingmaps["level"].strip()
-
-    if level == LOG_LEVEL.NOTSET:
-        log.setLevel(logging.NOTSET)
-    elif level == LOG_LEVEL.DEBUG:
-        log.setLevel(logging.DEBUG)
-    elif level == LOG_LEVEL.INFO:
-        log.setLevel(logging.INFO)
-    elif level == LOG_LEVEL.WARNING:
-        log.setLevel(logging.WARNING)
-    elif level == LOG_LEVEL.ERROR:
-        log.setLevel(logging.ERROR)
-    elif level == LOG_LEVEL.CRITICAL:
-        log.setLevel(logging.CRITICAL)
-    else:
-        log.setLevel(logging.INFO)
-    log.addHandler(fileHandler)
+    logHandlers = [fileHandler]
 
     to_console = settingmaps["console"].strip()
     if str(to_console).upper() == str(True).upper():
         consoleHandler = logging.StreamHandler()
         consoleHandler.terminator = ""
         consoleHandler.setFormatter(logFormatter)
-        log.addHandler(consoleHandler)
+        logHandlers.append(consoleHandler)
+
+    return get_level(settingmaps["level"]), logHandlers
+
+def get_log(name=LOG_TYPE.LOCAL):
+    """
+    Get the logger of a log config. The logger only enqueues the records (level check on the calling thread),
+    a QueueListener thread per logger formats and writes them.
+    """
+    log = logging.getLogger(name)
+    if name in LISTENERS:
+        return log
+    level, logHandlers = get_handlers(name)
+    log.setLevel(level)
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    listener = handlers.QueueListener(log_queue, *logHandlers)
+    listener.start()
+    LISTENERS[name] = listener
+    log.addHandler(LogQueueHandler(log_queue))
+    return log
+
+def get_dropped() -> dict:
+    """
+    Records dropped by the full queues, per logger.
+    Returns:
+        dropped (dict): name -> number of records
+    """
+    dropped = {}
+    for name in LISTENERS:
+        for handler in logging.getLogger(name).handlers:
+            if isinstance(handler, LogQueueHandler):
+                dropped[name] = dropped.get(name, 0) + handler.dropped
+    return dropped
+
+def stop_logging():
+    """
+    Write the queued records and stop the listener threads.
+    """
+    while LISTENERS:
+        _, listener = LISTENERS.popitem()
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
 
-    return log
\ No newline at end of file
+atexit.register(stop_logging)
@@ -0,0 +1,155 @@
+import bisect
+import threading
+from abc import ABC, abstractmethod
+
+from .log import get_dropped
+
+
+PREFIX = "madame_lan"
+# log-scale latency buckets (seconds): 1 ms to 65.5 s, doubling
+BUCKETS = tuple(0.001 * 2 ** i for i in range(17))
+# all metrics in the order of the /metrics output
+METRICS = []
+
+
+def format_labels(names, values, extra=""):
+    labels = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """Metric with values per label values, kept in per-thread shards: the updates of a thread only touch its own dict
+    (no lock on the hot path), the shards are summed when the metrics are rendered.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = "{}_{}".format(PREFIX, name)
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def get_shard(self) -> dict:
+        shard = getattr(self.local, "values", None)
+        if shard is None:
+            shard = {}
+            self.local.values = shard
+            # only a new thread takes the lock
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    @abstractmethod
+    def collect(self) -> dict:
+        """
+        Returns:
+            values (dict): label values (tuple) -> value of the metric, summed over the shards
+        """
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for labels, value in sorted(self.collect().items()):
+            lines.append("{}{} {}".format(self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, value=1):
+        shard = self.get_shard()
+        shard[labels] = shard.get(labels, 0) + value
+
+    def collect(self):
+        values = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for labels, value in list(shard.items()):
+                values[labels] = values.get(labels, 0) + value
+        return values
+
+
+class Histogram(Metric):
+    """Histogram with fixed buckets, counts per bucket (+Inf last) and the sum of the observed values.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        shard = self.get_shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # bucket counts, +Inf count, sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        values = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for labels, counts in list(shard.items()):
+                total = values.setdefault(labels, [0] * len(counts))
+                for i, count in enumerate(list(counts)):
+                    total[i] += count
+        return values
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for labels, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for le, count in zip(["{:g}".format(b) for b in self.buckets] + ["+Inf"], counts[:-1]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, format_labels(self.label_names, labels, 'le="{}"'.format(le)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.label_names, labels), format_value(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.label_names, labels), cumulative))
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Counter/gauge read at render time from the stats of another component.
+    callback returns a dict: label values (tuple) -> value.
+    """
+    def __init__(self, name: str, documentation: str, label_names=(), callback=None, kind="gauge"):
+        super().__init__(name, documentation, label_names)
+        self.callback = callback
+        self.kind = kind
+
+    def collect(self):
+        return self.callback() if self.callback is not None else {}
+
+
+def render_metrics() -> str:
+    """
+    Render all metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in METRICS:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append("# {} failed: {}".format(metric.name, type(e).__name__))
+    return "\n".join(lines) + "\n"
+
+
+FUNCTION_SECONDS = Histogram("function_seconds", "Duration of the functions decorated by timeit/async_timeit.", ["function"])
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens of the Azure OpenAI calls (prompt/completion/embedding).", ["model", "type"])
+SEARCH_CALLS = Counter("search_calls_total", "Search calls of the search tool.", ["type", "status"])
+RATE_LIMITED = Counter("rate_limited_total", "Requests rejected by the rate limit of the access tokens.", ["name"])
+TTS_CHARACTERS = Counter("tts_characters_total", "Characters sent to speech synthesis (audio cache misses).", ["voice"])
+LOG_RECORDS_DROPPED = CallbackMetric("log_records_dropped_total", "Log records dropped by the full log queues (stalled log volume).", ["logger"],
+                                     callback=lambda: {(name,): dropped for name, dropped in get_dropped().items()}, kind="counter")
@@ -1,36 +1,80 @@
 import time
+import random
+import logging
 import traceback
 
 from fastapi import Request, status
+from starlette.datastructures import MutableHeaders
 from starlette.middleware.base import BaseHTTPMiddleware
 
 
 from .log import get_log, LOG_TYPE
+from .trace import start_trace, end_trace
+from ..setup import LOG_FILE
+from ..core.utils import get_map_from_file
 
 
 LOGGER = get_log(name=LOG_TYPE.MIDDLEWARE)
+SETTINGS = get_map_from_file(LOG_FILE.format(LOG_TYPE.MIDDLEWARE))
+# share of the requests logged (INFO: one line per request, DEBUG: + request headers), errors are always logged
+SAMPLE_RATE = float(SETTINGS.get("sample", "1.0").strip())
 
 
 class LogMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, sample_rate: float = SAMPLE_RATE):
+        super().__init__(app)
+        self.sample_rate = sample_rate
+
     async def dispatch(self, request: Request, call_next):
         try:
             response = None
-            LOGGER.info("Request:")
-            LOGGER.info("request.method: {}".format(request.method))
-            LOGGER.info("request.url: {}".format(request.url))
-            LOGGER.info("request.headers: {}".format(request.headers))
-            LOGGER.info("request.headers.clientid: {}".format(request.headers.get("clientid", "")))
-            start_time = time.time()
+            sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+            if sampled and LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("request.headers: {}".format(request.headers))
+            start_time = time.perf_counter()
             response = await call_next(request)
-            process_time = time.time() - start_time
+            process_time = time.perf_counter() - start_time
             response.headers["X-Process-Time"] = str(f'{process_time:0.4f} sec')
-            if response.status_code == status.HTTP_400_BAD_REQUEST:
-                LOGGER.error("Exception: {}".format(response))
-            LOGGER.info("Response:")
-            LOGGER.info("response.status_code: {}".format(response.status_code))
-            LOGGER.info("X-Process-Time: {}\n".format(response.headers.get("X-Process-Time", "")))
+            if response.status_code == status.HTTP_400_BAD_REQUEST or response.status_code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+                LOGGER.error("Exception: {} {} - clientid={} - status_code={} - X-Process-Time={}".format(
+                    request.method, request.url, request.headers.get("clientid", ""), response.status_code, response.headers["X-Process-Time"]))
+            elif sampled and LOGGER.isEnabledFor(logging.INFO):
+                LOGGER.info("{} {} - clientid={} - status_code={} - X-Process-Time={}".format(
+                    request.method, request.url, request.headers.get("clientid", ""), response.status_code, response.headers["X-Process-Time"]))
         except Exception as e:
             exc_traceback = traceback.format_exc()
             LOGGER.error("Exception: {}".format(e))
             LOGGER.error("Traceback: {}".format(exc_traceback))
         return response
+
+
+class TraceMiddleware:
+    """Trace every HTTP request (root span) and summarize the stages finished before the response headers in the
+    Server-Timing header. Streamed responses send their headers first: their later stages are only in the exported trace.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = start_trace(scope["method"], **{"http.method": scope["method"]})
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                trace.root.set("http.status_code", message["status"])
+                MutableHeaders(scope=message).append("Server-Timing", trace.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        except Exception as e:
+            trace.root.error(e)
+            raise
+        finally:
+            # route template, the path has the access token
+            route = getattr(scope.get("route"), "path", scope["path"])
+            trace.root.name = "{} {}".format(scope["method"], route)
+            trace.root.set("http.route", route)
+            end_trace(trace)
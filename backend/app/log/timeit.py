@@ -1,35 +1,48 @@
 import os
 import time
+import logging
 import functools
 from datetime import datetime
 
 from app.log.log import get_log, LOG_TYPE
+from app.log.metrics import FUNCTION_SECONDS
 
 LOGGER = get_log(name=LOG_TYPE.TIMEIT)
 
 
+def get_function_name(func):
+    return "{} - {}()".format(os.path.basename(func.__code__.co_filename), func.__qualname__)
+
 def timeit():
     def decorator(func):
+        name = get_function_name(func)
+
         @functools.wraps(func)
         def timeit(*args, **kwargs):
             ts = time.perf_counter()
-            result = func(*args, **kwargs)
-            te = time.perf_counter()
-            LOGGER.debug("[{} - {}()] took {:.4f} sec.".format(os.path.basename(func.__code__.co_filename),
-                                                     func.__qualname__, te-ts))
-            return result
+            try:
+                return func(*args, **kwargs)
+            finally:
+                te = time.perf_counter()
+                FUNCTION_SECONDS.observe(te - ts, name)
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug("[{}] took {:.4f} sec.".format(name, te-ts))
         return timeit
     return decorator
 
 def async_timeit():
     def decorator(func):
+        name = get_function_name(func)
+
         @functools.wraps(func)
         async def timeit(*args, **kwargs):
             ts = time.perf_counter()
-            result = await func(*args, **kwargs)
-            te = time.perf_counter()
-            LOGGER.debug("[{} - {}()] took {:.4f} sec.".format(os.path.basename(func.__code__.co_filename),
-                                                     func.__qualname__, te-ts))
-            return result
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                te = time.perf_counter()
+                FUNCTION_SECONDS.observe(te - ts, name)
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug("[{}] took {:.4f} sec.".format(name, te-ts))
         return timeit
     return decorator
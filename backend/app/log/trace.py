@@ -0,0 +1,266 @@
+import time
+import json
+import random
+import asyncio
+import contextvars
+
+from .log import get_log, LOG_TYPE
+from ..setup import LOG_FILE
+from ..core.utils import get_map_from_file
+
+
+SERVICE_NAME = "madame_lan"
+SETTINGS = get_map_from_file(LOG_FILE.format(LOG_TYPE.TRACE))
+# share of the traces exported, traces slower than SLOW_THRESHOLD (seconds) are always exported
+SAMPLE_RATE = float(SETTINGS.get("sample", "1.0").strip())
+SLOW_THRESHOLD = float(SETTINGS.get("slow", "5").strip())
+# none, file (one OTLP/JSON line per trace in the log folder) or otlp (POST to the OTLP/HTTP endpoint of a collector)
+EXPORT = SETTINGS.get("export", "file").strip()
+ENDPOINT = SETTINGS.get("endpoint", "").strip()
+# seconds between two POSTs to the collector
+EXPORT_INTERVAL = 2.0
+
+CURRENT_TRACE = contextvars.ContextVar("trace", default=None)
+CURRENT_SPAN = contextvars.ContextVar("span", default=None)
+
+# span status codes of OTLP
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+
+class Span:
+    """One stage of a request: name, start/end times, attributes (str/int/float/bool) and error status.
+    Used as a context manager, the span is the current span (parent of the spans started inside) until it exits.
+    """
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "start", "end", "attributes", "status", "message", "token")
+
+    def __init__(self, trace, name: str, parent_id: str, attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = "{:016x}".format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = attributes
+        self.status = STATUS_UNSET
+        self.message = ""
+        self.token = None
+
+    def __enter__(self):
+        self.token = CURRENT_SPAN.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.error(exc)
+        CURRENT_SPAN.reset(self.token)
+        self.finish()
+        return False
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+        return self
+
+    def error(self, e: Exception):
+        self.status = STATUS_ERROR
+        self.message = "{}: {}".format(type(e).__name__, e)
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+            self.trace.spans.append(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class NoopSpan:
+    """Span of the code running outside of a traced request.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key, value):
+        return self
+
+    def error(self, e):
+        pass
+
+    def finish(self):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace:
+    """Spans of one request. The spans of the tasks started by the request are added to the same trace
+    (the tasks copy the context).
+    """
+    def __init__(self, name: str, attributes: dict = None):
+        self.trace_id = "{:032x}".format(random.getrandbits(128))
+        self.spans = []
+        self.root = Span(self, name, "", attributes or {})
+
+    def server_timing(self) -> str:
+        """
+        Summarize the finished spans for the Server-Timing header: duration (ms) per span name, summed over the spans
+        with the same name, and the time of the request so far (total).
+        """
+        durations = {}
+        for span in list(self.spans):
+            total, count = durations.get(span.name, (0.0, 0))
+            durations[span.name] = (total + span.duration, count + 1)
+        metrics = []
+        for name, (total, count) in durations.items():
+            metric = "{};dur={:.1f}".format(name, total * 1000)
+            if count > 1:
+                metric += ';desc="{} calls"'.format(count)
+            metrics.append(metric)
+        metrics.append("total;dur={:.1f}".format(self.root.duration * 1000))
+        return ", ".join(metrics)
+
+
+def get_value(value) -> dict:
+    # AnyValue of OTLP/JSON, 64-bit integers are strings
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def to_otlp(span: Span) -> dict:
+    end_ns = span.start_ns + int(span.duration * 1e9)
+    data = {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # server for the request, internal for the stages
+        "kind": 1 if span.parent_id else 2,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [{"key": key, "value": get_value(value)} for key, value in span.attributes.items()],
+        "status": {"code": span.status, "message": span.message} if span.status else {}
+    }
+    if span.parent_id:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+def to_request(traces: list) -> dict:
+    """
+    Build the body of an OTLP/HTTP JSON export request (ExportTraceServiceRequest) of the traces.
+    """
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "app.log.trace"},
+                "spans": [to_otlp(span) for trace in traces for span in trace.spans]
+            }]
+        }]
+    }
+
+
+class FileExporter:
+    """Write one OTLP/JSON line per trace to the trace log (queued logger, written by its listener thread).
+    """
+    def __init__(self):
+        self.log = get_log(name=LOG_TYPE.TRACE)
+
+    def export(self, trace: Trace):
+        self.log.info(json.dumps(to_request([trace]), ensure_ascii=False, separators=(",", ":")))
+
+
+class OTLPExporter:
+    """POST the traces to the OTLP/HTTP endpoint of a collector (<endpoint>/v1/traces), batched every EXPORT_INTERVAL.
+    """
+    def __init__(self, endpoint: str, interval: float = EXPORT_INTERVAL, max_pending: int = 1000):
+        self.url = endpoint.rstrip("/")
+        if not self.url.endswith("/v1/traces"):
+            self.url += "/v1/traces"
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.task = None
+        self.log = get_log(name=LOG_TYPE.LOCAL)
+
+    def export(self, trace: Trace):
+        if len(self.pending) >= self.max_pending:
+            return
+        self.pending.append(trace)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(self.interval)
+        traces, self.pending = self.pending, []
+        from ..core.http import get_http_session
+        try:
+            async with get_http_session().post(self.url, json=to_request(traces)) as response:
+                response.raise_for_status()
+        except Exception as e:
+            self.log.warning("Export of {} traces to {} failed: {}".format(len(traces), self.url, e))
+
+
+def create_exporter(export: str = EXPORT):
+    if export == "file":
+        return FileExporter()
+    if export == "otlp" and ENDPOINT:
+        return OTLPExporter(ENDPOINT)
+    return None
+
+
+EXPORTER = create_exporter()
+
+
+def start_trace(name: str, **attributes) -> Trace:
+    """
+    Start the trace of a request in the current context, its root span is the current span.
+    """
+    trace = Trace(name, attributes)
+    CURRENT_TRACE.set(trace)
+    CURRENT_SPAN.set(trace.root)
+    return trace
+
+def end_trace(trace: Trace, sample_rate: float = SAMPLE_RATE, slow_threshold: float = SLOW_THRESHOLD):
+    """
+    Finish the root span and export the trace if it is sampled or slow.
+    """
+    trace.root.finish()
+    if EXPORTER is None:
+        return
+    if trace.root.duration >= slow_threshold or random.random() < sample_rate:
+        try:
+            EXPORTER.export(trace)
+        except Exception:
+            # the export never fails the request
+            pass
+
+def start_span(name: str, **attributes):
+    """
+    Start a span which is not the current span (e.g. around an async generator), finished by span.finish().
+    Returns:
+        Span: NOOP_SPAN outside of a traced request
+    """
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        return NOOP_SPAN
+    parent = CURRENT_SPAN.get()
+    return Span(trace, name, parent.span_id if parent is not None else trace.root.span_id, attributes)
+
+def span(name: str, **attributes):
+    """
+    Record a stage of the request, the span is the parent of the spans started inside.
+    Usage:
+        with span("embedding", model=model) as s:
+            ...
+            s.set("cache_hit", True)
+    """
+    return start_span(name, **attributes)
@@ -1,17 +1,17 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from starlette.responses import Response
 
 from app.config import LOGGER
-from app.core.authentication import check_authentication
-from app.utils.service_result import handle_result
+from app.core.authentication import authenticate
+from app.utils.service_result import ServiceResult, handle_result
 
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(authenticate)])
 
 
 @router.post("/api/authentication/{access_token}")
 def authentication(access_token: str) -> Response:
     LOGGER.info("Request:")
-    response = check_authentication(access_token)
+    response = ServiceResult({"access_token": access_token})
     LOGGER.info("Response: response={}".format(response.value))
     return handle_result(response)
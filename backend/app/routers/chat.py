@@ -1,9 +1,17 @@
-from fastapi import APIRouter, HTTPException, Header, Body
+import json
+
+from fastapi import APIRouter, HTTPException, Header, Body, Depends
+from starlette.responses import StreamingResponse
 
 from app.config import APP_PATH, LOGGER, async_timeit, Config
-from app.core.speech import generate_speech_audio, remove_emoji, replace_markdown_links_with_urls
-from app.core.agent import Smart_Agent, FUNCTIONS_SPEC, AVAILABLE_FUNCTIONS, PERSONA, AzureOpenAIClient
-from app.core.authentication import check_authentication
+from app.core.speech import generate_speech_audio, remove_emoji, replace_markdown_links_with_urls, SpeechPipeline
+from app.core.agent import Smart_Agent, FUNCTIONS_SPEC, AVAILABLE_FUNCTIONS, PERSONA, get_embedding
+from app.core.cache import ANSWER_CACHE, EMBEDDING_CACHE
+from app.core.history import HISTORY_WINDOW
+from app.core.tokens import count_message_tokens, count_prompt_tokens
+from app.core.speech import AUDIO_CACHE_STATS
+from app.core.authentication import authenticate
+from app.log.trace import span
 # from app.core.prompt import IMAGE_SEARCH_PROMPT, IMAGE_SEARCH_HISTORY
 from app.utils.app_exceptions import AppExceptionCase
 from app.utils.service_result import ServiceResult
@@ -17,7 +25,7 @@ bing_subscription_key = "ac992e2236804d2b8324dee96eed10f5"
 bing_endpoint = "https://api.bing.microsoft.com/v7.0/search"
 bing_image = "https://api.bing.microsoft.com/v7.0/images/search"
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(authenticate)])
 
 Agent = Smart_Agent(
     persona=PERSONA,
@@ -46,6 +54,137 @@ class CustomizedMultiThread(Thread):
         return self._return
 
 
+async def get_conversation(access_token: str, client_id: str, user_query: str, voice_code: str):
+    """
+    Build the messages to ask: system prompt + latest conversations within the history token budget + user query.
+    Returns:
+        (current_promt, conversation)
+    """
+    with span("prompt") as s:
+        # load the session from the database after a restart or from another worker
+        with span("rehydrate"):
+            await DB.rehydrate_client(access_token, client_id)
+        current_promt = Agent.get_current_prompt(voice_code)
+        # get latest conversation
+        with span("history") as h:
+            history, stats = HISTORY_WINDOW.build(access_token, client_id, await DB.get_latest_turns(access_token, client_id))
+            h.set("turns", stats["turns"]).set("kept", stats["kept"]).set("summary_tokens", stats["summary_tokens"])
+        conversation = [{"role": str(Role.SYSTEM), "content": current_promt}] + history
+        conversation += [{"role": str(Role.USER), "content": user_query}]
+        system_tokens = count_prompt_tokens(current_promt)
+        user_tokens = count_message_tokens(user_query)
+        total_tokens = system_tokens + stats["tokens"] + stats["summary_tokens"] + user_tokens
+        s.set("prompt_tokens", total_tokens).set("history_tokens", stats["tokens"])
+    LOGGER.info("Prompt tokens: total={} - system={} - history={} ({}/{} conversations) - summary={} - user={}".format(
+        total_tokens, system_tokens, stats["tokens"], stats["kept"], stats["turns"], stats["summary_tokens"], user_tokens))
+    return current_promt, conversation
+
+async def get_cached_answer(user_query: str, voice_code: str, conversation: list):
+    """
+    Look up the answer cache, only for queries without conversation history.
+    Returns:
+        (embedding, cached, index_version): embedding of the query (None if bypassed), cached reply (None if missed),
+        version of the search index at the lookup (the reply is not cached if the index changed meanwhile)
+    """
+    # system prompt + user query only
+    if not ANSWER_CACHE.enabled or len(conversation) > 2:
+        return None, None, None
+    with span("answer_cache") as s:
+        try:
+            embedding = await get_embedding(user_query)
+        except Exception as e:
+            LOGGER.error("Exception: {}".format(e))
+            s.error(e)
+            return None, None, None
+        cached = ANSWER_CACHE.get(voice_code, embedding)
+        s.set("cache_hit", cached is not None)
+    return embedding, cached, ANSWER_CACHE.index_version
+
+def put_cached_answer(user_query: str, voice_code: str, embedding: list, assistant_reply: str, image_links: list,
+                      index_version: float):
+    if embedding is None:
+        return
+    # never cache the fallback reply of chat exceptions
+    if assistant_reply in (Config.CHAT_EXCEPTION.get(voice_code), Config.CHAT_EXCEPTION_DEFAULT):
+        return
+    ANSWER_CACHE.put(voice_code, user_query, embedding, assistant_reply, image_links, index_version)
+
+def get_image_paths(image_links):
+    return image_links[:3] if len(image_links) > 3 else image_links
+
+async def iter_cached_answer(cached: dict):
+    yield "delta", cached["reply"]
+    yield "done", (cached["reply"], cached["image_links"])
+
+def sse_event(event: str, data) -> str:
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data, ensure_ascii=False))
+
+async def get_chat_stream(access_token: str, client_id: str, user_query: str, voice_code: str):
+    """
+    Stream the reply as Server-Sent Events.
+    Events: delta (content chunk), reset (discard streamed content), audio_segment (audio of a finished sentence),
+    metadata (reply/history/images), audio (all audio paths in order), error, done.
+    """
+    try:
+        current_promt, conversation = await get_conversation(access_token, client_id, user_query, voice_code)
+        messages = conversation.copy()
+
+        # ask chat, forward the reply deltas and synthesize every finished sentence
+        speech = SpeechPipeline(voice_code)
+        audio_paths = []
+        assistant_reply, image_links = "", []
+        embedding, cached, index_version = await get_cached_answer(user_query, voice_code, conversation)
+        if cached is not None:
+            events = iter_cached_answer(cached)
+        else:
+            events = Agent.run_stream(voice_code, conversation)
+        async for event, value in events:
+            if event == "delta":
+                yield sse_event("delta", {"content": value})
+                speech.feed(value)
+            elif event == "reset":
+                yield sse_event("reset", {})
+                speech.reset()
+                audio_paths = []
+            elif event == "done":
+                assistant_reply, image_links = value
+            for audio_path in speech.ready():
+                audio_paths.append(audio_path.replace(APP_PATH, ""))
+                yield sse_event("audio_segment", {"index": len(audio_paths) - 1, "audio_path": audio_paths[-1]})
+        if cached is None:
+            put_cached_answer(user_query, voice_code, embedding, assistant_reply, image_links, index_version)
+
+        # update db ystem-prompt/user-query/assistant-reply
+        with span("add_conversation"):
+            await DB.add_conversation(access_token, client_id, voice_code, current_promt, user_query, assistant_reply)
+
+        # post procesing assistant-reply texts
+        with span("postprocess"):
+            assistant_reply = replace_markdown_links_with_urls(assistant_reply)
+            plain_text = remove_emoji(assistant_reply)
+        assistant_reply = assistant_reply if Config.SEARCH_WITH_EMOTION else plain_text
+        messages += [{"role": str(Role.ASSISTANT), "content": assistant_reply}]
+        yield sse_event("metadata", {
+            "assistant_reply": {
+                "role": "assistant",
+                "user_query": user_query,
+                "content": assistant_reply
+            },
+            "history": messages,
+            "image_paths": get_image_paths(image_links),
+            "link_paths": []
+        })
+
+        # wait for the audio of the last sentences
+        async for audio_path in speech.finish():
+            audio_paths.append(audio_path.replace(APP_PATH, ""))
+            yield sse_event("audio_segment", {"index": len(audio_paths) - 1, "audio_path": audio_paths[-1]})
+        yield sse_event("audio", {"audio_paths": audio_paths})
+    except Exception as e:
+        LOGGER.error("Exception: {}".format(e))
+        yield sse_event("error", {"context": str(e)})
+    yield sse_event("done", {})
+
 async def get_chat(access_token: str, client_id: str, user_query: str, voice_code: str) -> ServiceResult:
 
 
@@ -54,26 +193,29 @@ async def get_chat(access_token: str, client_id: str, user_query: str, voice_cod
         if not user_query:
             return ServiceResult(AppExceptionCase(status_code=400, context="user_query in body is required"))
 
-        current_promt = Agent.get_current_prompt(voice_code)
-        # get latest conversation
-        conversation = DB.get_latest_conversations(access_token, client_id)
-        conversation = [{"role": str(Role.SYSTEM), "content": current_promt}] + conversation
-        conversation += [{"role": str(Role.USER), "content": user_query}]
+        current_promt, conversation = await get_conversation(access_token, client_id, user_query, voice_code)
         messages = conversation.copy()
 
         # ask chat
-        assistant_reply, image_links = await Agent.run(voice_code, conversation)
+        embedding, cached, index_version = await get_cached_answer(user_query, voice_code, conversation)
+        if cached is not None:
+            assistant_reply, image_links = cached["reply"], cached["image_links"]
+        else:
+            assistant_reply, image_links = await Agent.run(voice_code, conversation)
+            put_cached_answer(user_query, voice_code, embedding, assistant_reply, image_links, index_version)
         
         # update db ystem-prompt/user-query/assistant-reply
-        DB.add_conversation(access_token, client_id, voice_code, current_promt, user_query, assistant_reply)
+        with span("add_conversation"):
+            await DB.add_conversation(access_token, client_id, voice_code, current_promt, user_query, assistant_reply)
 
 
         # post procesing assistant-reply texts
-        assistant_reply = replace_markdown_links_with_urls(assistant_reply)
-        plain_text = remove_emoji(assistant_reply)
+        with span("postprocess"):
+            assistant_reply = replace_markdown_links_with_urls(assistant_reply)
+            plain_text = remove_emoji(assistant_reply)
         # generate audio
         audio_path = await generate_speech_audio(plain_text, voice_code)
-        audio_path = audio_path.replace(APP_PATH, "")
+        audio_path = audio_path.replace(APP_PATH, "") if audio_path else ""
 
         # response reply by emition config
         assistant_reply = assistant_reply if Config.SEARCH_WITH_EMOTION else plain_text
@@ -91,9 +233,7 @@ async def get_chat(access_token: str, client_id: str, user_query: str, voice_cod
         # print('\n'.join(image_paths))
         # image_paths = await get_image_internet_search(assistant_reply)
         link_paths = []
-        image_paths = image_links
-        if len(image_paths) > 3:
-            image_paths = image_paths[:3] 
+        image_paths = get_image_paths(image_links)
         data={
             "assistant_reply": assistant_reply_obj,
             "audio_path": audio_path,
@@ -114,10 +254,33 @@ async def chat(access_token: str,
                voice_code: str = Body(..., embed=True)
                ):
     LOGGER.info("Request: \naccess_token={}\nclient_id={}\nvoice_code={}\nuser_query={}".format(access_token, ClientId, voice_code, user_query))
-    authen = check_authentication(access_token)
-    if not check_authentication(access_token).success:
-        return handle_result(authen)
-
     response = await get_chat(access_token, ClientId, user_query, voice_code)
     LOGGER.info("Response: \naccess_token={}\nclient_id={}\nvoice_code={}\nresponse={}".format(access_token, ClientId, voice_code, response.value))
     return handle_result(response)
+
+@router.post("/api/askStream/{access_token}")
+async def chat_stream(access_token: str,
+                      ClientId: str = Header(...),
+                      user_query: str = Body(..., embed=True),
+                      voice_code: str = Body(..., embed=True)
+                      ):
+    LOGGER.info("Request: \naccess_token={}\nclient_id={}\nvoice_code={}\nuser_query={}".format(access_token, ClientId, voice_code, user_query))
+    user_query = user_query.strip()
+    if not user_query:
+        return handle_result(ServiceResult(AppExceptionCase(status_code=400, context="user_query in body is required")))
+
+    return StreamingResponse(get_chat_stream(access_token, ClientId, user_query, voice_code),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# The API route to get hit/miss counters of the caches
+@router.get("/api/getCacheStats/{access_token}")
+async def get_cache_stats(access_token: str):
+    LOGGER.info("Request:")
+    data = {
+        "answer_cache": ANSWER_CACHE.stats(),
+        "embedding_cache": EMBEDDING_CACHE.stats(),
+        "audio_cache": dict(AUDIO_CACHE_STATS)
+    }
+    LOGGER.info("Response: response={}".format(data))
+    return handle_result(ServiceResult(data))
@@ -1,30 +1,30 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from starlette.responses import Response
 
 from app.config import LOGGER
-from app.core.authentication import check_authentication
+from app.core.authentication import authenticate
 from app.utils.app_exceptions import AppExceptionCase
 from app.utils.service_result import ServiceResult
 from app.utils.service_result import handle_result
 from app.db.api import DB
 
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(authenticate)])
 
-def create_client(access_token: str) -> ServiceResult:
+async def create_client(access_token: str) -> ServiceResult:
     try:
         data = {}
-        client_id = DB.create(access_token)
+        client_id = await DB.create(access_token)
         data = {'client_id': str(client_id)}
     except Exception as e:
         LOGGER.error("Exception: {}".format(e))
         return ServiceResult(AppExceptionCase(status_code=400, context=str(e)))
     return ServiceResult(data)
 
-def update_client(access_token: str, client_id: str) -> ServiceResult:
+async def update_client(access_token: str, client_id: str) -> ServiceResult:
     try:
         data = {}
-        client_id = DB.update(access_token, client_id)
+        client_id = await DB.update(access_token, client_id)
         data = {'client_id': str(client_id)}
     except Exception as e:
         LOGGER.error("Exception: {}".format(e))
@@ -34,21 +34,21 @@ def update_client(access_token: str, client_id: str) -> ServiceResult:
 @router.get("/api/getClientId/{access_token}")
 async def getClientId(access_token: str) -> Response:
     LOGGER.info("Request:")
-    authen = check_authentication(access_token)
-    if not check_authentication(access_token).success:
-        return handle_result(authen)
-
-    response = create_client(access_token)
+    response = await create_client(access_token)
     LOGGER.info("Response: response={}".format(response.value))
     return handle_result(response)
 
+# The API route to get gauges of the sessions (count/approximate bytes)
+@router.get("/api/getSessionStats/{access_token}")
+async def get_session_stats(access_token: str):
+    LOGGER.info("Request:")
+    data = await DB.get_session_stats()
+    LOGGER.info("Response: response={}".format(data))
+    return handle_result(ServiceResult(data))
+
 @router.put("/api/getClientId/{access_token}")
 async def getClientId(access_token: str, client_id: str) -> Response:
     LOGGER.info("Request:")
-    authen = check_authentication(access_token)
-    if not check_authentication(access_token).success:
-        return handle_result(authen)
-
-    response = update_client(access_token, client_id)
+    response = await update_client(access_token, client_id)
     LOGGER.info("Response: response={}".format(response.value))
     return handle_result(response)
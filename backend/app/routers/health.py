@@ -0,0 +1,24 @@
+from fastapi import APIRouter
+from starlette.responses import Response
+
+from app.core.services import SERVICES
+from app.utils.app_exceptions import AppException
+from app.utils.service_result import ServiceResult
+from app.utils.service_result import handle_result
+
+
+router = APIRouter()
+
+
+# The API route of the liveness probe: the process serves requests
+@router.get("/health/live")
+async def get_liveness() -> Response:
+    return handle_result(ServiceResult({"status": "alive"}))
+
+# The API route of the readiness probe: all required clients are built (503 with their states otherwise)
+@router.get("/health/ready")
+async def get_readiness() -> Response:
+    if not SERVICES.is_ready():
+        SERVICES.retry_failed()
+        return handle_result(ServiceResult(AppException.ServiceUnavailable(SERVICES.report())))
+    return handle_result(ServiceResult(SERVICES.report()))
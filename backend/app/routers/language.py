@@ -1,15 +1,16 @@
 from operator import itemgetter
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Request
 from starlette.responses import Response
 
-from app.config import Config, LOGGER
-from app.core.authentication import check_authentication
+from app.config import Config, LOGGER, load_languages
+from app.core.authentication import authenticate_token
 from app.utils.app_exceptions import AppExceptionCase
 from app.utils.service_result import ServiceResult
 from app.utils.service_result import handle_result
+from app.utils.cached_response import PrecomputedResponse
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(authenticate_token)])
 
 
 def get_languages() -> ServiceResult:
@@ -55,26 +56,24 @@ def get_logo() -> ServiceResult:
         return ServiceResult(AppExceptionCase(status_code=400, context=str(e)))
     return ServiceResult(data)
 
+# static responses, rebuilt when the YAML files change
+LANGUAGE_LIST = PrecomputedResponse(lambda: handle_result(get_languages()), Config.LANGUAGE_FILES, reload=load_languages,
+                                    check_interval=Config.CONFIG_RELOAD_INTERVAL, max_age=Config.STATIC_CACHE_MAX_AGE)
+LOGO_IMAGES = PrecomputedResponse(lambda: handle_result(get_logo()), [Config.LOGO_PATH], reload=load_languages,
+                                  check_interval=Config.CONFIG_RELOAD_INTERVAL, max_age=Config.STATIC_CACHE_MAX_AGE)
+
 # The API route to get language list
 @router.get("/api/getLanguageList/{access_token}")
-async def get_language_list(access_token: str) -> Response:
+async def get_language_list(access_token: str, request: Request) -> Response:
     LOGGER.info("Request:")
-    authen = check_authentication(access_token)
-    if not check_authentication(access_token).success:
-        return handle_result(authen)
-
-    response = get_languages()
-    LOGGER.info("Response: response={}".format(response.value))
-    return handle_result(response)
+    response = LANGUAGE_LIST.response(request)
+    LOGGER.info("Response: status_code={} - etag={}".format(response.status_code, LANGUAGE_LIST.etag))
+    return response
 
 # The API route to get logo images
 @router.get("/api/getLogoImages/{access_token}")
-async def get_logo_images(access_token: str) -> Response:
+async def get_logo_images(access_token: str, request: Request) -> Response:
     LOGGER.info("Request:")
-    authen = check_authentication(access_token)
-    if not check_authentication(access_token).success:
-        return handle_result(authen)
-
-    response = get_logo()
-    LOGGER.info("Response: response={}".format(response.value))
-    return handle_result(response)
+    response = LOGO_IMAGES.response(request)
+    LOGGER.info("Response: status_code={} - etag={}".format(response.status_code, LOGO_IMAGES.etag))
+    return response
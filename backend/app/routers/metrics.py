@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends
+from starlette.responses import Response
+
+from app.config import LOGGER
+from app.core.authentication import authenticate_token
+from app.core.cache import ANSWER_CACHE, EMBEDDING_CACHE
+from app.core.speech import AUDIO_CACHE_STATS
+from app.log.metrics import CallbackMetric, render_metrics
+from app.db.api import DB
+
+
+router = APIRouter(dependencies=[Depends(authenticate_token)])
+# session gauges, read from the session store once per scrape
+SESSION_STATS = {}
+
+
+def get_cache_requests():
+    values = {}
+    for cache, stats in (("answer", ANSWER_CACHE.stats()), ("embedding", EMBEDDING_CACHE.stats()), ("audio", AUDIO_CACHE_STATS)):
+        values[(cache, "hit")] = stats["hits"]
+        values[(cache, "miss")] = stats["misses"]
+    return values
+
+def get_session_gauges(key):
+    def callback():
+        return {(): SESSION_STATS.get(key, 0)}
+    return callback
+
+
+CallbackMetric("cache_requests_total", "Lookups of the answer/embedding/audio caches.", ["cache", "result"],
+               callback=get_cache_requests, kind="counter")
+CallbackMetric("sessions", "Sessions in the session store.", callback=get_session_gauges("sessions"))
+CallbackMetric("session_bytes", "Approximate bytes of the session store.", callback=get_session_gauges("bytes"))
+CallbackMetric("sessions_inactive", "Expired/evicted clients waiting to be saved to the database.", callback=get_session_gauges("inactive"))
+CallbackMetric("sessions_inactive_dropped_total", "Expired/evicted clients dropped unsaved over inactive_max_count.",
+               callback=get_session_gauges("inactive_dropped"), kind="counter")
+
+
+# The API route to scrape the metrics (Prometheus text format)
+@router.get("/metrics/{access_token}")
+async def get_metrics(access_token: str):
+    LOGGER.info("Request:")
+    SESSION_STATS.update(await DB.get_session_stats())
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -17,6 +17,12 @@ LOG_DIR = os.path.join(STORAGE_DIR, "logs")
 os.makedirs(LOG_DIR, exist_ok=True)
 LOG_FILE = os.path.join(APP_PATH, "conf", "log", "{}.conf")
 
+# Set search index version file (touched by script/indexing/prepdocs.py)
+INDEX_VERSION_FILE = os.path.join(STORAGE_DIR, "index.version")
+
+# Set embedding cache dir
+EMBEDDING_CACHE_DIR = os.path.join(STORAGE_DIR, "embeddings")
+
 # Set audio tmp dir
 AUDIO_TMP_DIR = os.path.join(APP_PATH, "static", "audio", "tmp")
 os.makedirs(os.path.dirname(AUDIO_TMP_DIR), exist_ok=True)
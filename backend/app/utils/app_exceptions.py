@@ -1,3 +1,5 @@
+import math
+
 from fastapi import Request
 from starlette.responses import JSONResponse
 
@@ -22,6 +24,7 @@ async def app_exception_handler(request: Request, exc: AppExceptionCase):
             "app_exception": exc.exception_case,
             "context": exc.context,
         },
+        headers=getattr(exc, "headers", None),
     )
 
 
@@ -42,6 +45,24 @@ class AppException(object):
             status_code = 403
             AppExceptionCase.__init__(self, status_code, context)
 
+    class TooManyRequests(AppExceptionCase):
+        def __init__(self, context: dict = None):
+            """
+            Rate limit of the access token exceeded
+            """
+            status_code = 429
+            AppExceptionCase.__init__(self, status_code, context)
+            retry_after = (context or {}).get("retry_after", 1)
+            self.headers = {"Retry-After": str(max(math.ceil(retry_after), 1))}
+
+    class ServiceUnavailable(AppExceptionCase):
+        def __init__(self, context: dict = None):
+            """
+            Services not ready
+            """
+            status_code = 503
+            AppExceptionCase.__init__(self, status_code, context)
+
     class IDNotFound(AppExceptionCase):
         def __init__(self, context: dict = None):
             """
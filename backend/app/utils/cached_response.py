@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from fastapi import Request
+from starlette.responses import Response
+
+from app.config import LOGGER
+from app.utils.app_exceptions import AppException
+from app.utils.service_result import ServiceResult, handle_result
+
+
+class PrecomputedResponse:
+    """JSON response of static config, serialized once to bytes with a strong ETag.
+    The source files are checked at most every check_interval seconds, the bytes are rebuilt only when their
+    mtime changed. Requests with a matching If-None-Match get 304 without body.
+    The body is built on the first request (not at import): until a build succeeds, requests get 503.
+    """
+    def __init__(self, build, paths: list, reload=None, check_interval: float = 5.0, max_age: int = 0):
+        """
+        Args:
+            build: function returning the data of the response (JSON serializable)
+            paths (list): files the data is built from
+            reload: function loading the changed files before build (e.g. into Config)
+            check_interval (float): seconds between two checks of the files
+            max_age (int): max-age of Cache-Control (seconds), 0 to revalidate every time
+        """
+        self.build = build
+        self.paths = paths
+        self.reload = reload
+        self.check_interval = check_interval
+        self.cache_control = "max-age={}, must-revalidate".format(max_age) if max_age > 0 else "no-cache"
+        self.lock = threading.Lock()
+        # mtimes of the files already loaded by the caller (reload only when they changed) and of the built body
+        self.loaded = self.get_mtimes()
+        self.mtimes = None
+        self.checked = 0.0
+        self.body = b""
+        self.etag = ""
+
+    def get_mtimes(self) -> tuple:
+        return tuple(os.stat(path).st_mtime_ns if os.path.isfile(path) else 0 for path in self.paths)
+
+    def refresh(self) -> bool:
+        """
+        Rebuild the body and the ETag if the files changed.
+        Returns:
+            changed (bool)
+        """
+        with self.lock:
+            self.checked = time.monotonic()
+            mtimes = self.get_mtimes()
+            if mtimes == self.mtimes:
+                return False
+            if self.reload is not None and mtimes != self.loaded:
+                self.reload()
+                self.loaded = mtimes
+            # same encoding as JSONResponse
+            body = json.dumps(self.build(), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+            self.body = body
+            self.etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+            self.mtimes = mtimes
+            return True
+
+    def is_not_modified(self, request: Request) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # weak comparison, as for GET requests
+        return any(tag.strip().replace("W/", "", 1) == self.etag for tag in if_none_match.split(","))
+
+    def response(self, request: Request) -> Response:
+        """
+        Response of the request: 304 if the client has the current version, else the pre-encoded body.
+        Raises ServiceUnavailable (503) while no body could be built.
+        """
+        if time.monotonic() - self.checked >= self.check_interval:
+            try:
+                if self.refresh():
+                    LOGGER.info("Rebuilt response of {}: etag={} - bytes={}".format(self.paths, self.etag, len(self.body)))
+            except Exception as e:
+                # keep the previous version until the files are fixed
+                LOGGER.error("Exception: {}".format(e))
+        if self.mtimes is None:
+            return handle_result(ServiceResult(AppException.ServiceUnavailable(
+                context={"message": "Response of {} not built yet, retried in {}s".format(self.paths, self.check_interval)})))
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control}
+        if self.is_not_modified(request):
+            return Response(status_code=304, headers=headers)
+        return Response(self.body, media_type="application/json", headers=headers)
@@ -16,6 +16,9 @@ def time2str(dt):
         return dt
     return dt.strftime(TIME_STR)[:-3]
 
+def str2time(text):
+    return get_tz().localize(datetime.strptime(text, TIME_STR))
+
 def get_tz():
     return pytz.timezone(TIMEZONE)
 
@@ -1,5 +1,6 @@
 import os
-from datetime import datetime, timedelta
+import asyncio
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI, HTTPException
@@ -9,16 +10,42 @@ from fastapi_utils.tasks import repeat_every
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import FileResponse
 
-from app.config import APP_PATH, LOGGER, show_config, AUDIO_TMP_DIR, Config
+from app.config import APP_PATH, LOGGER, show_config
+from app.core.speech import cleanup_audio_cache
+from app.core.http import close_http_session
+from app.core.services import SERVICES
 from app.routers import authentication as authen
-from app.routers import client, language, chat
-from app.db.api import DB
-from app.log.middleware import LogMiddleware
+from app.routers import client, language, chat, metrics, health
+from app.db.worker import PERSISTENCE_WORKER
+from app.log.middleware import LogMiddleware, TraceMiddleware
 from app.utils.app_exceptions import app_exception_handler, AppExceptionCase
 from app.utils.request_exceptions import http_exception_handler, request_validation_exception_handler
 
 
-app = FastAPI()
+@repeat_every(seconds=60)
+def cleanup_audio_files() -> None:
+    LOGGER.info("Start:")
+    cleanup_audio_cache()
+    LOGGER.info("Done!")
+
+# tables and persistence worker started with the other clients at startup, stopped first at shutdown (registered last)
+SERVICES.register("database", PERSISTENCE_WORKER.start, close=lambda _: PERSISTENCE_WORKER.stop())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # build the clients in the background: the server accepts connections (liveness),
+    # /health/ready answers 503 until the required clients are ready
+    startup = asyncio.ensure_future(SERVICES.start())
+    await cleanup_audio_files()
+    yield
+    if not startup.done():
+        startup.cancel()
+    # save the clients (database service, closed first) before closing the other clients
+    await SERVICES.close()
+    await close_http_session()
+
+
+app = FastAPI(lifespan=lifespan)
 LOGGER.info("\n\n\nStart AI Assistant webapp!\n")
 LOGGER.info("Config:")
 LOGGER.info("{}".format(show_config()))
@@ -48,35 +75,6 @@ async def custom_validation_exception_handler(request, e):
 async def custom_app_exception_handler(request, e):
     return await app_exception_handler(request, e)
 
-@app.on_event("startup")
-@repeat_every(seconds=60)
-def cleanup_audio_files() -> None:
-    LOGGER.info("Start:")
-    now = datetime.now()
-    for filename in os.listdir(AUDIO_TMP_DIR):
-        file_path = os.path.join(AUDIO_TMP_DIR, filename)
-        if os.path.isfile(file_path) and filename.endswith('.wav'):
-            file_creation_time = datetime.fromtimestamp(os.path.getctime(file_path))
-            if now - file_creation_time > timedelta(minutes=20):
-                os.remove(file_path)
-                LOGGER.info(f"Deleted old audio file: {filename}")
-    LOGGER.info("Done!")
-
-@app.on_event("startup")
-@repeat_every(seconds=Config.STATUS_DURATION)
-def update_client_status() -> None:
-    LOGGER.info("Start:")
-    DB.update_status()
-    LOGGER.info("Done!")
-
-@app.on_event("startup")
-@repeat_every(seconds=Config.OUTDATE_DURATION)
-def save_to_database() -> None:
-    LOGGER.info("Start:")
-    DB.save_inactive_clients()
-    DB.save_active_clients()
-    LOGGER.info("Done!")
-
 # The default route, which shows the default web page
 @app.get("/")
 @app.get("/authentication")
@@ -85,6 +83,7 @@ async def read_index():
 
 # Add middleware
 app.add_middleware(LogMiddleware)
+app.add_middleware(TraceMiddleware)
 
 # Include authen
 app.include_router(authen.router)
@@ -93,6 +92,8 @@ app.include_router(authen.router)
 app.include_router(client.router)
 app.include_router(language.router)
 app.include_router(chat.router)
+app.include_router(metrics.router)
+app.include_router(health.router)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+import uuid
+
+import aiohttp
+
+
+def load_questions(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [(row['user_query'], row['voice_code']) for row in csv.DictReader(f)]
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+async def ask(session, url, user_query, voice_code):
+    headers = {"ClientId": str(uuid.uuid4())}
+    body = {"user_query": user_query, "voice_code": voice_code}
+    ts = time.perf_counter()
+    async with session.post(url, headers=headers, json=body) as response:
+        await response.read()
+        status = response.status
+    return status, time.perf_counter() - ts
+
+async def run_level(url, questions, concurrency, total):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(questions[i % len(questions)])
+
+    async def worker(session):
+        nonlocal errors
+        while not queue.empty():
+            user_query, voice_code = queue.get_nowait()
+            try:
+                status, latency = await ask(session, url, user_query, voice_code)
+                if status == 200:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+            except Exception as e:
+                print(f"Request failed: {e}")
+                errors += 1
+
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        ts = time.perf_counter()
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+        duration = time.perf_counter() - ts
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "duration": round(duration, 3),
+        "throughput": round(len(latencies) / duration, 3) if duration else 0.0,
+        "p50": round(percentile(latencies, 50), 3),
+        "p90": round(percentile(latencies, 90), 3),
+        "p99": round(percentile(latencies, 99), 3),
+        "max": round(max(latencies), 3) if latencies else 0.0,
+    }
+
+async def main(args):
+    questions = load_questions(args.questions)
+    url = "{}/{}/{}".format(args.url.rstrip('/'), args.route.strip('/'), args.token)
+    results = []
+    print(f"Benchmark {url}")
+    print("{:>11} {:>8} {:>6} {:>9} {:>10} {:>7} {:>7} {:>7} {:>7}".format(
+        "concurrency", "requests", "errors", "duration", "throughput", "p50", "p90", "p99", "max"))
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        result = await run_level(url, questions, concurrency, args.requests or concurrency * 5)
+        results.append(result)
+        print("{concurrency:>11} {requests:>8} {errors:>6} {duration:>9} {throughput:>10} {p50:>7} {p90:>7} {p99:>7} {max:>7}".format(**result))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"url": url, "label": args.label, "results": results}, f, indent=4)
+        print(f"Saved results to '{args.output}'")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Send concurrent /api/ask requests and report latency percentiles (seconds) per concurrency level.",
+        epilog="Example: bench_ask.py --url http://localhost:5001 --token <access_token> --concurrency 1,10,50 --output after.json"
+    )
+    parser.add_argument("--url", default="http://localhost:5001", help="Base URL of the backend")
+    parser.add_argument("--token", required=True, help="Access token")
+    parser.add_argument("--route", default="/api/ask", help="Route to benchmark")
+    parser.add_argument("--questions", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "perf-test", "src", "data", "question.csv"), help="CSV file with user_query,voice_code columns")
+    parser.add_argument("--concurrency", default="1,10,50", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=0, help="Requests per level (default 5 x concurrency)")
+    parser.add_argument("--label", default="", help="Label saved with the results (e.g. before/after)")
+    parser.add_argument("--output", required=False, help="Optional. Save results to this JSON file")
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import queue
+import asyncio
+import logging
+import logging.handlers
+import argparse
+import tempfile
+
+import numpy as np
+from fastapi import FastAPI, Header
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from app.log.log import LOG_TYPE, LogQueueHandler, get_handlers
+from app.log.middleware import LogMiddleware
+
+
+MODES = ["off", "sync", "queue"]
+
+
+def slow_emit(handler, delay):
+    emit = handler.emit
+
+    def wrapper(record):
+        time.sleep(delay)
+        emit(record)
+    handler.emit = wrapper
+
+def setup_logger(name, mode, log_dir, level, write_delay=0.0):
+    """
+    Point the logger to the log files of log_dir: disabled (off), file handlers on the event loop (sync, the setup
+    before the queued logging) or a queue + listener thread (queue).
+    Args:
+        write_delay (float): seconds added to every write, to simulate a slow log volume
+    Returns:
+        listener: QueueListener to stop (queue mode), None otherwise
+    """
+    log = logging.getLogger(name)
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    if mode == "off":
+        log.setLevel(logging.CRITICAL)
+        return None
+    _, logHandlers = get_handlers(name, log_dir)
+    if write_delay > 0:
+        for handler in logHandlers:
+            slow_emit(handler, write_delay)
+    log.setLevel(level)
+    if mode == "sync":
+        for handler in logHandlers:
+            log.addHandler(handler)
+        return None
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logHandlers)
+    listener.start()
+    log.addHandler(LogQueueHandler(log_queue))
+    return listener
+
+def create_app(sample_rate):
+    app = FastAPI()
+    local = logging.getLogger(LOG_TYPE.LOCAL)
+
+    # route logging like the API routes: request and response lines
+    @app.get("/api/bench/{access_token}")
+    async def bench(access_token: str, ClientId: str = Header("")):
+        local.info("Request: \naccess_token={}\nclient_id={}".format(access_token, ClientId))
+        data = {"access_token": access_token, "client_id": ClientId}
+        local.info("Response: response={}".format(data))
+        return data
+
+    app.add_middleware(LogMiddleware, sample_rate=sample_rate)
+    return app
+
+async def request(app, path, headers):
+    """
+    Call the ASGI app in process (no HTTP client, no socket).
+    Returns:
+        status (int): status code of the response
+    """
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(key.lower().encode(), value.encode()) for key, value in headers.items()],
+        "client": ("127.0.0.1", 50000), "server": ("bench", 80)
+    }
+    response = {"status": 0}
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # the client stays connected until the response is sent
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+
+    await app(scope, receive, send)
+    return response["status"]
+
+async def run(app, concurrency, total):
+    latencies = []
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            ts = time.perf_counter()
+            status = await request(app, "/api/bench/token", {"ClientId": "client-{}".format(i)})
+            if status != 200:
+                raise RuntimeError("Request failed: status={}".format(status))
+            latencies.append(time.perf_counter() - ts)
+
+    ts = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    duration = time.perf_counter() - ts
+    return duration, latencies
+
+def main(args):
+    level = getattr(logging, args.level)
+    print("{:>6} {:>10} {:>9} {:>9} {:>9}".format("mode", "throughput", "p50_ms", "p99_ms", "log_lines"))
+    for mode in args.modes.split(','):
+        with tempfile.TemporaryDirectory() as log_dir:
+            listeners = [setup_logger(name, mode, log_dir, level, args.write_delay / 1000) for name in (LOG_TYPE.LOCAL, LOG_TYPE.MIDDLEWARE)]
+            app = create_app(args.sample)
+            asyncio.run(run(app, args.concurrency, min(args.requests, 200)))  # warm up
+            duration, latencies = asyncio.run(run(app, args.concurrency, args.requests))
+            for listener in listeners:
+                if listener is not None:
+                    listener.stop()
+            for name in (LOG_TYPE.LOCAL, LOG_TYPE.MIDDLEWARE):
+                for handler in logging.getLogger(name).handlers:
+                    handler.close()
+            lines = 0
+            for file_name in os.listdir(log_dir):
+                with open(os.path.join(log_dir, file_name), 'rb') as f:
+                    lines += sum(1 for _ in f)
+        print("{:>6} {:>10.1f} {:>9.3f} {:>9.3f} {:>9}".format(
+            mode, len(latencies) / duration, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000, lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Request throughput of an in-process app with the log middleware + route logging off, "
+                    "with file handlers on the event loop (sync) and with queued logging (queue).",
+        epilog="Example: bench_logging.py --requests 5000 --concurrency 50 --level DEBUG --sample 0.1"
+    )
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma separated modes: off,sync,queue")
+    parser.add_argument("--requests", type=int, default=5000, help="Requests per mode")
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent requests")
+    parser.add_argument("--level", default="INFO", choices=["DEBUG", "INFO", "WARNING"], help="Level of the loggers")
+    parser.add_argument("--sample", type=float, default=1.0, help="Share of the requests logged by the middleware")
+    parser.add_argument("--write-delay", type=float, default=0.0, help="Milliseconds added to every log write (slow log volume)")
+    args = parser.parse_args()
+    main(args)
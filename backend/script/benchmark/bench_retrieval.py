@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from app.core.retriever import LocalRetriever
+
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if values else 0.0
+
+async def main(args):
+    ts = time.perf_counter()
+    retriever = LocalRetriever(args.bundle)
+    load_time = time.perf_counter() - ts
+    n = len(retriever.documents)
+    print(f"Loaded {n} documents from '{args.bundle}' in {load_time * 1000:.1f} ms")
+
+    # queries: summary text of a random document + its vector with gaussian noise
+    random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    latencies = []
+    found = 0
+    for _ in range(args.queries):
+        doc_id = random.randrange(n)
+        document = retriever.documents[doc_id]
+        vector = np.array(retriever.vectors[doc_id], dtype=np.float32)
+        vector += rng.normal(0, args.noise, vector.shape).astype(np.float32)
+        ts = time.perf_counter()
+        results = await retriever.search(document.get("summary", ""), vector.tolist(), args.top)
+        latencies.append((time.perf_counter() - ts) * 1000)
+        found += any(result["summary"] == document.get("summary") for result in results)
+
+    print(f"queries={args.queries} - top={args.top} - recall@{args.top}={found / args.queries:.3f}")
+    print(f"latency (ms): p50={percentile(latencies, 50):.3f} - p90={percentile(latencies, 90):.3f} - p99={percentile(latencies, 99):.3f} - max={max(latencies):.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the local retriever (vector + BM25, reciprocal-rank fusion) offline on a bundle.",
+        epilog="Example: bench_retrieval.py ../../../storage/bundles --queries 1000"
+    )
+    parser.add_argument("bundle", help="Bundle folder with documents.jsonl and vectors.npy")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of queries")
+    parser.add_argument("--top", type=int, default=3, help="Top documents per query")
+    parser.add_argument("--noise", type=float, default=0.01, help="Std of the gaussian noise added to the query vectors")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    asyncio.run(main(args))
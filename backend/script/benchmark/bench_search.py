@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+import numpy as np
+from fastapi import FastAPI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from app.core import agent
+from app.core.retriever import Retriever, AzureRetriever
+from app.log.log import LOG_TYPE
+from bench_logging import request
+
+
+MODES = ["sync", "async"]
+
+
+def make_results(count):
+    return [{"summary": "summary {}".format(i), "content_details": "details {}".format(i), "image_links": [],
+             "@search.reranker_score": 2.0} for i in range(count)]
+
+
+class StubSearchClient:
+    """Sync SearchClient of azure.search.documents: the round trip blocks the calling thread.
+    """
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+
+    def search(self, search_text, top, **kwargs):
+        time.sleep(self.round_trip)
+        return make_results(top)
+
+
+class StubAsyncSearchClient:
+    """Async SearchClient of azure.search.documents.aio: the round trip awaits, paged results with async for.
+    """
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+
+    async def search(self, search_text, top, **kwargs):
+        await asyncio.sleep(self.round_trip)
+
+        async def results():
+            for result in make_results(top):
+                yield result
+        return results()
+
+    async def close(self):
+        pass
+
+
+class SyncRetriever(Retriever):
+    """local_search before the async client: the sync SearchClient called and iterated on the event loop.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    async def search(self, search_text, vector, top):
+        documents = []
+        for result in self.client.search(search_text=search_text, vector_queries=[vector], top=top):
+            score = float(result.get('@search.reranker_score') or 0.0)
+            documents.append({"summary": result['summary'], "content_details": result['content_details'],
+                              "image_links": result['image_links'], "score": score,
+                              "show_images": score >= AzureRetriever.RERANKER_SCORE_IMAGES})
+        return documents
+
+
+class StubOpenAI:
+    """Embeddings and chat completion of the ask route, fixed round trip (awaited in both modes).
+    """
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+        self.embeddings = self
+
+    async def create(self, input, model):
+        await asyncio.sleep(self.round_trip)
+
+        class Data:
+            embedding = [0.0] * 8
+
+        class Response:
+            data = [Data()]
+            usage = None
+        return Response()
+
+
+def create_app(mode, search_round_trip, llm_round_trip):
+    """
+    Ask route of the benchmark: local_search of the agent (embedding + search) then the answer of the chat model.
+    """
+    if mode == "sync":
+        retriever = SyncRetriever(StubSearchClient(search_round_trip))
+    else:
+        retriever = AzureRetriever()
+        retriever.client = StubAsyncSearchClient(search_round_trip)
+    openai = StubOpenAI(llm_round_trip)
+    agent.get_retriever = lambda: retriever
+    agent.get_openai_client = lambda: openai
+    app = FastAPI()
+
+    @app.get("/api/ask/{access_token}")
+    async def ask(access_token: str):
+        # unique query: no hit of the embedding cache
+        result = await agent.local_search("question {}".format(time.perf_counter_ns()))
+        await asyncio.sleep(llm_round_trip)
+        return {"content": len(result.content)}
+
+    return app
+
+async def run(app, concurrency, total):
+    latencies = []
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            ts = time.perf_counter()
+            status = await request(app, "/api/ask/token", {"ClientId": "client-{}".format(i)})
+            if status != 200:
+                raise RuntimeError("Request failed: status={}".format(status))
+            latencies.append(time.perf_counter() - ts)
+
+    ts = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    duration = time.perf_counter() - ts
+    return duration, latencies
+
+def main(args):
+    for name in (LOG_TYPE.LOCAL, LOG_TYPE.MIDDLEWARE, LOG_TYPE.TIMEIT, LOG_TYPE.TRACE):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    print("{:>5} {:>11} {:>10} {:>9} {:>9}".format("mode", "concurrency", "throughput", "p50_ms", "p99_ms"))
+    for mode in args.modes.split(','):
+        app = create_app(mode, args.search_rtt / 1000, args.llm_rtt / 1000)
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            duration, latencies = asyncio.run(run(app, concurrency, args.requests or concurrency * 10))
+            print("{:>5} {:>11} {:>10.1f} {:>9.1f} {:>9.1f}".format(
+                mode, concurrency, len(latencies) / duration, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Latency of concurrent /api/ask calls of an in-process app with a stub Azure Search (fixed round trip): "
+                    "sync SearchClient on the event loop (before the async client) and async SearchClient (after).",
+        epilog="Example: bench_search.py --concurrency 1,10,50 --search-rtt 50 --llm-rtt 200"
+    )
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma separated modes: sync,async")
+    parser.add_argument("--concurrency", default="1,10,50", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=0, help="Requests per level (default 10 x concurrency)")
+    parser.add_argument("--search-rtt", type=float, default=50.0, help="Milliseconds of a search round trip")
+    parser.add_argument("--llm-rtt", type=float, default=200.0, help="Milliseconds of the embedding and of the answer")
+    args = parser.parse_args()
+    main(args)
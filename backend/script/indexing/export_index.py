@@ -0,0 +1,129 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+
+FIELDS = ["id", "summary", "content_details", "keyword_entities", "image_links", "summaryVector", "sourcepage"]
+BUNDLE_FORMAT = 1
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def fetch_documents():
+    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
+                                 index_name=args.index,
+                                 credential=search_creds)
+    results = search_client.search("", select=FIELDS, include_total_count=True)
+    documents = []
+    for document in results:
+        documents.append({field: document.get(field) for field in FIELDS})
+        if args.verbose and len(documents) % 1000 == 0: print(f"\tFetched {len(documents)} documents")
+    if args.verbose: print(f"Fetched {len(documents)} documents (index count: {results.get_count()})")
+    documents.sort(key=lambda d: d["id"])
+    return documents
+
+def write_bundle(documents, bundle_dir, version):
+    vectors = [d.pop("summaryVector") or [] for d in documents]
+    dim = max((len(v) for v in vectors), default=0)
+    matrix = np.zeros((len(vectors), dim), dtype=np.float32)
+    for i, vector in enumerate(vectors):
+        if len(vector) == dim:
+            matrix[i] = vector
+        else:
+            print(f"Document '{documents[i]['id']}' has no summaryVector, stored as zeros.")
+    np.save(os.path.join(bundle_dir, "vectors.npy"), matrix)
+
+    with open(os.path.join(bundle_dir, "documents.jsonl"), 'w', encoding='utf-8') as f:
+        for document in documents:
+            f.write(json.dumps(document, ensure_ascii=False) + "\n")
+
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "index": args.index,
+        "version": version,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "count": len(documents),
+        "dim": dim,
+        "files": {
+            name: {"size": os.path.getsize(os.path.join(bundle_dir, name)), "sha256": file_sha256(os.path.join(bundle_dir, name))}
+            for name in ["documents.jsonl", "vectors.npy"]
+        }
+    }
+    with open(os.path.join(bundle_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+def verify_bundle(bundle_dir):
+    with open(os.path.join(bundle_dir, "manifest.json"), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    ok = True
+    for name, info in manifest["files"].items():
+        path = os.path.join(bundle_dir, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != info["size"] or file_sha256(path) != info["sha256"]:
+            print(f"File '{path}' does not match the manifest.")
+            ok = False
+    print(f"Bundle '{bundle_dir}' version {manifest['version']}: {manifest['count']} documents - {'OK' if ok else 'CORRUPTED'}")
+    return ok
+
+def export_index():
+    index_dir = os.path.join(args.output, args.index)
+    os.makedirs(index_dir, exist_ok=True)
+    version = time.strftime("%Y%m%d%H%M%S")
+    tmp_dir = os.path.join(index_dir, f"{version}.tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        manifest = write_bundle(fetch_documents(), tmp_dir, version)
+        bundle_dir = os.path.join(index_dir, version)
+        os.replace(tmp_dir, bundle_dir)
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+    # point LATEST to the new version, atomically
+    latest_tmp = os.path.join(index_dir, "LATEST.tmp")
+    with open(latest_tmp, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(latest_tmp, os.path.join(index_dir, "LATEST"))
+    print(f"Exported {manifest['count']} documents (dim={manifest['dim']}) to '{bundle_dir}'")
+
+    # keep the last versions only
+    versions = sorted(d for d in os.listdir(index_dir) if os.path.isdir(os.path.join(index_dir, d)) and not d.endswith(".tmp"))
+    for old in versions[:-args.keep] if args.keep > 0 else []:
+        if args.verbose: print(f"Removing old bundle '{old}'")
+        shutil.rmtree(os.path.join(index_dir, old))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export all documents of a search index to a versioned local bundle (documents.jsonl, memory-mappable vectors.npy, manifest.json) for the local retriever.",
+        epilog="Example: export_index.py --searchservice mysearch --index myindex --searchkey <key> -v"
+    )
+    parser.add_argument("--searchservice", help="Name of the Azure Cognitive Search service")
+    parser.add_argument("--index", help="Name of the Azure Cognitive Search index to export")
+    parser.add_argument("--searchkey", required=False, help="Optional. Use this Azure Cognitive Search account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "storage", "bundles"), help="Folder of the bundles, a bundle is written to <output>/<index>/<version>")
+    parser.add_argument("--keep", type=int, default=3, help="Number of bundle versions to keep (0 to keep all)")
+    parser.add_argument("--verify", required=False, help="Verify the files of this bundle folder against its manifest, then exit")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    if args.verify:
+        exit(0 if verify_bundle(args.verify) else 1)
+
+    if args.searchservice == None or args.index == None:
+        print("Error: --searchservice and --index are required.")
+        exit(1)
+    search_creds = None if args.searchkey == None else AzureKeyCredential(args.searchkey)
+    export_index()
@@ -397,6 +397,13 @@ def load_from_json(filename):
     with open(filename, 'r', encoding='utf-8') as f:
         return json.load(f)
     
+def touch_index_version(path):
+    # the backend clears its answer cache when this file changes
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a'):
+        os.utime(path, None)
+    if args.verbose: print(f"Updated index version file '{path}'")
+
 def filename_to_id(filename):
     filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
     filename_hash = base64.b16encode(filename.encode('utf-8')).decode('ascii')
@@ -458,6 +465,7 @@ if __name__ == "__main__":
     parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
     parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
     parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--indexversionfile", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "storage", "index.version"), help="Optional. File touched after the index is changed, to invalidate the answer cache of the backend")
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
 
@@ -530,4 +538,6 @@ if __name__ == "__main__":
 
             except Exception as e:
                 logging.error(f"Error processing file {filename}: {e}")
-                if args.verbose: print(f"Error processing file {filename}: {e}")
\ No newline at end of file
+                if args.verbose: print(f"Error processing file {filename}: {e}")
+
+    touch_index_version(args.indexversionfile)
\ No newline at end of file
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from app.core.history import HistoryWindow
+from app.db.models.turn import Turn
+from app.utils.utils import get_datetime_now
+
+
+MAX_LEN = 3
+KEY = ("token", "client")
+
+
+class FakeHistoryWindow(HistoryWindow):
+    """Summary of the turn numbers instead of a chat call, the turns out of the window are read from all the turns.
+    """
+    def __init__(self, budget, turns):
+        super().__init__(budget=budget, summary=True, load_turns=self.load)
+        self.turns = turns
+
+    async def load(self, access_token, client_id, since):
+        return [d for d in self.turns if d.turn >= since]
+
+    async def complete(self, previous, turns):
+        return ",".join(([previous] if previous else []) + [str(d.turn) for d in turns])
+
+
+def summarized(window):
+    cached = window.summaries.get(KEY)
+    return [int(i) for i in cached[1].split(",")] if cached is not None else []
+
+
+@pytest.mark.parametrize("budget", [0, 250])
+def test_summary_skips_no_turn(budget):
+    async def main():
+        turns = []
+        window = FakeHistoryWindow(budget, turns)
+        for i in range(30):
+            turns.append(Turn("vi-VN", "prompt", "user {}".format(i), "assistant {}".format(i), get_datetime_now(), turn=i, tokens=100))
+            messages, stats = window.build(*KEY, turns[-MAX_LEN:])
+            # a summary in flight for 2 requests out of 3: the turns leaving the window meanwhile are loaded later
+            if i % 3 == 0:
+                await asyncio.gather(*window.tasks.values())
+                assert summarized(window) == list(range(window.summaries[KEY][0] if KEY in window.summaries else 0))
+        await asyncio.gather(*window.tasks.values())
+
+        messages, stats = window.build(*KEY, turns[-MAX_LEN:])
+        await asyncio.gather(*window.tasks.values())
+        first_kept = turns[-stats["kept"]].turn
+        assert summarized(window) == list(range(first_kept))
+        assert window.summaries[KEY][0] == first_kept
+
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+import asyncio
+
+from app.db import api
+from app.core.services import ServiceRegistry, SERVICE_STATE
+
+
+class FakeTableService:
+    """Async TableServiceClient of azure.data.tables, the creation of a table fails once.
+    """
+    def __init__(self, fail_table=None):
+        self.fail_table = fail_table
+        self.closed = False
+
+    async def create_table_if_not_exists(self, table_name):
+        if table_name == self.fail_table:
+            self.fail_table = None
+            raise ConnectionError("table {} not created".format(table_name))
+
+    def get_table_client(self, table_name):
+        return table_name
+
+    async def close(self):
+        self.closed = True
+
+
+def test_retry_opens_tables_after_a_failure(monkeypatch):
+    failing = FakeTableService(fail_table=api.Config.DB_TABLE_CONVERSATION)
+    services = [failing, FakeTableService()]
+    monkeypatch.setattr(api.TableServiceClient, "from_connection_string", lambda conn_str: services.pop(0))
+    monkeypatch.setattr(api, "TableService", None)
+    monkeypatch.setattr(api, "DB_CLIENT", None)
+    monkeypatch.setattr(api, "DB_CONV", None)
+    monkeypatch.setattr(api, "DB_PROMPT", None)
+
+    async def main():
+        registry = ServiceRegistry(retry_interval=0.0)
+        registry.register("database", api.open_tables)
+        await registry.start()
+        service = registry.services["database"]
+        assert service.state == SERVICE_STATE.FAILED
+        # nothing half opened: the retry does not return early
+        assert failing.closed
+        assert (api.TableService, api.DB_CLIENT, api.DB_CONV, api.DB_PROMPT) == (None, None, None, None)
+
+        # retry of the readiness probe, started in the background
+        failed_task = service.task
+        registry.retry_failed()
+        while service.task is failed_task:
+            await asyncio.sleep(0)
+        await service.task
+        assert service.state == SERVICE_STATE.READY
+        assert (api.DB_CLIENT, api.DB_CONV, api.DB_PROMPT) == (
+            api.Config.DB_TABLE_CLIENT, api.Config.DB_TABLE_CONVERSATION, api.Config.DB_TABLE_PROMPT)
+
+    asyncio.run(main())
@@ -0,0 +1,206 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from app.db import store as store_module
+from app.db.store import SessionStore, MemorySessionStore, SQLiteSessionStore, RedisSessionStore, STORE_TYPE
+from app.db.models.turn import Turn
+from app.utils.utils import get_datetime_now
+
+
+ACCESS_TOKEN = "token"
+
+
+class FakeClock:
+    """Monotonic/epoch clock of the store module, moved by the tests.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+def new_client(updated_at=None):
+    now = get_datetime_now()
+    return {"status": "active", "language": "", "prompt_id": "", "turns": 0, "saved_turns": 0,
+            "created_at": now, "updated_at": updated_at or now}
+
+def new_turn(i):
+    return Turn("vi-VN", "prompt", "user {}".format(i), "assistant {}".format(i), get_datetime_now())
+
+
+@pytest.fixture(params=[STORE_TYPE.MEMORY, STORE_TYPE.SQLITE, STORE_TYPE.REDIS])
+def store_factory(request, tmp_path, monkeypatch):
+    """
+    Factory of an empty store of each backend, called in the event loop of the test (Redis: fakeredis).
+    """
+    if request.param == STORE_TYPE.REDIS:
+        fakeredis = pytest.importorskip("fakeredis")
+        pytest.importorskip("lupa")
+        import redis.asyncio
+        monkeypatch.setattr(redis.asyncio.Redis, "from_url", lambda url: fakeredis.FakeAsyncRedis())
+        return lambda: RedisSessionStore("redis://fake", prefix="test")
+    if request.param == STORE_TYPE.SQLITE:
+        return lambda: SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    return lambda: MemorySessionStore(max_sessions=0, max_bytes=0, token_quota=0)
+
+
+def test_create_is_atomic(store_factory):
+    async def main():
+        store = store_factory()
+        results = await asyncio.gather(*[store.create(ACCESS_TOKEN, "a", new_client()) for _ in range(5)])
+        assert sorted(results) == [False] * 4 + [True]
+        assert (await store.get(ACCESS_TOKEN, "a"))["turns"] == 0
+        assert await store.get(ACCESS_TOKEN, "b") is None
+        await store.close()
+    asyncio.run(main())
+
+def test_append_turn_and_last_turns(store_factory):
+    async def main():
+        store = store_factory()
+        await store.create(ACCESS_TOKEN, "a", new_client())
+        turns = await asyncio.gather(*[store.append_turn(ACCESS_TOKEN, "a", new_turn(i), get_datetime_now()) for i in range(10)])
+        assert sorted(turns) == list(range(10))
+        assert await store.append_turn(ACCESS_TOKEN, "missing", new_turn(0), get_datetime_now()) == -1
+        last = await store.get_turns(ACCESS_TOKEN, "a", 3)
+        assert [d.turn for d in last] == [7, 8, 9]
+        assert (await store.get(ACCESS_TOKEN, "a"))["turns"] == 10
+        assert await store.get_turns(ACCESS_TOKEN, "a", 0) == []
+        await store.close()
+    asyncio.run(main())
+
+def test_snapshot_mark_saved_and_restore(store_factory):
+    async def main():
+        store = store_factory()
+        await store.create(ACCESS_TOKEN, "a", new_client())
+        for i in range(5):
+            await store.append_turn(ACCESS_TOKEN, "a", new_turn(i), get_datetime_now())
+        snapshot = await store.snapshot(ACCESS_TOKEN, "a", since=3)
+        assert [d.turn for d in snapshot["conversations"]] == [3, 4]
+
+        # saved turns are dropped except the last 2
+        await store.mark_saved(ACCESS_TOKEN, "a", 5, keep=2)
+        snapshot = await store.snapshot(ACCESS_TOKEN, "a")
+        assert snapshot["saved_turns"] == 5
+        assert [d.turn for d in snapshot["conversations"]] == [3, 4]
+
+        # pop and restore keep the turn numbers
+        client = await store.pop(ACCESS_TOKEN, "a")
+        assert await store.get(ACCESS_TOKEN, "a") is None
+        assert await store.pop(ACCESS_TOKEN, "a") is None
+        conversations = client.pop("conversations")
+        assert await store.create(ACCESS_TOKEN, "a", client, conversations)
+        assert [(d.turn, d.user) for d in await store.get_turns(ACCESS_TOKEN, "a", 5)] == [(3, "user 3"), (4, "user 4")]
+        assert await store.append_turn(ACCESS_TOKEN, "a", new_turn(5), get_datetime_now()) == 5
+        await store.close()
+    asyncio.run(main())
+
+def test_items_and_update(store_factory):
+    async def main():
+        store = store_factory()
+        for client_id in ("a", "b"):
+            await store.create(ACCESS_TOKEN, client_id, new_client())
+        assert await store.update(ACCESS_TOKEN, "a", {"status": "inactive"})
+        assert not await store.update(ACCESS_TOKEN, "c", {"status": "inactive"})
+        items = {client_id: client["status"] for _, client_id, client in await store.items()}
+        assert items == {"a": "inactive", "b": "active"}
+        assert (await store.stats())["sessions"] == 2
+        await store.close()
+    asyncio.run(main())
+
+
+def test_pop_expired_by_updated_at(store_factory, request):
+    if request.node.callspec.params["store_factory"] == STORE_TYPE.MEMORY:
+        pytest.skip("the memory store expires by its LRU clock")
+
+    async def main():
+        store = store_factory()
+        await store.create(ACCESS_TOKEN, "old", new_client(get_datetime_now() - timedelta(hours=2)))
+        await store.create(ACCESS_TOKEN, "new", new_client())
+        await store.append_turn(ACCESS_TOKEN, "old", new_turn(0), get_datetime_now() - timedelta(hours=2))
+        expired = await store.pop_expired(3600)
+        assert [(client_id, len(client["conversations"])) for _, client_id, client in expired] == [("old", 1)]
+        assert await store.get(ACCESS_TOKEN, "old") is None
+        assert await store.pop_expired(3600) == []
+        await store.close()
+    asyncio.run(main())
+
+
+def test_memory_pop_expired_from_lru(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(store_module, "time", clock)
+
+    async def main():
+        store = MemorySessionStore(max_sessions=0, max_bytes=0, token_quota=0)
+        await store.create(ACCESS_TOKEN, "a", new_client())
+        clock.now += 10
+        await store.create(ACCESS_TOKEN, "b", new_client())
+        clock.now += 10
+        # a turn makes "a" the most recently updated
+        await store.append_turn(ACCESS_TOKEN, "a", new_turn(0), get_datetime_now())
+        clock.now += 5
+        assert [client_id for _, client_id, _ in await store.pop_expired(12)] == ["b"]
+        assert await store.pop_expired(12) == []
+        assert [client_id for _, client_id, _ in await store.pop_expired(5)] == ["a"]
+        assert (await store.stats())["sessions"] == 0
+    asyncio.run(main())
+
+def test_memory_lru_eviction():
+    evicted = []
+
+    async def main():
+        store = MemorySessionStore(max_sessions=2, max_bytes=0, token_quota=0,
+                                   on_evict=lambda access_token, client_id, client: evicted.append(client_id))
+        await store.create(ACCESS_TOKEN, "a", new_client())
+        await store.create(ACCESS_TOKEN, "b", new_client())
+        await store.append_turn(ACCESS_TOKEN, "a", new_turn(0), get_datetime_now())
+        await store.create(ACCESS_TOKEN, "c", new_client())
+        assert evicted == ["b"]
+        assert await store.get(ACCESS_TOKEN, "b") is None
+        stats = await store.stats()
+        assert stats["sessions"] == 2 and stats["evicted"] == 1
+    asyncio.run(main())
+
+def test_memory_token_quota_evicts_own_sessions():
+    evicted = []
+
+    async def main():
+        store = MemorySessionStore(max_sessions=0, max_bytes=0, token_quota=2,
+                                   on_evict=lambda access_token, client_id, client: evicted.append((access_token, client_id)))
+        await store.create("other", "x", new_client())
+        for client_id in ("a", "b", "c", "d"):
+            await store.create(ACCESS_TOKEN, client_id, new_client())
+        assert evicted == [(ACCESS_TOKEN, "a"), (ACCESS_TOKEN, "b")]
+        assert await store.get("other", "x") is not None
+        assert (await store.stats())["sessions"] == 3
+    asyncio.run(main())
+
+def test_memory_max_bytes_eviction_keeps_conversations():
+    evicted = []
+
+    async def main():
+        store = MemorySessionStore(max_sessions=0, max_bytes=1, token_quota=0,
+                                   on_evict=lambda access_token, client_id, client: evicted.append(client))
+        await store.create(ACCESS_TOKEN, "a", new_client())
+        await store.append_turn(ACCESS_TOKEN, "a", new_turn(0), get_datetime_now())
+        # the last session is kept whatever its size
+        assert evicted == []
+        await store.create(ACCESS_TOKEN, "b", new_client())
+        assert [d.user for d in evicted[0]["conversations"]] == ["user 0"]
+        stats = await store.stats()
+        assert stats["sessions"] == 1 and stats["bytes"] > 0
+    asyncio.run(main())
+
+
+def test_incomplete_backend_fails_at_construction():
+    class IncompleteSessionStore(SessionStore):
+        async def get(self, access_token, client_id):
+            return None
+
+    with pytest.raises(TypeError):
+        IncompleteSessionStore()